@@ -0,0 +1,196 @@
+# -*- coding: utf-8; indent-tabs-mode: nil; python-indent: 2 -*-
+#
+# Copyright 2013 Thibauld Nion
+#
+# This file is part of WaterOnMars (https://github.com/tibonihoo/wateronmars) 
+#
+# WaterOnMars is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# WaterOnMars is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with WaterOnMars.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+
+"""
+Measure the core workloads (feed collection, unread items check, page
+rendering, imports and cleanup) on a synthetic dataset, reporting the
+wall time, number of queries and peak memory of each one as JSON.
+
+Usage: python -m benchmarks.core [NUM_ITEMS [OUTPUT_FILE]]
+
+NUM_ITEMS is the number of feed items of the dataset (from 10^3 to
+10^6). The benchmark runs in its own temporary database and the feeds
+are served by a local FeedServer so that no network access is needed.
+"""
+
+import os
+import sys
+import time
+import shutil
+import datetime
+import resource
+import tempfile
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE","wateronmars.settings")
+
+from django.conf import settings
+from django.db import connection
+from django.db import reset_queries
+from django.utils import simplejson
+from django.utils import timezone
+from django.test.client import Client
+from django.test.utils import setup_test_environment
+from django.contrib.auth.models import User
+
+# Number of new items in each feed served for the collection
+NEW_ITEMS_PER_FEED = 10
+
+# Number of feeds in the imported OPML file
+NUM_IMPORTED_FEEDS = 1000
+
+# Number of bookmarks in the imported bookmark file
+NUM_IMPORTED_BOOKMARKS = 1000
+
+# References published before now-OLD_REFERENCES_AGE are deleted by
+# the cleanup (about half of the generated items)
+OLD_REFERENCES_AGE = datetime.timedelta(weeks=4)
+
+
+def measure_operation(name,func,*args):
+  """Call func with args and return a dictionary of the wall time, the
+  number of db queries and the peak memory measured during the call."""
+  reset_queries()
+  rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  start = time.time()
+  func(*args)
+  duration = time.time()-start
+  max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  result = {
+    "name": name,
+    "seconds": round(duration,4),
+    "queries": len(connection.queries),
+    "max_rss_kb": max_rss,
+    "max_rss_increase_kb": max_rss-rss_before,
+    }
+  print >> sys.stderr, "%-30s %8.3fs %7d queries" \
+    % (name,duration,result["queries"])
+  return result
+
+
+def get_page(client,url,expected_status=200):
+  response = client.get(url)
+  if response.status_code!=expected_status:
+    raise RuntimeError("GET %s returned %d" % (url,response.status_code))
+  return response
+
+
+def run_operations(user):
+  from wom_river.tasks import collect_news_from_feeds
+  from wom_user.tasks import check_user_unread_feed_items
+  from wom_user.tasks import import_user_feedsources_from_opml
+  from wom_user.tasks import import_user_bookmarks_from_ns_list
+  import wom_pebbles.tasks
+  from benchmarks.opml_parsing import generate_opml
+  from benchmarks.data import PASSWORD
+  from benchmarks.data import generate_ns_bookmarks
+  client = Client()
+  client.login(username=user.username,password=PASSWORD)
+  opml_txt = generate_opml(NUM_IMPORTED_FEEDS)
+  nsbmk_txt = generate_ns_bookmarks(NUM_IMPORTED_BOOKMARKS)
+  operations = [
+    ("collect_news_from_feeds",collect_news_from_feeds),
+    ("check_user_unread_feed_items",check_user_unread_feed_items,user),
+    ("river page",get_page,client,"/u/%s/river/" % user.username),
+    ("sieve page",get_page,client,"/u/%s/sieve/" % user.username),
+    ("collection page",get_page,client,
+     "/u/%s/collection/" % user.username),
+    ("sources page",get_page,client,"/u/%s/sources/" % user.username),
+    ("import opml (%d feeds)" % NUM_IMPORTED_FEEDS,
+     import_user_feedsources_from_opml,user,opml_txt),
+    ("import bookmarks (%d)" % NUM_IMPORTED_BOOKMARKS,
+     import_user_bookmarks_from_ns_list,user,nsbmk_txt),
+    ("delete_old_references",wom_pebbles.tasks.delete_old_references,
+     timezone.now()-OLD_REFERENCES_AGE),
+    ]
+  # measure the work, not the pauses meant to spare concurrent requests
+  delete_pause = wom_pebbles.tasks.DELETE_PAUSE
+  wom_pebbles.tasks.DELETE_PAUSE = 0
+  try:
+    return [measure_operation(*op) for op in operations]
+  finally:
+    wom_pebbles.tasks.DELETE_PAUSE = delete_pause
+
+
+def create_benchmark_db(work_dir):
+  """Create the benchmark's empty db (a SQLite file in work_dir with
+  the default settings) and return the name of the original db."""
+  from south.management.commands import patch_for_test_db_setup
+  settings.DEMO = False
+  settings.DATABASES["default"]["TEST_NAME"] = os.path.join(work_dir,
+                                                            "bench.sql3")
+  setup_test_environment()
+  patch_for_test_db_setup()
+  return connection.creation.create_test_db(verbosity=0,autoclobber=True)
+
+
+def write_report(report,output=None):
+  """Write the report as JSON in the output file (or on stdout)."""
+  report.update({
+    "database": settings.DATABASES["default"]["ENGINE"],
+    "python": sys.version.split()[0],
+    "date": datetime.datetime.utcnow().isoformat(),
+    })
+  report_txt = simplejson.dumps(report,indent=2,sort_keys=True)
+  if output:
+    with open(output,"w") as output_file:
+      output_file.write(report_txt)
+  else:
+    print report_txt
+  return report
+
+
+def run(num_items,output=None):
+  from benchmarks.data import generate_dataset
+  from benchmarks.data import get_dataset_size
+  from benchmarks.feed_server import FeedServer
+  work_dir = tempfile.mkdtemp(prefix="wom_benchmark")
+  old_db_name = create_benchmark_db(work_dir)
+  # the feeds' entries are published after the dataset's generation
+  feed_server = FeedServer(num_feeds=get_dataset_size(num_items).num_feeds,
+                           entries_per_feed=NEW_ITEMS_PER_FEED,
+                           origin=datetime.datetime.utcnow()
+                           +datetime.timedelta(minutes=1))
+  feed_server.start()
+  try:
+    print >> sys.stderr, "Generating a dataset of %d items..." % num_items
+    start = time.time()
+    counts = generate_dataset(num_items,feed_server.feed_url)
+    generation_seconds = time.time()-start
+    # DEBUG is required for django to record the queries
+    settings.DEBUG = True
+    user = User.objects.order_by("id")[0]
+    operations = run_operations(user)
+  finally:
+    settings.DEBUG = False
+    feed_server.stop()
+    connection.creation.destroy_test_db(old_db_name,verbosity=0)
+    shutil.rmtree(work_dir,ignore_errors=True)
+  return write_report({
+    "num_items": num_items,
+    "dataset": counts,
+    "generation_seconds": round(generation_seconds,2),
+    "operations": operations,
+    },output)
+
+if __name__ == '__main__':
+  run(int(sys.argv[1]) if len(sys.argv)>1 else 10000,
+      sys.argv[2] if len(sys.argv)>2 else None)
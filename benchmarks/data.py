@@ -0,0 +1,210 @@
+# -*- coding: utf-8; indent-tabs-mode: nil; python-indent: 2 -*-
+#
+# Copyright 2013 Thibauld Nion
+#
+# This file is part of WaterOnMars (https://github.com/tibonihoo/wateronmars) 
+#
+# WaterOnMars is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# WaterOnMars is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with WaterOnMars.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+
+"""
+Generate synthetic datasets for the benchmarks: users following web
+feeds full of references, with statuses, bookmarks and tags.
+
+The size of a dataset is driven by its number of feed items (from 10^3
+to 10^6) from which the number of feeds, users, statuses and bookmarks
+are derived.
+"""
+
+import datetime
+from collections import namedtuple
+
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+from django.contrib.auth.models import User
+from django.contrib.auth.hashers import make_password
+from django.contrib.contenttypes.models import ContentType
+
+from wom_pebbles.models import Reference
+from wom_river.models import WebFeed
+from wom_user.models import UserProfile
+from wom_user.models import UserBookmark
+from wom_user.models import ReferenceUserStatus
+from wom_user.models import rebuild_user_source_tags
+from wom_classification.models import Tag
+from wom_classification.models import ClassificationData
+from wom_classification.models import rebuild_tag_usage
+
+
+# Password of all the generated users
+PASSWORD = "bench"
+
+# Number of rows inserted at once
+BATCH_SIZE = 500
+
+# Number of distinct tag names
+NUM_TAGS = 20
+
+# The feed items are published over this period before "now"
+ITEMS_PERIOD = datetime.timedelta(weeks=8)
+
+
+DatasetSize = namedtuple("DatasetSize",
+                         "num_feeds items_per_feed num_users feeds_per_user "
+                         "bookmarks_per_user")
+
+def get_dataset_size(num_items):
+  """Derive the size of each part of a dataset from its total number
+  of feed items."""
+  num_feeds = max(10,num_items//100)
+  num_users = max(2,num_items//5000)
+  return DatasetSize(num_feeds=num_feeds,
+                     items_per_feed=max(1,num_items//num_feeds),
+                     num_users=num_users,
+                     feeds_per_user=min(num_feeds,50),
+                     bookmarks_per_user=max(10,num_items//(10*num_users)))
+
+
+def bulk_create_with_ids(model,instances):
+  """Save the instances with bulk_create and return the list of their
+  ids (assuming, as for a freshly created benchmark db, that nobody
+  else is inserting rows in the model's table).
+  """
+  first_id = (model.objects.aggregate(Max("id"))["id__max"] or 0)+1
+  model.objects.bulk_create(instances,batch_size=BATCH_SIZE)
+  ids = range(first_id,first_id+len(instances))
+  assert model.objects.filter(id__gte=first_id).count()==len(instances)
+  return ids
+
+
+def generate_dataset(num_items,get_feed_url):
+  """Fill the db with a synthetic dataset of num_items feed items
+  (get_feed_url giving the xmlURL of the i-th feed) and return the
+  dictionary of the number of rows created per model.
+  """
+  size = get_dataset_size(num_items)
+  now = timezone.now()
+  item_delta = ITEMS_PERIOD//max(1,size.items_per_feed)
+  counts = {}
+  with transaction.commit_on_success():
+    # Feeds and their items
+    source_ids = bulk_create_with_ids(Reference,[
+      Reference(url="http://bench.example.com/f%d" % i,
+                title="Feed %d" % i,pub_date=now)
+      for i in range(size.num_feeds)])
+    feed_ids = bulk_create_with_ids(WebFeed,[
+      WebFeed(xmlURL=get_feed_url(i),source_id=src_id,
+              last_update_check=now)
+      for i,src_id in enumerate(source_ids)])
+    ReferenceSources = Reference.sources.through
+    item_ids_by_feed = []
+    for i,src_id in enumerate(source_ids):
+      item_dates = [now-ITEMS_PERIOD+j*item_delta
+                    for j in range(size.items_per_feed)]
+      item_ids = bulk_create_with_ids(Reference,[
+        Reference(url="http://bench.example.com/f%d/%d" % (i,j),
+                  title="Item %d of feed %d" % (j,i),
+                  description="<p>Item <b>%d</b> of feed %d.</p>" % (j,i),
+                  pub_date=d)
+        for j,d in enumerate(item_dates)])
+      ReferenceSources.objects.bulk_create(
+        [ReferenceSources(from_reference_id=item_id,to_reference_id=src_id)
+         for item_id in item_ids],batch_size=BATCH_SIZE)
+      item_ids_by_feed.append(zip(item_ids,item_dates))
+    counts["feeds"] = size.num_feeds
+    counts["references"] = size.num_feeds*(1+size.items_per_feed)
+    # Users with their subscriptions, statuses and bookmarks
+    tag_ids = bulk_create_with_ids(Tag,[Tag(name="tag%d" % i)
+                                        for i in range(NUM_TAGS)])
+    password = make_password(PASSWORD)
+    user_ids = bulk_create_with_ids(User,[
+      User(username="user%d" % i,password=password)
+      for i in range(size.num_users)])
+    profile_ids = bulk_create_with_ids(UserProfile,[
+      UserProfile(owner_id=user_id) for user_id in user_ids])
+    feed_type = ContentType.objects.get_for_model(WebFeed)
+    ref_type = ContentType.objects.get_for_model(Reference)
+    counts["users"] = size.num_users
+    counts["statuses"] = 0
+    counts["bookmarks"] = 0
+    counts["classification_data"] = 0
+    for u,(user_id,profile_id) in enumerate(zip(user_ids,profile_ids)):
+      followed = [(u*size.feeds_per_user//2+k) % size.num_feeds
+                  for k in range(size.feeds_per_user)]
+      UserProfile.web_feeds.through.objects.bulk_create(
+        [UserProfile.web_feeds.through(userprofile_id=profile_id,
+                                       webfeed_id=feed_ids[f])
+         for f in followed],batch_size=BATCH_SIZE)
+      for relationship in (UserProfile.sources,UserProfile.public_sources):
+        relationship.through.objects.bulk_create(
+          [relationship.through(userprofile_id=profile_id,
+                                reference_id=source_ids[f])
+           for f in followed],batch_size=BATCH_SIZE)
+      statuses = []
+      for f in followed:
+        for j,(item_id,item_date) in enumerate(item_ids_by_feed[f]):
+          statuses.append(ReferenceUserStatus(
+            owner_id=user_id,reference_id=item_id,
+            reference_pub_date=item_date,main_source_id=source_ids[f],
+            has_been_read=(j%2==0)))
+      ReferenceUserStatus.objects.bulk_create(statuses,batch_size=BATCH_SIZE)
+      counts["statuses"] += len(statuses)
+      # bookmarks spread over all the feeds
+      bookmarked = [item_ids_by_feed[(u+k) % size.num_feeds]\
+                    [(k*7) % size.items_per_feed]
+                    for k in range(size.bookmarks_per_user)]
+      bookmarked = dict(bookmarked).items()
+      UserBookmark.objects.bulk_create(
+        [UserBookmark(owner_id=user_id,reference_id=item_id,
+                      saved_date=item_date,is_public=(k%3!=0),
+                      comment="Comment %d" % k)
+         for k,(item_id,item_date) in enumerate(bookmarked)],
+        batch_size=BATCH_SIZE)
+      counts["bookmarks"] += len(bookmarked)
+      # tags on the followed feeds and the bookmarks
+      tagged = [(feed_type.id,feed_ids[f]) for f in followed]\
+               + [(ref_type.id,item_id) for item_id,_ in bookmarked]
+      cd_ids = bulk_create_with_ids(ClassificationData,[
+        ClassificationData(owner_id=user_id,content_type_id=type_id,
+                           object_id=object_id)
+        for type_id,object_id in tagged])
+      ClassificationData.tags.through.objects.bulk_create(
+        [ClassificationData.tags.through(classificationdata_id=cd_id,
+                                         tag_id=tag_ids[(k+t) % NUM_TAGS])
+         for k,cd_id in enumerate(cd_ids) for t in range(2)],
+        batch_size=BATCH_SIZE)
+      counts["classification_data"] += len(cd_ids)
+    Reference.objects.filter(userbookmark__isnull=False)\
+                     .update(save_count=1)
+  rebuild_tag_usage()
+  for user in User.objects.filter(id__in=user_ids):
+    rebuild_user_source_tags(user)
+  return counts
+
+
+def generate_ns_bookmarks(num_bookmarks):
+  """Generate a Netscape-style bookmark file with num_bookmarks links
+  that are not in the generated datasets."""
+  lines = ["<!DOCTYPE NETSCAPE-Bookmark-file-1>",
+           "<TITLE>Bookmarks</TITLE>","<H1>Bookmarks</H1>","<DL><p>"]
+  for i in range(num_bookmarks):
+    lines.append('<DT><A HREF="http://bench.example.com/bmk/%d" '
+                 'ADD_DATE="%d" PRIVATE="%d" TAGS="tag%d,bench">'
+                 'Bookmark %d</A>' % (i,1367951483+i,i%2,i%NUM_TAGS,i))
+    lines.append("<DD>Description of bookmark %d" % i)
+  lines.append("</DL><p>")
+  return "\n".join(lines)
@@ -0,0 +1,332 @@
+# -*- coding: utf-8; indent-tabs-mode: nil; python-indent: 2 -*-
+#
+# Copyright 2013 Thibauld Nion
+#
+# This file is part of WaterOnMars (https://github.com/tibonihoo/wateronmars) 
+#
+# WaterOnMars is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# WaterOnMars is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with WaterOnMars.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+"""
+A local HTTP server standing in for the web sites and their feeds, so
+that the feed collection and discovery can be tested and benchmarked
+offline and deterministically.
+
+It serves, for each of its feeds:
+
+- /feed/<i>.xml: a RSS or Atom feed with its latest entries,
+- /site/<i>/: a HTML page linking to the feed (for feed discovery),
+
+and a /robots.txt allowing everything.
+
+Usage: python -m benchmarks.feed_server [NUM_FEEDS [PORT]]
+"""
+
+import sys
+import time
+import random
+import calendar
+import datetime
+import threading
+import BaseHTTPServer
+import SocketServer
+from email.utils import formatdate
+from email.utils import parsedate_tz
+from email.utils import mktime_tz
+from xml.sax.saxutils import escape
+
+
+RSS_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<rss version="2.0"><channel><title>Feed %(index)d</title>
+<link>%(site_url)s</link><description>Synthetic feed %(index)d</description>
+%(entries)s
+</channel></rss>"""
+
+RSS_ENTRY_TEMPLATE = """<item><title>Entry %(num)d of feed %(index)d</title>
+<link>%(url)s</link><guid>%(url)s</guid><pubDate>%(date)s</pubDate>
+<category>cat%(category)d</category>
+<description>%(description)s</description></item>"""
+
+ATOM_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom"><title>Feed %(index)d</title>
+<link href="%(site_url)s"/><id>%(site_url)s</id><updated>%(updated)s</updated>
+%(entries)s
+</feed>"""
+
+ATOM_ENTRY_TEMPLATE = """<entry><title>Entry %(num)d of feed %(index)d</title>
+<link href="%(url)s"/><id>%(url)s</id><updated>%(date)s</updated>
+<category term="cat%(category)d"/>
+<summary type="html">%(description)s</summary></entry>"""
+
+SITE_TEMPLATE = """<!DOCTYPE html>
+<html><head><title>Site %(index)d</title>
+<link rel="alternate" type="%(feed_type)s" title="Feed %(index)d" href="%(feed_path)s">
+</head><body><h1>Site %(index)d</h1></body></html>"""
+
+ROBOTS_TXT = "User-agent: *\nDisallow:\n"
+
+
+class FeedServer(object):
+  """Serve synthetic feeds from a background thread.
+
+  num_feeds: number of feeds served.
+  entries_per_feed: number of entries in each feed.
+  entry_size: approximate size in bytes of each entry's description.
+  churn: number of new entries published by each feed every
+    churn_period seconds (and for each call to advance()).
+  latency: delay in seconds before answering each request.
+  error_rate: fraction of the requests answered with a 500 error.
+  conditional: if True, send ETag and Last-Modified headers and answer
+    the matching conditional requests with a 304.
+  atom_ratio: fraction of the feeds served as Atom instead of RSS.
+  origin: publication date of the first entry (defaults to a date
+    making the entries of the initial feeds published in the past
+    minutes).
+  """
+
+  def __init__(self,num_feeds=1000,entries_per_feed=20,entry_size=500,
+               churn=0,churn_period=60,latency=0,error_rate=0,
+               conditional=True,atom_ratio=0.5,origin=None,seed=0,
+               port=0):
+    self.num_feeds = num_feeds
+    self.entries_per_feed = entries_per_feed
+    self.entry_size = entry_size
+    self.churn = churn
+    self.churn_period = churn_period
+    self.latency = latency
+    self.error_rate = error_rate
+    self.conditional = conditional
+    self.atom_ratio = atom_ratio
+    self.entry_interval = datetime.timedelta(minutes=1)
+    if origin is None:
+      origin = datetime.datetime.utcnow() \
+               - self.entry_interval*(entries_per_feed+1)
+    self.origin = origin
+    self.random = random.Random(seed)
+    self.lock = threading.Lock()
+    self.base_generation = 0
+    self.stats = dict(requests=0,feeds=0,sites=0,not_modified=0,errors=0)
+    self.port = port
+    self.httpd = None
+    self.thread = None
+
+  # Content generation
+
+  def get_generation(self):
+    """Return the number of times each feed has been updated."""
+    generation = self.base_generation
+    if self.churn and self.churn_period:
+      generation += int((time.time()-self.start_time)/self.churn_period)
+    return generation
+
+  def advance(self,num_generations=1):
+    """Publish churn new entries in each feed right away."""
+    with self.lock:
+      self.base_generation += num_generations
+
+  def is_atom(self,index):
+    # spread the Atom feeds evenly among the RSS ones
+    return int((index+1)*self.atom_ratio)>int(index*self.atom_ratio)
+
+  def get_entry_date(self,num):
+    return self.origin+self.entry_interval*num
+
+  def get_feed_entries(self,index,generation):
+    """Return the numbers of the entries of a feed (newest first)."""
+    newest = generation*self.churn+self.entries_per_feed-1
+    return range(newest,max(-1,newest-self.entries_per_feed),-1)
+
+  def generate_feed(self,index,generation):
+    """Return the content and modification date of a feed."""
+    atom = self.is_atom(index)
+    site_url = self.site_url(index)
+    filler = "lorem ipsum " * (self.entry_size//12)
+    entry_template = ATOM_ENTRY_TEMPLATE if atom else RSS_ENTRY_TEMPLATE
+    entries = []
+    nums = self.get_feed_entries(index,generation)
+    for num in nums:
+      date = self.get_entry_date(num)
+      entries.append(entry_template % {
+        "num": num, "index": index, "category": num % 5,
+        "url": "%sentry/%d" % (site_url,num),
+        "date": format_date(date,atom),
+        "description": escape("<p>Entry <b>%d</b>. %s</p>" % (num,filler))})
+    last_modified = self.get_entry_date(nums[0] if nums else 0)
+    feed_template = ATOM_TEMPLATE if atom else RSS_TEMPLATE
+    return feed_template % {"index": index, "site_url": site_url,
+                            "updated": format_date(last_modified,True),
+                            "entries": "\n".join(entries)}, last_modified
+
+  # URLs
+
+  def url(self,path=""):
+    return "http://127.0.0.1:%d/%s" % (self.port,path.lstrip("/"))
+
+  def feed_url(self,index):
+    return self.url("feed/%d.xml" % index)
+
+  def site_url(self,index):
+    return self.url("site/%d/" % index)
+
+  # Server management
+
+  def start(self):
+    self.httpd = FeedHTTPServer(("127.0.0.1",self.port),FeedRequestHandler)
+    self.httpd.feed_server = self
+    self.port = self.httpd.server_address[1]
+    self.start_time = time.time()
+    self.thread = threading.Thread(target=self.httpd.serve_forever)
+    self.thread.daemon = True
+    self.thread.start()
+    return self
+
+  def stop(self):
+    if self.httpd is not None:
+      self.httpd.shutdown()
+      self.httpd.server_close()
+      self.thread.join()
+      self.httpd = None
+
+  def __enter__(self):
+    return self.start()
+
+  def __exit__(self,exc_type,exc_value,traceback):
+    self.stop()
+
+  def count(self,stat_name):
+    with self.lock:
+      self.stats[stat_name] += 1
+
+  def should_fail(self):
+    if not self.error_rate:
+      return False
+    with self.lock:
+      return self.random.random()<self.error_rate
+    
+
+def format_date(date,atom):
+  if atom:
+    return date.strftime("%Y-%m-%dT%H:%M:%SZ")
+  return date.strftime("%a, %d %b %Y %H:%M:%S GMT")
+
+
+class FeedHTTPServer(SocketServer.ThreadingMixIn,BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+  request_queue_size = 128
+  
+
+class FeedRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+  protocol_version = "HTTP/1.0"
+
+  def log_message(self,format,*args):
+    pass
+
+  def send_content(self,content,content_type,extra_headers=()):
+    self.send_response(200)
+    self.send_header("Content-Type",content_type)
+    self.send_header("Content-Length",str(len(content)))
+    for header in extra_headers:
+      self.send_header(*header)
+    self.end_headers()
+    if self.command!="HEAD":
+      self.wfile.write(content)
+
+  def do_HEAD(self):
+    self.do_GET()
+    
+  def do_GET(self):
+    server = self.server.feed_server
+    server.count("requests")
+    if server.latency:
+      time.sleep(server.latency)
+    if server.should_fail():
+      server.count("errors")
+      self.send_error(500,"Synthetic error")
+      return
+    parts = self.path.split("?")[0].strip("/").split("/")
+    try:
+      if parts==["robots.txt"]:
+        return self.send_content(ROBOTS_TXT,"text/plain")
+      if len(parts)==2 and parts[0]=="feed" and parts[1].endswith(".xml"):
+        return self.send_feed(server,int(parts[1][:-4]))
+      if len(parts)>=2 and parts[0]=="site":
+        return self.send_site(server,int(parts[1]))
+    except ValueError:
+      pass
+    self.send_error(404)
+
+  def check_index(self,server,index):
+    if not 0<=index<server.num_feeds:
+      raise ValueError(index)
+
+  def send_site(self,server,index):
+    self.check_index(server,index)
+    server.count("sites")
+    self.send_content(SITE_TEMPLATE % {
+      "index": index,
+      "feed_type": "application/atom+xml" if server.is_atom(index) \
+                   else "application/rss+xml",
+      "feed_path": "/feed/%d.xml" % index},"text/html; charset=utf-8")
+    
+  def send_feed(self,server,index):
+    self.check_index(server,index)
+    generation = server.get_generation()
+    content,last_modified = server.generate_feed(index,generation)
+    headers = []
+    if server.conditional:
+      etag = '"%d-%d-%d"' % (index,generation,server.churn)
+      last_modified_txt = formatdate(
+        calendar.timegm(last_modified.utctimetuple()),usegmt=True)
+      headers = [("ETag",etag),("Last-Modified",last_modified_txt)]
+      if self.is_not_modified(etag,last_modified):
+        server.count("not_modified")
+        self.send_response(304)
+        for header in headers:
+          self.send_header(*header)
+        self.end_headers()
+        return
+    server.count("feeds")
+    content_type = "application/atom+xml" if server.is_atom(index) \
+                   else "application/rss+xml"
+    self.send_content(content,content_type+"; charset=utf-8",headers)
+
+  def is_not_modified(self,etag,last_modified):
+    if_none_match = self.headers.get("If-None-Match")
+    if if_none_match is not None:
+      return etag in [t.strip() for t in if_none_match.split(",")]
+    if_modified_since = self.headers.get("If-Modified-Since")
+    if if_modified_since is not None:
+      parsed_date = parsedate_tz(if_modified_since)
+      if parsed_date is not None:
+        since = datetime.datetime.utcfromtimestamp(mktime_tz(parsed_date))
+        return last_modified.replace(microsecond=0)<=since
+    return False
+
+
+def run(num_feeds,port):
+  server = FeedServer(num_feeds=num_feeds,port=port).start()
+  print "Serving %d feeds at %s (feed/<i>.xml, site/<i>/)" \
+    % (num_feeds,server.url())
+  try:
+    while True:
+      time.sleep(3600)
+  except KeyboardInterrupt:
+    server.stop()
+
+
+if __name__ == '__main__':
+  run(int(sys.argv[1]) if len(sys.argv)>1 else 1000,
+      int(sys.argv[2]) if len(sys.argv)>2 else 8000)
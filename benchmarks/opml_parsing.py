@@ -0,0 +1,76 @@
+# -*- coding: utf-8; indent-tabs-mode: nil; python-indent: 2 -*-
+#
+# Copyright 2013 Thibauld Nion
+#
+# This file is part of WaterOnMars (https://github.com/tibonihoo/wateronmars) 
+#
+# WaterOnMars is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# WaterOnMars is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with WaterOnMars.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+"""
+Measure the time taken to parse a big synthetic OPML file.
+
+Usage: python -m benchmarks.opml_parsing [NUM_OUTLINES]
+"""
+
+import sys
+import time
+import resource
+
+from wom_river.utils.read_opml import parse_opml
+
+# Number of feeds in each folder of the synthetic file
+FEEDS_PER_FOLDER = 100
+
+
+def generate_opml(num_outlines):
+  """Generate an OPML file with num_outlines feed outlines grouped in
+  folders, one feed out of ten being listed a second time in another
+  folder.
+  """
+  lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+           '<opml version="2.0"><head><title>Benchmark</title></head><body>']
+  for i in range(num_outlines):
+    if i % FEEDS_PER_FOLDER == 0:
+      if i:
+        lines.append('</outline>')
+      lines.append('<outline text="folder%d">' % (i // FEEDS_PER_FOLDER))
+    feed_id = i-FEEDS_PER_FOLDER-1 if (i % 10 == 9 and i>FEEDS_PER_FOLDER) else i
+    lines.append('<outline text="Feed %d" type="rss" '
+                 'xmlUrl="http://feed%d.example.com/rss.xml" '
+                 'htmlUrl="http://feed%d.example.com" category="c%d"/>'\
+                 % (feed_id,feed_id,feed_id,i % 7))
+  if num_outlines:
+    lines.append('</outline>')
+  lines.append('</body></opml>')
+  return "\n".join(lines)
+
+
+def run(num_outlines):
+  opml_txt = generate_opml(num_outlines)
+  start = time.time()
+  feeds,tags = parse_opml(opml_txt,False)
+  duration = time.time()-start
+  max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  print "Parsed %d outlines (%d feeds, %d tags) in %.3fs (max RSS: %d kB)"\
+    % (num_outlines,len(feeds),len(tags),duration,max_rss)
+  return duration
+
+
+if __name__ == '__main__':
+  if len(sys.argv)>1:
+    run(int(sys.argv[1]))
+  else:
+    run(20000)
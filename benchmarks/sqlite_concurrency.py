@@ -0,0 +1,224 @@
+# -*- coding: utf-8; indent-tabs-mode: nil; python-indent: 2 -*-
+#
+# Copyright 2013 Thibauld Nion
+#
+# This file is part of WaterOnMars (https://github.com/tibonihoo/wateronmars) 
+#
+# WaterOnMars is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# WaterOnMars is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with WaterOnMars.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+"""
+Measure how page reads and feed collection writes get along when they
+run concurrently on a SQLite db holding a synthetic dataset, with and
+without the SQLite profile of wom_pebbles (WAL journal, relaxed
+synchronous mode, bigger cache, busy timeout...).
+
+Usage: python -m benchmarks.sqlite_concurrency [NUM_ITEMS [NUM_READERS [SECONDS [OUTPUT_FILE]]]]
+"""
+
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE","wateronmars.settings")
+
+from django.conf import settings
+from django.db import connection
+from django.db import transaction
+from django.db import DatabaseError
+from django.utils import timezone
+from django.contrib.auth.models import User
+
+from benchmarks.core import create_benchmark_db
+from benchmarks.core import write_report
+
+# Number of news items written by each collection transaction
+WRITE_BATCH_SIZE = 20
+
+
+def get_percentile(sorted_values,percentile):
+  if not sorted_values:
+    return None
+  return sorted_values[min(len(sorted_values)-1,
+                           len(sorted_values)*percentile//100)]
+
+
+class WorkerStats(object):
+  """Durations of the successful operations of a worker and number of
+  operations that failed because the db was locked."""
+  
+  def __init__(self):
+    self.durations = []
+    self.lock_errors = 0
+
+  def measure(self,operation):
+    start = time.time()
+    try:
+      operation()
+    except DatabaseError,e:
+      if "locked" not in str(e):
+        raise
+      self.lock_errors += 1
+      transaction.rollback_unless_managed()
+    else:
+      self.durations.append(time.time()-start)
+
+
+def summarize(stats,duration):
+  durations = sorted(d for s in stats for d in s.durations)
+  return {
+    "count": len(durations),
+    "per_second": round(len(durations)/duration,1),
+    "p50_ms": round(get_percentile(durations,50)*1000,2) if durations else None,
+    "p95_ms": round(get_percentile(durations,95)*1000,2) if durations else None,
+    "lock_errors": sum(s.lock_errors for s in stats),
+    }
+
+
+def read_river(user_id):
+  """Run the queries of the river page of a user."""
+  from wom_user.models import ReferenceUserStatus
+  statuses = ReferenceUserStatus.objects.filter(owner=user_id)
+  list(statuses.order_by("-reference_pub_date")\
+       .select_related("reference","main_source")[:100])
+  statuses.filter(has_been_read=False).count()
+
+
+def write_news(feed,user_id,batch_index):
+  """Save a batch of news items for a feed, as the collection and the
+  check of the unread items do."""
+  from wom_pebbles.models import Reference
+  from wom_user.models import ReferenceUserStatus
+  now = timezone.now()
+  with transaction.commit_on_success():
+    statuses = []
+    for i in range(WRITE_BATCH_SIZE):
+      ref = Reference.objects.create(
+        url="%s/bench/%d/%d" % (feed.source.url,batch_index,i),
+        title="New item %d" % i,description="<p>New</p>",pub_date=now)
+      ref.sources.add(feed.source)
+      statuses.append(ReferenceUserStatus(owner_id=user_id,reference=ref,
+                                          reference_pub_date=now,
+                                          main_source=feed.source))
+    ReferenceUserStatus.objects.bulk_create(statuses)
+    feed.last_update_check = now
+    feed.save()
+
+
+def run_worker(name,worker,duration,results,*args):
+  """Run worker(stats,*args) repeatedly for duration seconds and put
+  the resulting stats, labelled with name, in the results queue."""
+  # never share the parent's connection
+  connection.close()
+  stats = WorkerStats()
+  deadline = time.time()+duration
+  try:
+    while time.time()<deadline:
+      worker(stats,*args)
+  finally:
+    connection.close()
+    results.put((name,stats))
+
+  
+def read_rivers(stats,user_ids,rand):
+  stats.measure(lambda: read_river(rand.choice(user_ids)))
+
+
+def write_batches(stats,feeds,user_id,batch_counter):
+  batch_counter[0] += 1
+  feed = feeds[batch_counter[0] % len(feeds)]
+  stats.measure(lambda: write_news(feed,user_id,batch_counter[0]))
+
+  
+def measure_concurrency(num_readers,duration):
+  """Run num_readers processes reading river pages and one process
+  collecting news for duration seconds and return their stats."""
+  from multiprocessing import Process
+  from multiprocessing import Queue
+  from wom_river.models import WebFeed
+  user_ids = list(User.objects.values_list("id",flat=True))
+  feeds = list(WebFeed.objects.select_related("source"))
+  connection.close()
+  results = Queue()
+  processes = [Process(target=run_worker,
+                       args=("reads",read_rivers,duration,results,user_ids,
+                             random.Random(i)))
+               for i in range(num_readers)]
+  processes.append(Process(target=run_worker,
+                           args=("writes",write_batches,duration,results,
+                                 feeds,user_ids[0],[0])))
+  for p in processes:
+    p.start()
+  stats_by_name = {}
+  for _ in processes:
+    name,stats = results.get()
+    stats_by_name.setdefault(name,[]).append(stats)
+  for p in processes:
+    p.join()
+  return dict((name,summarize(stats,duration))
+              for name,stats in stats_by_name.items())
+
+
+def remove_db_files(db_path):
+  for path in (db_path,db_path+"-wal",db_path+"-shm",db_path+"-journal"):
+    if os.path.exists(path):
+      os.remove(path)
+  
+
+def run(num_items,num_readers,duration,output=None):
+  import wom_pebbles.models
+  from benchmarks.data import generate_dataset
+  work_dir = tempfile.mkdtemp(prefix="wom_benchmark")
+  old_db_name = create_benchmark_db(work_dir)
+  db_path = settings.DATABASES["default"]["NAME"]
+  initial_profile = wom_pebbles.models.SQLITE_PROFILE
+  try:
+    print >> sys.stderr, "Generating a dataset of %d items..." % num_items
+    wom_pebbles.models.SQLITE_PROFILE = False
+    counts = generate_dataset(num_items,
+                              lambda i: "http://127.0.0.1/feed/%d.xml" % i)
+    connection.close()
+    dataset_path = os.path.join(work_dir,"dataset.sql3")
+    shutil.copy(db_path,dataset_path)
+    results = {}
+    for profile in (False,True):
+      remove_db_files(db_path)
+      shutil.copy(dataset_path,db_path)
+      wom_pebbles.models.SQLITE_PROFILE = profile
+      name = "sqlite_profile" if profile else "default"
+      results[name] = measure_concurrency(num_readers,duration)
+      print >> sys.stderr, "%-15s reads: %s" % (name,results[name]["reads"])
+      print >> sys.stderr, "%-15s writes: %s" % (name,results[name]["writes"])
+  finally:
+    wom_pebbles.models.SQLITE_PROFILE = initial_profile
+    connection.creation.destroy_test_db(old_db_name,verbosity=0)
+    shutil.rmtree(work_dir,ignore_errors=True)
+  return write_report({
+    "num_items": num_items,
+    "num_readers": num_readers,
+    "seconds": duration,
+    "dataset": counts,
+    "results": results,
+    },output)
+
+
+if __name__ == '__main__':
+  run(int(sys.argv[1]) if len(sys.argv)>1 else 10000,
+      int(sys.argv[2]) if len(sys.argv)>2 else 4,
+      float(sys.argv[3]) if len(sys.argv)>3 else 10,
+      sys.argv[4] if len(sys.argv)>4 else None)
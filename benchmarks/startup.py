@@ -0,0 +1,124 @@
+# -*- coding: utf-8; indent-tabs-mode: nil; python-indent: 2 -*-
+#
+# Copyright 2013 Thibauld Nion
+#
+# This file is part of WaterOnMars (https://github.com/tibonihoo/wateronmars) 
+#
+# WaterOnMars is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# WaterOnMars is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with WaterOnMars.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+
+"""
+Measure the startup time of the management commands and of the web
+workers, and check that the heavy modules (feed parsing, html
+sanitizing, feed discovery...) are not imported at startup.
+
+Usage: python -m benchmarks.startup [NUM_RUNS [MAX_SECONDS]]
+
+Exits with a non-zero status if a heavy module is imported at startup
+or if the median time of a scenario exceeds MAX_SECONDS.
+"""
+
+import os
+import sys
+import time
+import subprocess
+
+# Modules that should only be imported when they are actually needed.
+HEAVY_MODULES = ("feedparser","bs4","sgmllib","robotparser","xmlrpclib",
+                 "multiprocessing","wom_river.utils.feedfinder")
+
+# Print the heavy modules found in sys.modules at the end of a run.
+REPORT_HEAVY_MODULES = """
+import sys
+print "HEAVY_MODULES:" + ",".join(m for m in %r if m in sys.modules)
+""" % (HEAVY_MODULES,)
+
+# Boot a web worker (without the startup tasks) and load all the views
+WSGI_BOOT_SCRIPT = """
+import os
+os.environ.setdefault("DJANGO_SETTINGS_MODULE","wateronmars.settings")
+from django.conf import settings
+settings.DEMO = False
+import wateronmars.wsgi
+from django.core.urlresolvers import get_resolver
+get_resolver(None).reverse_dict
+""" + REPORT_HEAVY_MODULES
+
+# Import the project settings and run manage.py's help command
+MANAGE_HELP_SCRIPT = """
+import os
+import sys
+import StringIO
+os.environ.setdefault("DJANGO_SETTINGS_MODULE","wateronmars.settings")
+from django.core.management import execute_from_command_line
+stdout = sys.stdout
+sys.stdout = StringIO.StringIO()
+execute_from_command_line(["manage.py","help"])
+sys.stdout = stdout
+""" + REPORT_HEAVY_MODULES
+
+SCENARIOS = (
+  ("manage.py help",MANAGE_HELP_SCRIPT),
+  ("wsgi worker boot",WSGI_BOOT_SCRIPT),
+  )
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure(script,num_runs):
+  """Run the script in num_runs fresh interpreters and return the
+  sorted list of durations and the heavy modules it imported.
+  """
+  durations = []
+  heavy_modules = set()
+  for i in range(num_runs):
+    start = time.time()
+    command = [sys.executable,"-c",script]
+    with open(os.devnull,"w") as devnull:
+      process = subprocess.Popen(command,cwd=PROJECT_DIR,
+                                 stdout=subprocess.PIPE,stderr=devnull)
+      output = process.communicate()[0]
+    if process.returncode!=0:
+      raise subprocess.CalledProcessError(process.returncode,command)
+    durations.append(time.time()-start)
+    for line in output.splitlines():
+      if line.startswith("HEAVY_MODULES:"):
+        heavy_modules.update(m for m in line[len("HEAVY_MODULES:"):].split(",")
+                             if m)
+  return sorted(durations),heavy_modules
+
+
+def run(num_runs,max_seconds=None):
+  success = True
+  for name,script in SCENARIOS:
+    durations,heavy_modules = measure(script,num_runs)
+    median = durations[len(durations)//2]
+    print "%s: median %.3fs, min %.3fs over %d runs" \
+      % (name,median,durations[0],num_runs)
+    if heavy_modules:
+      print "  ERROR: heavy modules imported: %s" \
+        % ", ".join(sorted(heavy_modules))
+      success = False
+    if max_seconds is not None and median>max_seconds:
+      print "  ERROR: slower than %.3fs" % max_seconds
+      success = False
+  return success
+
+
+if __name__ == '__main__':
+  num_runs = int(sys.argv[1]) if len(sys.argv)>1 else 5
+  max_seconds = float(sys.argv[2]) if len(sys.argv)>2 else None
+  sys.exit(0 if run(num_runs,max_seconds) else 1)
@@ -87,7 +87,9 @@ WARNING: Make sure to clean any db used by Django before the reset !""")
     print("Setup the base db")
     local("python manage.py syncdb")
     local("python manage.py migrate")
+    local("python manage.py wom_bootstrap")
     
 def db_update():
     local("python manage.py syncdb")
     local("python manage.py migrate")
+    local("python manage.py wom_bootstrap")
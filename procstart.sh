@@ -1,3 +1,3 @@
 # Local Processes configuration for test deployment
-screen -L -d -m python manage.py celeryd -E -B --loglevel=INFO
+screen -L -d -m python manage.py wom_worker
 python manage.py runserver
@@ -0,0 +1,238 @@
+# -*- coding: utf-8; indent-tabs-mode: nil; python-indent: 2 -*-
+#
+# Copyright 2013 Thibauld Nion
+#
+# This file is part of WaterOnMars (https://github.com/tibonihoo/wateronmars) 
+#
+# WaterOnMars is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# WaterOnMars is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with WaterOnMars.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+"""
+Opt-in profiling of the requests (activated by the PROFILING_ENABLED
+setting).
+
+For each request, ProfilingMiddleware measures the total time, the
+number and time of the SQL queries, the time spent rendering
+templates and the time spent in the functions decorated with
+record_time (like the check of the user's unread feed items). The
+measures are sent back in a Server-Timing header and the total times
+are kept per view to compute rolling percentiles.
+
+A sample of the requests (PROFILING_SAMPLE_RATE), as well as the
+requests of staff users sent with a "X-Wom-Profile" header, are run
+under cProfile and their stats dumped in PROFILING_DUMP_DIR.
+"""
+
+import os
+import time
+import random
+import threading
+from collections import deque
+from functools import wraps
+
+from django.conf import settings
+from django.db import connection
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Request header that staff users can set to get their request profiled
+PROFILE_REQUEST_HEADER = "HTTP_X_WOM_PROFILE"
+
+# Percentiles reported for each view
+PERCENTILES = (50,90,99)
+
+
+_current = threading.local()
+
+
+def get_current_timings():
+  """Return the dictionary of the durations measured for the request
+  being processed by the current thread (None if no request is
+  profiled)."""
+  return getattr(_current,"timings",None)
+
+
+def add_time(name,duration):
+  timings = get_current_timings()
+  if timings is not None:
+    timings[name] = timings.get(name,0)+duration
+
+
+def record_time(name):
+  """Decorator adding the time spent in the decorated function to
+  the timings of the profiled request (if any) under the given name.
+  """
+  def decorator(func):
+    @wraps(func)
+    def wrapper(*args,**kwargs):
+      if get_current_timings() is None:
+        return func(*args,**kwargs)
+      start = time.time()
+      try:
+        return func(*args,**kwargs)
+      finally:
+        add_time(name,time.time()-start)
+    return wrapper
+  return decorator
+
+
+def instrument_template_rendering():
+  """Make the rendering of the templates add its duration to the
+  timings of the profiled request (once, counting only the outermost
+  template when templates include or extend others)."""
+  from django.template.base import Template
+  if getattr(Template._render,"is_instrumented",False):
+    return
+  original_render = Template._render
+  def timed_render(self,context):
+    if get_current_timings() is None or getattr(_current,"rendering",False):
+      return original_render(self,context)
+    _current.rendering = True
+    start = time.time()
+    try:
+      return original_render(self,context)
+    finally:
+      _current.rendering = False
+      add_time("template",time.time()-start)
+  timed_render.is_instrumented = True
+  Template._render = timed_render
+
+
+class RollingPercentiles(object):
+  """Keep the last window_size values measured for each key and
+  compute percentiles over them."""
+
+  def __init__(self,window_size):
+    self.window_size = window_size
+    self.values = {}
+    self.total_count = 0
+    self.lock = threading.Lock()
+
+  def add(self,key,value):
+    """Add a value for the given key and return the total number of
+    values added so far (for all keys)."""
+    with self.lock:
+      if key not in self.values:
+        self.values[key] = deque(maxlen=self.window_size)
+      self.values[key].append(value)
+      self.total_count += 1
+      return self.total_count
+
+  def get(self,key,percentiles=PERCENTILES):
+    """Return a dictionary with the number of values and the requested
+    percentiles of the values for the given key."""
+    with self.lock:
+      values = sorted(self.values.get(key,()))
+    stats = {"count": len(values)}
+    for p in percentiles:
+      stats["p%d" % p] = values[min(len(values)-1,len(values)*p//100)] \
+                         if values else None
+    return stats
+
+  def get_all(self,percentiles=PERCENTILES):
+    with self.lock:
+      keys = self.values.keys()
+    return dict((k,self.get(k,percentiles)) for k in keys)
+
+
+view_timings = RollingPercentiles(settings.PROFILING_WINDOW)
+
+
+def log_view_percentiles():
+  for view_name,stats in sorted(view_timings.get_all().items()):
+    logger.info("%s: %d requests, %s" \
+                % (view_name,stats["count"],
+                   ", ".join("p%d=%.1fms" % (p,stats["p%d" % p]*1000)
+                             for p in PERCENTILES)))
+
+
+def format_server_timing(timings,num_queries):
+  """Format the timings (in seconds) as the value of a Server-Timing
+  header (with durations in milliseconds)."""
+  metrics = []
+  for name,duration in sorted(timings.items()):
+    metric = "%s;dur=%.1f" % (name,duration*1000)
+    if name=="sql":
+      metric += ';desc="%d queries"' % num_queries
+    metrics.append(metric)
+  return ", ".join(metrics)
+
+
+def get_view_name(view_func):
+  return "%s.%s" % (view_func.__module__,
+                    getattr(view_func,"__name__",view_func.__class__.__name__))
+
+
+class ProfilingMiddleware(object):
+  """Measure where the time of each request goes (see this module's
+  documentation). Should come last in MIDDLEWARE_CLASSES, after the
+  authentication middleware."""
+
+  def __init__(self):
+    instrument_template_rendering()
+
+  def process_request(self,request):
+    _current.timings = {}
+    _current.start = time.time()
+    _current.view_name = None
+    _current.debug_cursor = connection.use_debug_cursor
+    connection.use_debug_cursor = True
+    _current.first_query = len(connection.queries)
+
+  def should_dump_profile(self,request):
+    if PROFILE_REQUEST_HEADER in request.META \
+       and getattr(request,"user",None) is not None \
+       and request.user.is_staff:
+      return True
+    return random.random()<settings.PROFILING_SAMPLE_RATE
+
+  def process_view(self,request,view_func,view_args,view_kwargs):
+    _current.view_name = get_view_name(view_func)
+    if not self.should_dump_profile(request):
+      return None
+    import cProfile
+    profiler = cProfile.Profile()
+    response = profiler.runcall(view_func,request,*view_args,**view_kwargs)
+    dump_path = os.path.join(settings.PROFILING_DUMP_DIR,
+                             "%s-%d.pstats" % (_current.view_name,
+                                               time.time()*1000))
+    try:
+      if not os.path.isdir(settings.PROFILING_DUMP_DIR):
+        os.makedirs(settings.PROFILING_DUMP_DIR)
+      profiler.dump_stats(dump_path)
+      logger.debug("Profile of %s dumped to %s" % (request.path,dump_path))
+    except (IOError,OSError),e:
+      logger.error("Could not dump the profile of %s (%s)" % (request.path,e))
+    return response
+
+  def process_response(self,request,response):
+    timings = get_current_timings()
+    if timings is None:
+      return response
+    _current.timings = None
+    connection.use_debug_cursor = _current.debug_cursor
+    queries = connection.queries[_current.first_query:]
+    timings["sql"] = sum(float(q["time"]) for q in queries)
+    timings["total"] = time.time()-_current.start
+    response["Server-Timing"] = format_server_timing(timings,len(queries))
+    if _current.view_name is not None:
+      count = view_timings.add(_current.view_name,timings["total"])
+      if count % view_timings.window_size == 0:
+        log_view_percentiles()
+    logger.debug("%s %s: %s" % (request.method,request.path,
+                                response["Server-Timing"]))
+    return response
@@ -21,6 +21,7 @@
 # Django settings for wateronmars project.
 
 import os
+import tempfile
 APP_BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
 
@@ -80,6 +81,14 @@ DEMO = True
 DEMO_USER_NAME = "demo"
 DEMO_USER_PASSWD = "redh2o"
 
+# Files used to make sure that the startup tasks (like the demo setup)
+# are run only once and by a single process at a time (see
+# wateronmars/startup.py and the wom_bootstrap command)
+BOOTSTRAP_MARKER_FILE = os.path.join(tempfile.gettempdir(),
+                                     "wateronmars-bootstrap.done")
+BOOTSTRAP_LOCK_FILE = os.path.join(tempfile.gettempdir(),
+                                   "wateronmars-bootstrap.lock")
+
 # DEBUG or not DEBUG
 DEBUG = False
 TEMPLATE_DEBUG = DEBUG
@@ -102,6 +111,9 @@ else:
         'PORT': '',                      # Set to empty string for default. Not used with sqlite3.
     }
   }
+  # Activate the WAL mode and other tunings of the SQLite connections
+  # (see wom_pebbles/settings.py)
+  WOM_PEBBLES_SQLITE_PROFILE = bool(os.environ.get("WOM_SQLITE_PROFILE"))
   
 # Allow all host headers
 ALLOWED_HOSTS = ['*']
@@ -188,6 +200,19 @@ MIDDLEWARE_CLASSES = (
     # 'django.middleware.clickjacking.XFrameOptionsMiddleware',
 )
 
+# Opt-in profiling of the requests (see wateronmars/profiling.py): the
+# total time of each view is kept over the last PROFILING_WINDOW
+# requests and a PROFILING_SAMPLE_RATE fraction of the requests are run
+# under cProfile, their stats being dumped in PROFILING_DUMP_DIR.
+PROFILING_ENABLED = bool(os.environ.get("WOM_PROFILING"))
+PROFILING_WINDOW = 1000
+PROFILING_SAMPLE_RATE = float(os.environ.get("WOM_PROFILING_SAMPLE_RATE",0))
+PROFILING_DUMP_DIR = os.environ.get("WOM_PROFILING_DUMP_DIR",
+                                    os.path.join(tempfile.gettempdir(),
+                                                 "wateronmars-profiles"))
+if PROFILING_ENABLED:
+  MIDDLEWARE_CLASSES += ('wateronmars.profiling.ProfilingMiddleware',)
+
 ROOT_URLCONF = 'wateronmars.urls'
 
 # Python dotted path to the WSGI application used by Django's runserver.
@@ -276,5 +301,10 @@ LOGGING = {
             'level': 'ERROR',
             'propagate': True,
         },
+        'wateronmars.profiling': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': True,
+        },
     }
 }
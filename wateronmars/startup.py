@@ -18,6 +18,14 @@
 # along with WaterOnMars.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import os
+
+try:
+  import fcntl
+except ImportError:
+  # no inter-process locking on this platform
+  fcntl = None
+
 from django.conf import settings
 
 from django.contrib.auth.models import User
@@ -71,7 +79,8 @@ NS_BOOKMARKS_TXT_MORE_TEMPLATE = """\
 """
 
 
-def run():
+def bootstrap():
+  """Run the startup tasks that have not been run yet on the db."""
   if settings.DEMO and not User.objects.filter(username=settings.DEMO_USER_NAME).exists():
     print("DEMO mode: Creating demo user.")
     demo_user = User(username=settings.DEMO_USER_NAME)
@@ -87,3 +96,47 @@ def run():
     import_user_feedsources_from_opml(demo_user,OPML_TXT)
     print("DEMO mode: demo user setup finished.")
 
+
+
+def get_bootstrap_signature():
+  """Identify the setup that the startup tasks have been run for."""
+  return "%s:%s:%s" % (settings.DATABASES["default"].get("NAME"),
+                       settings.DEMO,settings.DEMO_USER_NAME)
+
+
+def is_bootstrapped():
+  try:
+    with open(settings.BOOTSTRAP_MARKER_FILE) as marker:
+      return marker.read()==get_bootstrap_signature()
+  except IOError:
+    return False
+
+  
+def run(force=False):
+  """Make sure the startup tasks have been run.
+
+  Once done, a marker file is written so that the next calls (typically
+  by each web worker) just have to check this file. The tasks are run
+  while holding a lock so that concurrent processes don't run them at
+  the same time.
+
+  If force is True, the startup tasks are checked against the db even
+  if the marker file says they have already been run.
+  """
+  if not settings.DEMO:
+    return
+  if not force and is_bootstrapped():
+    return
+  with open(settings.BOOTSTRAP_LOCK_FILE,"a") as lock:
+    if fcntl is not None:
+      fcntl.flock(lock,fcntl.LOCK_EX)
+    try:
+      if force or not is_bootstrapped():
+        bootstrap()
+        marker_tmp_path = settings.BOOTSTRAP_MARKER_FILE+".tmp"
+        with open(marker_tmp_path,"w") as marker:
+          marker.write(get_bootstrap_signature())
+        os.rename(marker_tmp_path,settings.BOOTSTRAP_MARKER_FILE)
+    finally:
+      if fcntl is not None:
+        fcntl.flock(lock,fcntl.LOCK_UN)
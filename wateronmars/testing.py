@@ -0,0 +1,117 @@
+# -*- coding: utf-8; indent-tabs-mode: nil; python-indent: 2 -*-
+#
+# Copyright 2013 Thibauld Nion
+#
+# This file is part of WaterOnMars (https://github.com/tibonihoo/wateronmars) 
+#
+# WaterOnMars is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# WaterOnMars is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with WaterOnMars.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+"""
+Helpers for the tests that keep an eye on the number of SQL queries
+run by the views and tasks.
+"""
+
+import re
+from collections import defaultdict
+
+from django.db import connection
+from django.db import reset_queries
+from django.core.signals import request_started
+
+
+# Literal values removed from the queries before comparing them
+SQL_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+# List of values (as in "IN (...)" clauses) removed as well
+SQL_VALUE_LISTS = re.compile(r"\((?:\s*\?\s*,)+\s*\?\s*\)")
+
+
+class QueryRecorder(object):
+  """Context manager recording the SQL queries run on a connection
+  (including during requests sent by the test client) in its
+  'queries' attribute."""
+
+  def __init__(self,conn=connection):
+    self.connection = conn
+    self.queries = []
+
+  def __enter__(self):
+    self.old_debug_cursor = self.connection.use_debug_cursor
+    self.connection.use_debug_cursor = True
+    self.starting_queries = len(self.connection.queries)
+    request_started.disconnect(reset_queries)
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.connection.use_debug_cursor = self.old_debug_cursor
+    request_started.connect(reset_queries)
+    self.queries = [q["sql"] for q in
+                    self.connection.queries[self.starting_queries:]]
+
+  def __len__(self):
+    return len(self.queries)
+
+
+def normalize_sql(sql):
+  """Remove the literal values from a query so that the queries run
+  by a same loop look the same."""
+  return SQL_VALUE_LISTS.sub("(?)",SQL_LITERALS.sub("?",sql))
+
+
+def get_duplicated_queries(queries):
+  """Return the (count,normalized query) pairs of the queries that
+  were run several times, the most repeated first."""
+  counts = defaultdict(int)
+  for sql in queries:
+    counts[normalize_sql(sql)] += 1
+  return sorted(((c,q) for q,c in counts.items() if c>1),reverse=True)
+
+
+def format_duplicated_queries(queries):
+  duplicates = get_duplicated_queries(queries)
+  if not duplicates:
+    return "No duplicated query."
+  return "Duplicated queries:\n" + "\n".join("%5dx %s" % (c,q)
+                                             for c,q in duplicates)
+
+
+class QueryBudgetTestMixin:
+  """Mixin for TestCase classes checking that the number of queries
+  needed by an operation stays within a budget and doesn't grow with
+  the size of the data it processes."""
+
+  def assertQueryBudget(self,budget,sizes,prepare,func):
+    """For each size, call prepare(size) to get the arguments of func,
+    then call func with them and check that it runs at most budget
+    queries and no more queries than for the previous (smaller) size.
+
+    On failure the queries that were repeated are listed.
+    """
+    previous = None
+    for size in sizes:
+      args = prepare(size)
+      with QueryRecorder() as recorder:
+        func(*args)
+      if len(recorder)>budget:
+        self.fail("%d queries run for size %d (budget is %d).\n%s"
+                  % (len(recorder),size,budget,
+                     format_duplicated_queries(recorder.queries)))
+      if previous is not None and len(recorder)>len(previous[1]):
+        self.fail("The number of queries grows with the size: "
+                  "%d queries for size %d and %d for size %d.\n%s"
+                  % (len(previous[1]),previous[0],len(recorder),size,
+                     format_duplicated_queries(recorder.queries)))
+      previous = (size,recorder)
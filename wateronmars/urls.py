@@ -37,6 +37,7 @@ urlpatterns = patterns('',
                        url(r'^u/(?P<owner_name>[^/]*)/sources/opml/$', 'wom_user.views.user_upload_opml'),
                        url(r'^u/(?P<owner_name>[^/]*)/collection/$', 'wom_user.views.user_collection'),
                        url(r'^u/(?P<owner_name>[^/]*)/collection/nsbmk/$', 'wom_user.views.user_upload_nsbmk'),
+                       url(r'^u/(?P<owner_name>[^/]*)/jobs/(?P<job_id>\d+)/$', 'wom_user.views.user_job_status'),
                        url(r'^u/(?P<owner_name>[^/]*)/sources/$', 'wom_user.views.user_river_sources'),
                        url(r'^u/(?P<owner_name>[^/]*)/sources/add/$', 'wom_user.views.user_river_source_add'),
                        url(r'^u/(?P<owner_name>[^/]*)/sources/item/(?P<source_url>.*)$', 'wom_user.views.user_river_source_item'),
@@ -52,8 +53,8 @@ urlpatterns = patterns('',
 
 if not settings.USE_CELERY:
   urlpatterns += patterns('',
-                       # temporary hack to avoid depending too much on
-                       # background tasks
+                       # queue the update and cleanup jobs for the
+                       # wom_worker command
                        url(r'^houston/we_ve_got_an_update_request/$',
                            'wom_user.views.request_for_update'),
                        url(r'^houston/we_ve_got_a_cleanup_request/$',
@@ -23,6 +23,8 @@ from django.contrib import admin
 
 from wom_classification.models import Tag
 from wom_classification.models import ClassificationData
+from wom_classification.models import TagUsage
 
 admin.site.register(Tag)
 admin.site.register(ClassificationData)
+admin.site.register(TagUsage)
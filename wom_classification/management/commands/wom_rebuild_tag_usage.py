@@ -0,0 +1,45 @@
+# -*- coding: utf-8; indent-tabs-mode: nil; python-indent: 2 -*-
+#
+# Copyright 2013 Thibauld Nion
+#
+# This file is part of WaterOnMars (https://github.com/tibonihoo/wateronmars) 
+#
+# WaterOnMars is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# WaterOnMars is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with WaterOnMars.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from django.contrib.auth.models import User
+
+from wom_classification.models import rebuild_tag_usage
+
+
+class Command(BaseCommand):
+  args = "[<username> ...]"
+  help = "Recompute the materialized tag usage counts from the classification data of the given users (or of all users if none is given)."
+
+  def handle(self, *args, **options):
+    if not args:
+      num_usages = rebuild_tag_usage()
+    else:
+      num_usages = 0
+      for username in args:
+        try:
+          user = User.objects.get(username=username)
+        except User.DoesNotExist:
+          raise CommandError("User '%s' does not exist." % username)
+        num_usages += rebuild_tag_usage(user)
+    self.stdout.write("Rebuilt %d tag usage counts.\n" % num_usages)
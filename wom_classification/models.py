@@ -20,6 +20,9 @@
 
 from django.db import models
 from django.db import transaction
+from django.db.models import F
+from django.db.models import Sum
+from django.db.models import Count
 
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes import generic
@@ -66,6 +69,33 @@ class ClassificationData(models.Model):
                            self.content_object,
                            list(t for t in self.tags.all()))
 
+
+class TagUsage(models.Model):
+  """Materialize the number of items of a given type to which a user
+  attributed a given tag.
+
+  WARNING: these counts are maintained by the tagging helpers of this
+  module, any other modification of the ClassificationData's tags
+  requires a call to rebuild_tag_usage.
+  """
+
+  owner = models.ForeignKey(User)
+  
+  tag = models.ForeignKey(Tag)
+  
+  # The type of the tagged items
+  content_type = models.ForeignKey(ContentType)
+  
+  # Number of items of this type that the user tagged with this tag
+  count = models.PositiveIntegerField(default=0)
+  
+  class Meta:
+    unique_together = (("owner","tag","content_type"),)
+
+  def __unicode__(self):
+    return u"%s>%s[%s]: %d" % (self.owner.username,self.tag.name,
+                               self.content_type,self.count)
+
   
 def get_item_tags(user,item):
   """Return a QuerySet referencing all Tags attributed by the user to the item."""
@@ -88,6 +118,23 @@ def get_item_tag_names(user,item):
   return [t.name for t in get_item_tags(user,item).all()]
 
 
+def get_items_tag_names(user,model,item_ids):
+  """Return a dictionary mapping the ids of the given items (of the
+  given model) to the names of the tags attributed to them by the user
+  (with a single query).
+  """
+  item_type = ContentType.objects.get_for_model(model)
+  tag_names = {}
+  for item_id,name in ClassificationData.tags.through.objects\
+      .filter(classificationdata__owner=user,
+              classificationdata__content_type=item_type,
+              classificationdata__object_id__in=item_ids)\
+      .order_by("tag__name")\
+      .values_list("classificationdata__object_id","tag__name"):
+    tag_names.setdefault(item_id,[]).append(name)
+  return tag_names
+
+
 def get_all_users_tags_for_item(item):
   """Return a QuerySet for Tags attributed by any user to the item.""" 
   item_type = ContentType.objects.get_for_model(item)
@@ -108,11 +155,15 @@ def set_item_tags(user,item,tags):
   if numRes==0:
     cd = ClassificationData(owner=user,content_object=item)
     cd.save()
+    previous_tag_ids = set()
   else:
     if numRes>1:
       print "WARNING: unexpectedly found more than one CD for %s's%s" % (user,item)
     cd = qs[0]
+    previous_tag_ids = set(cd.tags.values_list("id",flat=True))
   cd.tags.add(*tags)
+  increment_tag_usage(user,item_type,
+                      set(t.id for t in tags)-previous_tag_ids)
   return cd
   
 def set_item_tag_names(user,item,names):
@@ -133,11 +184,140 @@ def set_item_tag_names(user,item,names):
     for t in new_tags:
       t.save()
   return set_item_tags(user,item,tag_list+new_tags)
-  
+
+
+def get_or_create_tags_by_name(names):
+  """Return a dictionary mapping the names to the corresponding Tag
+  instances, creating the missing ones (with a constant number of
+  queries)."""
+  names = set(names)
+  if not names:
+    return {}
+  tags_by_name = dict((t.name,t) for t in Tag.objects.filter(name__in=names))
+  missing_names = names-set(tags_by_name.keys())
+  if missing_names:
+    Tag.objects.bulk_create([Tag(name=n) for n in missing_names])
+    # bulk_create doesn't set the primary keys so fetch them back
+    tags_by_name.update((t.name,t) for t in
+                        Tag.objects.filter(name__in=missing_names))
+  return tags_by_name
+
+
+def set_items_tag_names(user,model,tag_names_by_item_id):
+  """Add the tags corresponding to the given names to several items of
+  a same model on behalf of a specific user, like set_item_tag_names
+  but with a number of queries that doesn't depend on the number of
+  items.
+
+  tag_names_by_item_id: a dictionary mapping the ids of the items to
+  the names of the tags to add to them.
+  """
+  if not tag_names_by_item_id:
+    return
+  item_type = ContentType.objects.get_for_model(model)
+  item_ids = tag_names_by_item_id.keys()
+  with transaction.commit_on_success():
+    tags_by_name = get_or_create_tags_by_name(
+      name for names in tag_names_by_item_id.values() for name in names)
+    cd_qs = ClassificationData.objects.filter(owner=user,
+                                              content_type=item_type,
+                                              object_id__in=item_ids)
+    # when an item unexpectedly has several CD, the first one is used
+    cd_ids_by_item_id = dict(cd_qs.order_by("-id")\
+                             .values_list("object_id","id"))
+    new_item_ids = [i for i in item_ids if i not in cd_ids_by_item_id]
+    if new_item_ids:
+      ClassificationData.objects.bulk_create(
+        [ClassificationData(owner=user,content_type=item_type,object_id=i)
+         for i in new_item_ids])
+      cd_ids_by_item_id.update(cd_qs.filter(object_id__in=new_item_ids)\
+                               .values_list("object_id","id"))
+    CDTags = ClassificationData.tags.through
+    existing_links = set(CDTags.objects\
+                         .filter(classificationdata__in=cd_ids_by_item_id.values())\
+                         .values_list("classificationdata_id","tag_id"))
+    new_links = set()
+    for item_id,names in tag_names_by_item_id.items():
+      cd_id = cd_ids_by_item_id[item_id]
+      new_links.update((cd_id,tags_by_name[n].id) for n in names
+                       if (cd_id,tags_by_name[n].id) not in existing_links)
+    if not new_links:
+      return
+    CDTags.objects.bulk_create([CDTags(classificationdata_id=cd_id,
+                                       tag_id=tag_id)
+                                for cd_id,tag_id in new_links])
+    # recount the usage of the tags that were just attributed
+    tag_ids = set(tag_id for _,tag_id in new_links)
+    counts = CDTags.objects.filter(classificationdata__owner=user,
+                                   classificationdata__content_type=item_type,
+                                   tag__in=tag_ids)\
+                           .values("tag").annotate(total=Count("id"))\
+                           .order_by()
+    TagUsage.objects.filter(owner=user,content_type=item_type,
+                            tag__in=tag_ids).delete()
+    TagUsage.objects.bulk_create([TagUsage(owner=user,tag_id=c["tag"],
+                                           content_type=item_type,
+                                           count=c["total"])
+                                  for c in counts])
+
 def get_user_tags(user):
   """Return a QuerySet referencing all tags set by a given user."""
   return Tag.objects.filter(classificationdata__owner=user).distinct()
 
+def get_user_tag_counts(user,model=None):
+  """Return a list of (tag name, count) tuples sorted by name and
+  giving, for each tag set by the user, the number of items it has
+  been attributed to (restricted to the items of a given model if
+  one is specified).
+  """
+  qs = TagUsage.objects.filter(owner=user,count__gt=0)
+  if model is not None:
+    qs = qs.filter(content_type=ContentType.objects.get_for_model(model))
+  return [(u["tag__name"],u["total"]) for u in qs.values("tag__name")\
+                                                .annotate(total=Sum("count"))\
+                                                .order_by("tag__name")]
+
+def increment_tag_usage(user,item_type,tag_ids):
+  """Increment the usage count of the tags identified by tag_ids for
+  items of the given content type, on behalf of a specific user.
+  """
+  if not tag_ids:
+    return
+  with transaction.commit_on_success():
+    usage_qs = TagUsage.objects.filter(owner=user,content_type=item_type,
+                                       tag__in=tag_ids)
+    used_tag_ids = set(usage_qs.values_list("tag_id",flat=True))
+    if used_tag_ids:
+      usage_qs.update(count=F("count")+1)
+    TagUsage.objects.bulk_create(
+      [TagUsage(owner=user,tag_id=tag_id,content_type=item_type,count=1)
+       for tag_id in set(tag_ids)-used_tag_ids])
+
+def rebuild_tag_usage(user=None):
+  """Recompute the tag usage counts from the ClassificationData for a
+  given user or for all users if user is None.
+
+  Return the number of TagUsage instances created.
+  """
+  usage_qs = TagUsage.objects.all()
+  cd_tags_qs = ClassificationData.tags.through.objects.all()
+  if user is not None:
+    usage_qs = usage_qs.filter(owner=user)
+    cd_tags_qs = cd_tags_qs.filter(classificationdata__owner=user)
+  counts = cd_tags_qs.values("classificationdata__owner",
+                             "classificationdata__content_type",
+                             "tag")\
+                     .annotate(total=Count("id"))\
+                     .order_by()
+  new_usages = [TagUsage(owner_id=c["classificationdata__owner"],
+                         content_type_id=c["classificationdata__content_type"],
+                         tag_id=c["tag"],
+                         count=c["total"]) for c in counts]
+  with transaction.commit_on_success():
+    usage_qs.delete()
+    TagUsage.objects.bulk_create(new_usages)
+  return len(new_usages)
+
 def select_model_items_with_tags(user,model,tags):
   """Return a QuerySet referencing all items of the specified models
   that has been attributed a given set of tags by the user."""
@@ -19,6 +19,7 @@
 #
 
 from django.test import TestCase
+from django.core.management import call_command
 from django.db import IntegrityError
 
 from django.contrib.auth.models import User
@@ -31,8 +32,12 @@ from wom_classification.models import get_item_tag_names
 from wom_classification.models import get_all_users_tags_for_item 
 from wom_classification.models import set_item_tags
 from wom_classification.models import set_item_tag_names
+from wom_classification.models import set_items_tag_names
 from wom_classification.models import get_user_tags
 from wom_classification.models import select_model_items_with_tags
+from wom_classification.models import TagUsage
+from wom_classification.models import get_user_tag_counts
+from wom_classification.models import rebuild_tag_usage
 
 
 if TAG_NAME_MAX_LENGTH>255:
@@ -181,3 +186,73 @@ class ClassificationDataManipulationTest(TestCase):
                           [self.tag_mouf,self.tag_blah])
     self.assertEqual(0,itemQuerySet.count())
 
+
+class TagUsageTest(TestCase):
+  """Test the maintenance of the materialized tag usage counts."""
+
+  def setUp(self):
+    self.user_a = User.objects.create(username="UserA")
+    self.user_b = User.objects.create(username="UserB")
+    self.item_1 = User.objects.create(username="Item1")
+    self.item_2 = User.objects.create(username="Item2")
+    self.item_3 = Tag.objects.create(name="Item3")
+    set_item_tag_names(self.user_a,self.item_1,["mouf","glop"])
+    set_item_tag_names(self.user_a,self.item_2,["mouf"])
+    set_item_tag_names(self.user_a,self.item_3,["mouf","hop"])
+    set_item_tag_names(self.user_b,self.item_1,["blah"])
+
+  def test_counts_per_content_type(self):
+    self.assertEqual([("glop",1),("mouf",2)],
+                     get_user_tag_counts(self.user_a,User))
+    self.assertEqual([("hop",1),("mouf",1)],
+                     get_user_tag_counts(self.user_a,Tag))
+    
+  def test_counts_for_all_content_types(self):
+    self.assertEqual([("glop",1),("hop",1),("mouf",3)],
+                     get_user_tag_counts(self.user_a))
+    self.assertEqual([("blah",1)],get_user_tag_counts(self.user_b))
+
+  def test_setting_same_tags_again_does_not_change_counts(self):
+    set_item_tag_names(self.user_a,self.item_1,["mouf","glop"])
+    self.assertEqual([("glop",1),("mouf",2)],
+                     get_user_tag_counts(self.user_a,User))
+
+  def test_adding_a_tag_to_a_tagged_item(self):
+    set_item_tag_names(self.user_a,self.item_2,["mouf","glop"])
+    self.assertEqual([("glop",2),("mouf",2)],
+                     get_user_tag_counts(self.user_a,User))
+    
+  def test_setting_tags_of_several_items(self):
+    item_4 = User.objects.create(username="Item4")
+    with self.assertNumQueries(12):
+      set_items_tag_names(self.user_a,User,{self.item_2.id: ["mouf","glop"],
+                                            item_4.id: ["new","mouf"]})
+    self.assertEqual(["glop","mouf"],
+                     sorted(get_item_tag_names(self.user_a,self.item_2)))
+    self.assertEqual(["mouf","new"],
+                     sorted(get_item_tag_names(self.user_a,item_4)))
+    self.assertEqual([("glop",2),("mouf",3),("new",1)],
+                     get_user_tag_counts(self.user_a,User))
+    self.assertEqual([("hop",1),("mouf",1)],
+                     get_user_tag_counts(self.user_a,Tag))
+    
+  def test_rebuild_tag_usage(self):
+    # Tags set without the helpers are not counted until a rebuild
+    cd = ClassificationData.objects.create(owner=self.user_b,
+                                           content_object=self.item_2)
+    cd.tags.add(Tag.objects.get(name="mouf"))
+    TagUsage.objects.filter(owner=self.user_a).update(count=42)
+    self.assertEqual([("blah",1)],get_user_tag_counts(self.user_b))
+    rebuild_tag_usage(self.user_b)
+    self.assertEqual([("blah",1),("mouf",1)],
+                     get_user_tag_counts(self.user_b))
+    rebuild_tag_usage()
+    self.assertEqual([("glop",1),("hop",1),("mouf",3)],
+                     get_user_tag_counts(self.user_a))
+    
+  def test_rebuild_command(self):
+    TagUsage.objects.all().delete()
+    call_command("wom_rebuild_tag_usage","UserA")
+    self.assertEqual([("glop",1),("hop",1),("mouf",3)],
+                     get_user_tag_counts(self.user_a))
+    self.assertEqual([],get_user_tag_counts(self.user_b))
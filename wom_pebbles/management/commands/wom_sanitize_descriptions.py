@@ -0,0 +1,38 @@
+# -*- coding: utf-8; indent-tabs-mode: nil; python-indent: 2 -*-
+#
+# Copyright 2013 Thibauld Nion
+#
+# This file is part of WaterOnMars (https://github.com/tibonihoo/wateronmars) 
+#
+# WaterOnMars is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# WaterOnMars is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with WaterOnMars.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from wom_pebbles.tasks import fill_sanitized_descriptions
+
+
+class Command(BaseCommand):
+  help = "Store the sanitized version of the references' descriptions that haven't been sanitized yet (typically the ones saved before sanitization happened at ingest)."
+  option_list = BaseCommand.option_list + (
+    make_option("--force",action="store_true",dest="force",default=False,
+                help="Sanitize again the descriptions of all references."),
+    )
+
+  def handle(self, *args, **options):
+    num_refs = fill_sanitized_descriptions(options["force"])
+    self.stdout.write("Sanitized %d reference descriptions.\n" % num_refs)
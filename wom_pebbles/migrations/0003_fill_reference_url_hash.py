@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import DataMigration
+from django.db import models
+
+class Migration(DataMigration):
+
+    def forwards(self, orm):
+        "Compute the hash of the existing references' urls."
+        from wom_pebbles.models import compute_url_hash
+        for ref_id,url in list(orm['wom_pebbles.Reference'].objects\
+                               .values_list("id","url")):
+            orm['wom_pebbles.Reference'].objects.filter(id=ref_id)\
+                .update(url_hash=compute_url_hash(url))
+
+    def backwards(self, orm):
+        "Nothing to do: the column is dropped by the previous migration."
+
+    models = {
+        'wom_pebbles.reference': {
+            'Meta': {'object_name': 'Reference'},
+            'description': ('django.db.models.fields.TextField', [], {'default': "''"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'pub_date': ('django.db.models.fields.DateTimeField', [], {}),
+            'save_count': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'sources': ('django.db.models.fields.related.ManyToManyField', [], {'related_name': "'productions'", 'symmetrical': 'False', 'to': "orm['wom_pebbles.Reference']"}),
+            'title': ('django.db.models.fields.CharField', [], {'max_length': '150'}),
+            'url': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '255'}),
+            'url_hash': ('wom_pebbles.models.URLHashField', [], {'default': '0', 'db_index': 'True'})
+        }
+    }
+
+    complete_apps = ['wom_pebbles']
+    symmetrical = True
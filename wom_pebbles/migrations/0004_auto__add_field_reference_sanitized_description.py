@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding field 'Reference.sanitized_description'
+        db.add_column('wom_pebbles_reference', 'sanitized_description',
+                      self.gf('django.db.models.fields.TextField')(default=None, null=True),
+                      keep_default=False)
+
+
+    def backwards(self, orm):
+        # Deleting field 'Reference.sanitized_description'
+        db.delete_column('wom_pebbles_reference', 'sanitized_description')
+
+
+    models = {
+        'wom_pebbles.reference': {
+            'Meta': {'object_name': 'Reference'},
+            'description': ('django.db.models.fields.TextField', [], {'default': "''"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'pub_date': ('django.db.models.fields.DateTimeField', [], {}),
+            'sanitized_description': ('django.db.models.fields.TextField', [], {'default': 'None', 'null': 'True'}),
+            'save_count': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'sources': ('django.db.models.fields.related.ManyToManyField', [], {'related_name': "'productions'", 'symmetrical': 'False', 'to': "orm['wom_pebbles.Reference']"}),
+            'title': ('django.db.models.fields.CharField', [], {'max_length': '150'}),
+            'url': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '255'}),
+            'url_hash': ('wom_pebbles.models.URLHashField', [], {'default': '0', 'db_index': 'True'})
+        }
+    }
+
+    complete_apps = ['wom_pebbles']
\ No newline at end of file
@@ -20,6 +20,15 @@
 
 
 from django.db import models
+from django.db.backends.signals import connection_created
+
+import hashlib
+from urlparse import urlsplit
+from urlparse import urlunsplit
+
+
+from wom_pebbles.settings import SQLITE_PROFILE
+from wom_pebbles.settings import SQLITE_PRAGMAS
 
 
 # Max number of characters in a URL.
@@ -34,7 +43,46 @@ URL_MAX_LENGTH = 255
 REFERENCE_TITLE_MAX_LENGTH = 150
 
 
-  
+def normalize_url(url):
+  """Return a canonical version of url, used to spot near-duplicates:
+  lower case scheme and host, no "campain" tracker (utm_) parameter
+  in the query string and no trailing slash.
+  """
+  scheme,netloc,path,query,fragment = urlsplit(url)
+  if query:
+    query = "&".join(p for p in query.split("&")
+                     if p and not p.startswith("utm_"))
+  return urlunsplit((scheme.lower(),netloc.lower(),path.rstrip("/"),
+                     query,fragment))
+
+
+def compute_url_hash(url):
+  """Return a 64 bits signed integer hash of the normalized url."""
+  normalized_url = normalize_url(url)
+  if isinstance(normalized_url,unicode):
+    normalized_url = normalized_url.encode("utf-8")
+  url_hash = int(hashlib.md5(normalized_url).hexdigest()[:16],16)
+  if url_hash >= 2**63:
+    url_hash -= 2**64
+  return url_hash
+
+
+class URLHashField(models.BigIntegerField):
+  """Store the hash of the model's url field (computed each time the
+  instance is saved, including by bulk_create)."""
+
+  def pre_save(self, model_instance, add):
+    url_hash = compute_url_hash(model_instance.url)
+    setattr(model_instance,self.attname,url_hash)
+    return url_hash
+
+try:
+  from south.modelsinspector import add_introspection_rules
+  add_introspection_rules([], ["^wom_pebbles\.models\.URLHashField"])
+except ImportError:
+  pass
+
+
 class Reference(models.Model): # A pebble !
   """
   The most basic item representing a piece of information on the
@@ -44,6 +92,9 @@ class Reference(models.Model): # A pebble !
   # but several references may share the same URL especially if they
   # have been published by different sources.
   url = models.CharField(max_length=URL_MAX_LENGTH,unique=True)
+  # Hash of the normalized url, making it faster to find a reference
+  # from its url and to find near-duplicates too.
+  url_hash = URLHashField(default=0,db_index=True)
   # Title of the reference (compulsory)
   title = models.CharField(max_length=REFERENCE_TITLE_MAX_LENGTH)
   # A short summary about the reference's content.
@@ -51,6 +102,9 @@ class Reference(models.Model): # A pebble !
   # reference, visible to everybody. User-specific description should
   # better be stored in another "model".
   description = models.TextField(default="")
+  # The description stripped from its scripts and layout-breaking tags,
+  # ready to be displayed (None if not computed yet).
+  sanitized_description = models.TextField(null=True,default=None)
   # Tells when the reference was first published, as a timezone-aware
   # datetime object.
   pub_date = models.DateTimeField('date published')
@@ -64,3 +118,48 @@ class Reference(models.Model): # A pebble !
     return "%s[%s]" % (self.title,self.url)
 
 
+def get_references_by_normalized_url(urls):
+  """Return a dictionary mapping normalized urls to the existing
+  references whose url normalizes the same way as one of urls (with
+  only one query).
+
+  When several references share the same normalized url, the oldest
+  one is selected.
+  """
+  references_by_normalized_url = {}
+  url_hashes = set(compute_url_hash(u) for u in urls)
+  if not url_hashes:
+    return references_by_normalized_url
+  for ref in Reference.objects.filter(url_hash__in=url_hashes)\
+                              .order_by("-id"):
+    references_by_normalized_url[normalize_url(ref.url)] = ref
+  return references_by_normalized_url
+
+
+def get_reference_by_url(url):
+  """Return the reference with the given url or a near-duplicate of
+  it, raise Reference.DoesNotExist if none exists.
+  """
+  normalized_url = normalize_url(url)
+  candidates = list(Reference.objects.filter(url_hash=compute_url_hash(url))\
+                    .order_by("id"))
+  for ref in candidates:
+    if ref.url == url:
+      return ref
+  for ref in candidates:
+    if normalize_url(ref.url) == normalized_url:
+      return ref
+  raise Reference.DoesNotExist("No reference found for url: %s" % url)
+
+
+def apply_sqlite_profile(sender,connection,**kwargs):
+  """Set the SQLITE_PRAGMAS on the new SQLite connections (if the
+  SQLITE_PROFILE is activated)."""
+  if not SQLITE_PROFILE or connection.vendor!="sqlite":
+    return
+  cursor = connection.connection.cursor()
+  for name,value in SQLITE_PRAGMAS:
+    cursor.execute("PRAGMA %s=%s" % (name,value))
+  cursor.close()
+
+connection_created.connect(apply_sqlite_profile)
@@ -0,0 +1,100 @@
+# -*- coding: utf-8; indent-tabs-mode: nil; python-indent: 2 -*-
+#
+# Copyright 2013 Thibauld Nion
+#
+# This file is part of WaterOnMars (https://github.com/tibonihoo/wateronmars) 
+#
+# WaterOnMars is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# WaterOnMars is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with WaterOnMars.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Gather all parameters specific to this application: the default
+values and the way to read them from the global django site settings.
+"""
+
+from django.conf import settings
+
+
+if hasattr(settings,"WOM_PEBBLES_IMPORT_CHUNK_SIZE"):
+  IMPORT_CHUNK_SIZE = settings.WOM_PEBBLES_IMPORT_CHUNK_SIZE
+else:
+  # keep it low enough for the url lookups to stay under SQLite's
+  # limit on the number of query parameters (999).
+  IMPORT_CHUNK_SIZE = 500
+
+if hasattr(settings,"WOM_PEBBLES_EXPANDED_URL_CACHE"):
+  # Path to a JSON file mapping short urls to their expanded version
+  # (as built by wom_river/utils/netscape_bookmarks.py EXPAND) used to
+  # resolve the short urls of imported bookmarks.
+  EXPANDED_URL_CACHE = settings.WOM_PEBBLES_EXPANDED_URL_CACHE
+else:
+  EXPANDED_URL_CACHE = None
+
+if hasattr(settings,"WOM_PEBBLES_DELETE_CHUNK_SIZE"):
+  DELETE_CHUNK_SIZE = settings.WOM_PEBBLES_DELETE_CHUNK_SIZE
+else:
+  DELETE_CHUNK_SIZE = 500
+
+if hasattr(settings,"WOM_PEBBLES_DELETE_PAUSE"):
+  # Pause (in seconds) between the deletion of two chunks of
+  # references, giving other writers a chance to get the db lock.
+  DELETE_PAUSE = settings.WOM_PEBBLES_DELETE_PAUSE
+else:
+  DELETE_PAUSE = 0.05
+
+if hasattr(settings,"WOM_PEBBLES_SANITIZE_CHUNK_SIZE"):
+  SANITIZE_CHUNK_SIZE = settings.WOM_PEBBLES_SANITIZE_CHUNK_SIZE
+else:
+  SANITIZE_CHUNK_SIZE = 500
+
+if hasattr(settings,"WOM_PEBBLES_SANITIZER_CACHE_SIZE"):
+  # Max number of sanitized html snippets kept in memory by each
+  # process for the defang_html filter.
+  SANITIZER_CACHE_SIZE = settings.WOM_PEBBLES_SANITIZER_CACHE_SIZE
+else:
+  SANITIZER_CACHE_SIZE = 1000
+
+if hasattr(settings,"WOM_PEBBLES_SANITIZER_CACHE_USE_DJANGO_CACHE"):
+  # Also store the sanitized html snippets in Django's cache backend.
+  SANITIZER_CACHE_USE_DJANGO_CACHE = settings.WOM_PEBBLES_SANITIZER_CACHE_USE_DJANGO_CACHE
+else:
+  SANITIZER_CACHE_USE_DJANGO_CACHE = False
+
+if hasattr(settings,"WOM_PEBBLES_SANITIZER_CACHE_TIMEOUT"):
+  SANITIZER_CACHE_TIMEOUT = settings.WOM_PEBBLES_SANITIZER_CACHE_TIMEOUT
+else:
+  SANITIZER_CACHE_TIMEOUT = 7*24*3600
+
+if hasattr(settings,"WOM_PEBBLES_SQLITE_PROFILE"):
+  # Tune each new SQLite connection with the SQLITE_PRAGMAS, for
+  # single node deployments where the web workers and the feed
+  # collection share the same db file.
+  SQLITE_PROFILE = settings.WOM_PEBBLES_SQLITE_PROFILE
+else:
+  SQLITE_PROFILE = False
+
+if hasattr(settings,"WOM_PEBBLES_SQLITE_PRAGMAS"):
+  SQLITE_PRAGMAS = settings.WOM_PEBBLES_SQLITE_PRAGMAS
+else:
+  SQLITE_PRAGMAS = (
+    # readers don't block the writer (and vice versa)
+    ("journal_mode","WAL"),
+    # with WAL, only a checkpoint needs a fsync
+    ("synchronous","NORMAL"),
+    # page cache size in KiB (when negative)
+    ("cache_size",-32000),
+    ("mmap_size",256*1024*1024),
+    # wait for the lock (in ms) instead of failing right away
+    ("busy_timeout",20000),
+    )
@@ -21,19 +21,31 @@
 from django.utils.encoding import iri_to_uri
 
 from wom_river.utils.netscape_bookmarks import parse_netscape_bookmarks
+from wom_river.utils.netscape_bookmarks import ExpandedURLCache
 
 from wom_pebbles.models import REFERENCE_TITLE_MAX_LENGTH
 from wom_pebbles.models import URL_MAX_LENGTH
 from wom_pebbles.models import Reference
+from wom_pebbles.models import normalize_url
+from wom_pebbles.models import get_references_by_normalized_url
+from wom_pebbles.templatetags.html_sanitizers import sanitize_html
 
+from wom_pebbles.settings import IMPORT_CHUNK_SIZE
+from wom_pebbles.settings import EXPANDED_URL_CACHE
+from wom_pebbles.settings import DELETE_CHUNK_SIZE
+from wom_pebbles.settings import DELETE_PAUSE
+from wom_pebbles.settings import SANITIZE_CHUNK_SIZE
 
 from django.utils import timezone
 from django.db import transaction
+from django.db import connection
 from django.core.exceptions import ObjectDoesNotExist
 
+import time
 import datetime
 from urlparse import urlparse
 from collections import namedtuple
+from collections import defaultdict
 
 import logging
 logger = logging.getLogger(__name__)
@@ -103,6 +115,20 @@ def build_source_url_from_reference_url(ref_url):
 BookmarkMetadata = namedtuple("BookmarkMetadata",'note, tags, is_public')
 
 
+def split_in_chunks(iterable,chunk_size):
+  """Yield lists of at most chunk_size consecutive items taken from
+  iterable, without ever consuming more than one chunk in advance.
+  """
+  chunk = []
+  for item in iterable:
+    chunk.append(item)
+    if len(chunk)>=chunk_size:
+      yield chunk
+      chunk = []
+  if chunk:
+    yield chunk
+
+
 def import_references_from_ns_bookmark_list(nsbmk_txt):
   """Extract bookmarks from a Netscape-style bookmark file and save
   them as Reference instances in the database.
@@ -110,12 +136,23 @@ def import_references_from_ns_bookmark_list(nsbmk_txt):
   nsbmk_txt: a unicode string representing the full content of a
   Netscape-style bookmark file.
 
+  Return a dictionary mapping each reference with the BookmarkMetadata
+  associated to it according to the input content.
+  """
+  return import_references_from_ns_bookmarks(
+    parse_netscape_bookmarks(nsbmk_txt))
+
+
+def import_references_from_ns_bookmarks(collected_bmks):
+  """Save the bookmarks as Reference instances in the database.
+  
+  collected_bmks: a list of bookmarks as the dictionaries yielded by
+  wom_river.utils.netscape_bookmarks.iter_netscape_bookmarks.
+
   Return a dictionary mapping each reference with the BookmarkMetadata
   associated to it according to the input content.
   """
   date_now = datetime.datetime.now(timezone.utc)
-  # Parse the file
-  collected_bmks = parse_netscape_bookmarks(nsbmk_txt)
   if not collected_bmks:
     return {}
   # Make sure that the source common to all the following import
@@ -128,11 +165,36 @@ def import_references_from_ns_bookmark_list(nsbmk_txt):
                               title="Bookmark Import",
                               pub_date=date_now)
     common_source.save()
-  new_refs  = []
+  if EXPANDED_URL_CACHE:
+    expanded_url_cache = ExpandedURLCache(EXPANDED_URL_CACHE)
+  else:
+    expanded_url_cache = None
   ref_and_metadata = []
-  new_ref_by_url = {}
-  for bmk_info in collected_bmks:
+  for bmk_chunk in split_in_chunks(collected_bmks,IMPORT_CHUNK_SIZE):
+    ref_and_metadata.extend(
+      import_references_from_ns_bookmark_chunk(bmk_chunk,common_source,
+                                               date_now,expanded_url_cache))
+  return dict(ref_and_metadata)
+
+
+def import_references_from_ns_bookmark_chunk(bmk_chunk,common_source,
+                                             date_now,expanded_url_cache=None):
+  """Save a chunk of bookmarks as references with a constant number of
+  queries and in a single (short) transaction.
+
+  If an expanded_url_cache is given, the short urls found in it are
+  replaced by their expanded version (no expansion is attempted for
+  the others).
+
+  Return a list of (reference,metadata) pairs.
+  """
+  # references to be created, indexed by normalized url
+  new_refs_by_url = {}
+  url_and_metadata = []
+  for bmk_info in bmk_chunk:
     u = bmk_info["url"]
+    if expanded_url_cache is not None:
+      u = expanded_url_cache.get(u,u)
     if not u:
       logger.warning("Skipping a bookmark that has an empty URL.")
       continue
@@ -144,38 +206,159 @@ def import_references_from_ns_bookmark_list(nsbmk_txt):
       logger.warning("Found an url of length %d (>%d) \
 when importing Netscape-style bookmark list." % (len(u),URL_MAX_LENGTH))
     u = u_truncated
-    t = bmk_info.get("title") or build_reference_title_from_url(u)
-    if "posix_timestamp" in bmk_info:
-      d = datetime.datetime\
-                  .utcfromtimestamp(float(bmk_info["posix_timestamp"]))\
-                  .replace(tzinfo=timezone.utc)
-    else:
-      d = date_now
-    if u in new_ref_by_url:
-      ref = new_ref_by_url[u]
-    else:
-      try:
-        ref = Reference.objects.get(url=u)
-      except ObjectDoesNotExist:
-        ref = Reference(url=u,title=truncate_reference_title(t),
-                        pub_date=d,description=info)
-        new_refs.append(ref)
-        new_ref_by_url[u] = ref
+    normalized_u = normalize_url(u)
+    if normalized_u not in new_refs_by_url:
+      t = bmk_info.get("title") or build_reference_title_from_url(u)
+      if "posix_timestamp" in bmk_info:
+        d = datetime.datetime\
+                    .utcfromtimestamp(float(bmk_info["posix_timestamp"]))\
+                    .replace(tzinfo=timezone.utc)
+      else:
+        d = date_now
+      new_refs_by_url[normalized_u] = Reference(
+        url=u,title=truncate_reference_title(t),
+        pub_date=d,description=info,
+        sanitized_description=sanitize_html(info))
     meta = BookmarkMetadata(bmk_info.get("note",""),
                             set(bmk_info.get("tags","").split(",")),
                             bmk_info.get("private","0")=="0")
-    ref_and_metadata.append((ref,meta))
+    url_and_metadata.append((normalized_u,meta))
+  if not url_and_metadata:
+    return []
   with transaction.commit_on_success():
-    for ref in new_refs:
-      ref.save()
-      ref.sources.add(common_source)
-  # Note: We have to wait until now to convert the list to a dict,
-  # because only now will the model instances have their specific ids and
-  # hashes (before that they would have looked the same for the dict).
-  return dict(ref_and_metadata)
+    refs_by_url = get_references_by_normalized_url(
+      r.url for r in new_refs_by_url.values())
+    new_urls = [u for u in new_refs_by_url if u not in refs_by_url]
+    if new_urls:
+      Reference.objects.bulk_create([new_refs_by_url[u] for u in new_urls])
+      # bulk_create doesn't set the primary keys so fetch them back
+      new_refs_by_url = get_references_by_normalized_url(
+        new_refs_by_url[u].url for u in new_urls)
+      ReferenceSources = Reference.sources.through
+      ReferenceSources.objects.bulk_create(
+        [ReferenceSources(from_reference_id=r.id,
+                          to_reference_id=common_source.id)
+         for r in new_refs_by_url.values()])
+      refs_by_url.update(new_refs_by_url)
+  return [(refs_by_url[u],meta) for u,meta in url_and_metadata]
+
 
 def delete_old_references(time_threshold):
   """Delete references that are older that the time_threshold and have a
   save count equal to 0.
+
+  The references are deleted by chunks of DELETE_CHUNK_SIZE (in id
+  order), each chunk in its own short transaction followed by a pause
+  of DELETE_PAUSE seconds.
+
+  Return a dictionary mapping each table name to the number of rows
+  deleted from it.
+  """
+  deleted_rows = defaultdict(int)
+  old_references = Reference.objects.filter(save_count=0,
+                                            pub_date__lt=time_threshold)\
+                                    .order_by("id")
+  last_id = None
+  while True:
+    if last_id is not None:
+      chunk_qs = old_references.filter(id__gt=last_id)
+    else:
+      chunk_qs = old_references
+    reference_ids = list(chunk_qs.values_list("id",flat=True)\
+                         [:DELETE_CHUNK_SIZE])
+    if not reference_ids:
+      break
+    last_id = reference_ids[-1]
+    with transaction.commit_on_success():
+      for table,count in delete_references(reference_ids).items():
+        deleted_rows[table] += count
+    if len(reference_ids)<DELETE_CHUNK_SIZE:
+      break
+    if DELETE_PAUSE:
+      time.sleep(DELETE_PAUSE)
+  return dict(deleted_rows)
+
+
+def delete_rows(table,column,ids):
+  """Delete the rows of a table where column's value is in ids, with a
+  single raw SQL query, and return the number of deleted rows.
+  """
+  qn = connection.ops.quote_name
+  cursor = connection.cursor()
+  cursor.execute("DELETE FROM %s WHERE %s IN (%s)" \
+                 % (qn(table),qn(column),",".join(["%s"]*len(ids))),
+                 ids)
+  transaction.set_dirty()
+  return cursor.rowcount
+
+
+def has_dependencies(model):
+  """Tell if deleting instances of model would require deleting or
+  updating rows in other tables.
+  """
+  opts = model._meta
+  return bool(opts.get_all_related_objects(include_hidden=True)
+              or opts.get_all_related_many_to_many_objects()
+              or opts.many_to_many)
+
+
+def delete_references(reference_ids):
+  """Delete the references with the given ids and all the rows
+  depending on them.
+
+  The relationship tables and the tables of models without
+  dependencies of their own are cleaned with raw set-based queries
+  instead of relying on Django's in-memory cascade.
+
+  Must be called inside a transaction. Return a dictionary mapping
+  each table name to the number of deleted rows.
+  """
+  deleted_rows = defaultdict(int)
+  relationship_columns = set()
+  for field in Reference._meta.many_to_many:
+    through_table = field.rel.through._meta.db_table
+    relationship_columns.add((through_table,field.m2m_column_name()))
+    relationship_columns.add((through_table,field.m2m_reverse_name()))
+  for related in Reference._meta.get_all_related_many_to_many_objects():
+    relationship_columns.add((related.field.rel.through._meta.db_table,
+                              related.field.m2m_reverse_name()))
+  for table,column in sorted(relationship_columns):
+    deleted_rows[table] += delete_rows(table,column,reference_ids)
+  for related in Reference._meta.get_all_related_objects(include_hidden=True):
+    if related.model._meta.auto_created:
+      # relationship tables already handled above
+      continue
+    if has_dependencies(related.model):
+      dependents = related.model.objects\
+        .filter(**{"%s__in" % related.field.name: reference_ids})
+      count = dependents.count()
+      if count:
+        dependents.delete()
+        deleted_rows[related.model._meta.db_table] += count
+    else:
+      deleted_rows[related.model._meta.db_table] += delete_rows(
+        related.model._meta.db_table,related.field.column,reference_ids)
+  deleted_rows[Reference._meta.db_table] += delete_rows(
+    Reference._meta.db_table,Reference._meta.pk.column,reference_ids)
+  return dict((table,count) for table,count in deleted_rows.items() if count)
+
+
+def fill_sanitized_descriptions(force=False):
+  """Compute the sanitized description of the references that don't
+  have one yet (or of all references if force is True), by chunks of
+  SANITIZE_CHUNK_SIZE references each saved in a single transaction.
+
+  Return the number of updated references.
   """
-  Reference.objects.filter(save_count=0,pub_date__lt=time_threshold).delete()
+  references = Reference.objects.all()
+  if not force:
+    references = references.filter(sanitized_description__isnull=True)
+  reference_ids = list(references.order_by("id")\
+                       .values_list("id",flat=True))
+  for id_chunk in split_in_chunks(reference_ids,SANITIZE_CHUNK_SIZE):
+    with transaction.commit_on_success():
+      for ref_id,description in Reference.objects.filter(id__in=id_chunk)\
+                                        .values_list("id","description"):
+        Reference.objects.filter(id=ref_id)\
+          .update(sanitized_description=sanitize_html(description))
+  return len(reference_ids)
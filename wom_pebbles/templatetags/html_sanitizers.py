@@ -2,12 +2,20 @@
 # -*- coding: utf-8 -*-
 
 import re
-
-from bs4 import BeautifulSoup
+import time
+import hashlib
+import threading
+from collections import deque
 
 from django import template
+from django.core.cache import cache
 from django.utils.html import conditional_escape
 from django.utils.safestring import mark_safe
+from django.utils.safestring import SafeData
+
+from wom_pebbles.settings import SANITIZER_CACHE_SIZE
+from wom_pebbles.settings import SANITIZER_CACHE_USE_DJANGO_CACHE
+from wom_pebbles.settings import SANITIZER_CACHE_TIMEOUT
 
 register = template.Library()
 
@@ -24,15 +32,147 @@ def auto_esc(text,autoescape):
   else:
     return text
 
-@register.filter(needs_autoescape=True)
-def defang_html(text, autoescape=None):
+def sanitize_html(text):
   """
-  Remove tags mentionned in the space separated list 'tags' given as input.
+  Return the html text without its scripts and without the tags
+  that may mess up with the page layout (see DANGEROUS_TAGS_NAMES).
   """
-  soup = BeautifulSoup(auto_esc(text,autoescape))
+  if not text:
+    return u""
+  # imported on first use only as it takes a while
+  from bs4 import BeautifulSoup
+  soup = BeautifulSoup(text)
   for tag in soup.find_all("script"):
     tag.replace_with('')
   html = unicode(soup)
-  text = DANGEROUS_TAGS_RE.sub(" ",html)
-  return mark_safe(text)
+  return DANGEROUS_TAGS_RE.sub(" ",html)
+
+
+class SanitizedHTMLCache(object):
+  """
+  Bounded LRU cache (shared by all threads) of the sanitized html,
+  keyed by a hash of the input text and by whether it needs to be
+  escaped.
+
+  If use_django_cache is True, the entries are also stored in
+  Django's cache backend so that they can be shared between processes
+  and survive restarts.
+  """
+  
+  def __init__(self,max_size,use_django_cache=False,timeout=None):
+    self.max_size = max_size
+    self.use_django_cache = use_django_cache
+    self.timeout = timeout
+    self._entries = {}
+    # last access "time" of each entry and the (time,key) of all the
+    # accesses in order, where outdated accesses are skipped at eviction
+    self._last_access = {}
+    self._accesses = deque()
+    self._clock = 0
+    self._lock = threading.Lock()
+    self.clear()
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+      self._last_access.clear()
+      self._accesses.clear()
+      self.hits = 0
+      self.misses = 0
+      self.time_saved = 0.
+
+  def get_key(self,text,escape):
+    if isinstance(text,unicode):
+      text = text.encode("utf-8")
+    return "wom_pebbles.sanitized_html.%s.%d" \
+      % (hashlib.md5(text).hexdigest(),escape)
+    
+  def sanitize(self,text,autoescape):
+    """
+    Return the same as sanitize_html(auto_esc(text,autoescape)) but
+    from the cache when the same text has already been sanitized.
+    """
+    escape = bool(autoescape) and not isinstance(text,SafeData)
+    key = self.get_key(text,escape)
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is not None:
+        self._touch(key)
+        self.hits += 1
+        self.time_saved += entry[1]
+        return entry[0]
+    if self.use_django_cache:
+      entry = cache.get(key)
+    if entry is None:
+      start = time.time()
+      html = sanitize_html(auto_esc(text,autoescape))
+      entry = (html,time.time()-start)
+      if self.use_django_cache:
+        cache.set(key,entry,self.timeout)
+      hit = False
+    else:
+      hit = True
+    with self._lock:
+      if hit:
+        self.hits += 1
+        self.time_saved += entry[1]
+      else:
+        self.misses += 1
+      self._entries[key] = entry
+      self._touch(key)
+      while len(self._entries)>self.max_size:
+        access_time,old_key = self._accesses.popleft()
+        if self._last_access.get(old_key)==access_time:
+          del self._entries[old_key]
+          del self._last_access[old_key]
+    return entry[0]
+
+  def _touch(self,key):
+    """Record an access to the entry (with the lock held)."""
+    self._clock += 1
+    self._last_access[key] = self._clock
+    self._accesses.append((self._clock,key))
+    if len(self._accesses)>2*max(self.max_size,len(self._entries)):
+      # drop the outdated accesses that accumulate with the hits
+      self._accesses = deque(sorted((t,k) for k,t in
+                                    self._last_access.items()))
+
+  def stats(self):
+    """
+    Return a dictionary with the number of hits and misses, the hit
+    rate and the time saved (in seconds) by the cache.
+    """
+    with self._lock:
+      lookups = self.hits+self.misses
+      return {
+        "size": len(self._entries),
+        "hits": self.hits,
+        "misses": self.misses,
+        "hit_rate": float(self.hits)/lookups if lookups else 0.,
+        "time_saved": self.time_saved,
+        }
+
+    
+sanitized_html_cache = SanitizedHTMLCache(SANITIZER_CACHE_SIZE,
+                                          SANITIZER_CACHE_USE_DJANGO_CACHE,
+                                          SANITIZER_CACHE_TIMEOUT)
+
+  
+@register.filter(needs_autoescape=True)
+def defang_html(text, autoescape=None):
+  """
+  Remove tags mentionned in the space separated list 'tags' given as input.
+  """
+  return mark_safe(sanitized_html_cache.sanitize(text,autoescape))
+
+
+@register.filter
+def sanitized_description(reference):
+  """
+  Return the reference's description as sanitized at ingest time, or
+  sanitize it on the fly if this hasn't been done yet.
+  """
+  if reference.sanitized_description is None:
+    return defang_html(reference.description,autoescape=False)
+  return mark_safe(reference.sanitized_description)
 
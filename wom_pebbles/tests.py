@@ -19,21 +19,37 @@
 #
 
 
+import os
+import shutil
 import datetime
+import tempfile
 from django.utils import timezone
 
 from django.test import TestCase
 from django.db import IntegrityError
+from django.db import connection
+from django.db.backends.sqlite3.base import DatabaseWrapper
+from django.core.cache import cache
+from django.utils.safestring import mark_safe
 
 from wom_pebbles.models import Reference
 from wom_pebbles.models import URL_MAX_LENGTH
 from wom_pebbles.models import REFERENCE_TITLE_MAX_LENGTH
+from wom_pebbles.models import normalize_url
+from wom_pebbles.models import compute_url_hash
+from wom_pebbles.models import get_reference_by_url
+from wom_pebbles.models import get_references_by_normalized_url
 from wom_pebbles.tasks  import build_reference_title_from_url
 from wom_pebbles.tasks  import truncate_reference_title
 from wom_pebbles.tasks  import sanitize_url
 from wom_pebbles.tasks  import import_references_from_ns_bookmark_list
+from wom_pebbles.tasks  import import_references_from_ns_bookmarks
+from wom_pebbles.tasks  import fill_sanitized_descriptions
 
 from wom_pebbles.templatetags.html_sanitizers  import defang_html
+from wom_pebbles.templatetags.html_sanitizers  import sanitize_html
+from wom_pebbles.templatetags.html_sanitizers  import sanitized_description
+from wom_pebbles.templatetags.html_sanitizers  import SanitizedHTMLCache
 
 
 if URL_MAX_LENGTH>255:
@@ -107,6 +123,42 @@ class ReferenceModelTest(TestCase):
     self.assertEqual(reference,source.productions.get())
 
 
+class ReferenceURLHashTest(TestCase):
+
+  def test_normalize_url(self):
+    self.assertEqual("http://mouf.org/a?b=1",
+                     normalize_url("HTTP://Mouf.org/a/?utm_source=rss&b=1"))
+    self.assertEqual("http://mouf.org",normalize_url("http://mouf.org/"))
+    self.assertEqual("#internal",normalize_url("#internal"))
+    self.assertNotEqual(compute_url_hash("http://mouf.org/a"),
+                        compute_url_hash("http://mouf.org/b"))
+    self.assertEqual(compute_url_hash("http://mouf.org/a"),
+                     compute_url_hash(u"http://mouf.org/a/?utm_medium=rss"))
+
+  def test_url_hash_set_on_save_and_bulk_create(self):
+    date = datetime.datetime.now(timezone.utc)
+    Reference.objects.create(url=u"http://mouf/a",title=u"a",pub_date=date)
+    Reference.objects.bulk_create([Reference(url=u"http://mouf/b",title=u"b",
+                                             pub_date=date)])
+    for url in ("http://mouf/a","http://mouf/b"):
+      self.assertEqual(compute_url_hash(url),
+                       Reference.objects.get(url=url).url_hash)
+    
+  def test_get_reference_by_url_finds_near_duplicates(self):
+    date = datetime.datetime.now(timezone.utc)
+    ref = Reference.objects.create(url=u"http://mouf/a",title=u"a",
+                                   pub_date=date)
+    exact_ref = Reference.objects.create(url=u"http://mouf/a/",title=u"a",
+                                         pub_date=date)
+    self.assertEqual(ref,get_reference_by_url("http://mouf/a?utm_source=x"))
+    self.assertEqual(exact_ref,get_reference_by_url("http://mouf/a/"))
+    self.assertRaises(Reference.DoesNotExist,
+                      get_reference_by_url,"http://mouf/b")
+    self.assertEqual({"http://mouf/a": ref},
+                     get_references_by_normalized_url(["http://mouf/a/",
+                                                       "http://mouf/b"]))
+
+    
 class UtilityFunctionsTests(TestCase):
 
   def test_build_reference_title_from_url(self):
@@ -264,6 +316,74 @@ Do Not Edit! -->
     self.assertEqual("A too long URL.",meta.note)
     self.assertTrue(meta.is_public)
 
+  def test_new_references_linked_to_the_import_source(self):
+    import_source = Reference.objects.get(url="#internal-bookmark-import")
+    self.assertEqual(set(["http://www.example.com"]),
+                     set(r.url for r in import_source.productions.all()
+                         if not r.url.startswith("http://uuu")))
+    self.assertEqual(2,import_source.productions.count())
+    self.assertEqual([self.source],
+                     list(Reference.objects.get(url="http://mouf/a")\
+                          .sources.all()))
+
+
+class ImportReferencesFromNSBookmarkChunksTest(TestCase):
+
+  def setUp(self):
+    import wom_pebbles.tasks
+    self.initial_chunk_size = wom_pebbles.tasks.IMPORT_CHUNK_SIZE
+    wom_pebbles.tasks.IMPORT_CHUNK_SIZE = 4
+    date = datetime.datetime.now(timezone.utc)
+    Reference.objects.create(url=u"http://mouf/3",title=u"glop",
+                             pub_date=date)
+    Reference.objects.create(url=u"#internal-bookmark-import",
+                             title=u"Bookmark Import",
+                             pub_date=date)
+
+  def tearDown(self):
+    import wom_pebbles.tasks
+    wom_pebbles.tasks.IMPORT_CHUNK_SIZE = self.initial_chunk_size
+
+  def test_constant_number_of_queries_per_chunk(self):
+    bmks = [{"url": "http://mouf/%d" % i, "title": "R%d" % i}
+            for i in range(10)]
+    # duplicated bookmarks in the same chunk
+    bmks.insert(1,{"url": "http://mouf/0", "note": "again"})
+    # 1 query for the common source then for each chunk: 1 lookup,
+    # 2 inserts and 1 fetch of the new references (the last chunk
+    # contains 3 bookmarks).
+    with self.assertNumQueries(1+3*4):
+      ref_and_metadata = import_references_from_ns_bookmarks(bmks)
+    self.assertEqual(10,len(ref_and_metadata))
+    self.assertEqual(11,Reference.objects.count())
+    self.assertEqual("glop",Reference.objects.get(url="http://mouf/3").title)
+    self.assertEqual("R9",Reference.objects.get(url="http://mouf/9").title)
+    import_source = Reference.objects.get(url="#internal-bookmark-import")
+    self.assertEqual(9,import_source.productions.count())
+
+  def test_near_duplicate_urls_resolved_to_existing_references(self):
+    import_references_from_ns_bookmarks(
+      [{"url": "http://mouf/3/?utm_source=rss"},
+       {"url": "http://mouf/4"},{"url": "HTTP://MOUF/4/"}])
+    self.assertEqual(3,Reference.objects.count())
+    self.assertFalse(Reference.objects.filter(url__contains="utm").exists())
+    
+  def test_short_urls_replaced_by_cached_expanded_urls(self):
+    import wom_pebbles.tasks
+    cache_file = tempfile.NamedTemporaryFile(suffix=".json",delete=False)
+    cache_file.write('{"http://sh.rt/1": "http://mouf/long"}')
+    cache_file.close()
+    wom_pebbles.tasks.EXPANDED_URL_CACHE = cache_file.name
+    try:
+      import_references_from_ns_bookmarks([{"url": "http://sh.rt/1"},
+                                           {"url": "http://sh.rt/2"}])
+    finally:
+      wom_pebbles.tasks.EXPANDED_URL_CACHE = None
+      os.remove(cache_file.name)
+    self.assertTrue(Reference.objects.filter(url="http://mouf/long").exists())
+    self.assertFalse(Reference.objects.filter(url="http://sh.rt/1").exists())
+    self.assertTrue(Reference.objects.filter(url="http://sh.rt/2").exists())
+
 
 class HTMLSanitizersTemplateTagsTest(TestCase):
   
@@ -302,3 +422,147 @@ class HTMLSanitizersTemplateTagsTest(TestCase):
  <p> <img/>Hello <b>World!</b> </p> """
     output = defang_html(html)
     self.assertEqual(safer_html,output)
+
+  def test_sanitized_description_uses_stored_value(self):
+    ref = Reference(url="http://mouf",title="mouf",
+                    description="<script>bad</script>",
+                    sanitized_description="<b>stored</b>")
+    self.assertEqual("<b>stored</b>",sanitized_description(ref))
+
+  def test_sanitized_description_falls_back_to_defang_html(self):
+    ref = Reference(url="http://mouf",title="mouf",
+                    description="<div><b>Hello</b><script>bad</script></div>")
+    self.assertEqual(None,ref.sanitized_description)
+    self.assertEqual(" <b>Hello</b> ",sanitized_description(ref))
+
+
+class SanitizedDescriptionTest(TestCase):
+
+  def setUp(self):
+    self.date = datetime.datetime.now(timezone.utc)
+    
+  def test_import_from_ns_bookmarks_sanitizes_descriptions(self):
+    long_url = "http://mouf/" + "a"*URL_MAX_LENGTH
+    import_references_from_ns_bookmarks([{"url": long_url}])
+    ref = Reference.objects.get(url__startswith="http://mouf/aaa")
+    self.assertIn("WOM had to truncate",ref.description)
+    self.assertEqual(sanitize_html(ref.description),
+                     ref.sanitized_description)
+    
+  def test_fill_sanitized_descriptions_only_fills_missing_ones(self):
+    Reference.objects.create(url="http://mouf",title="mouf",
+                             pub_date=self.date,
+                             description="<div><b>Hello</b></div>")
+    Reference.objects.create(url="http://bla",title="bla",
+                             pub_date=self.date,
+                             description="<div><b>Bla</b></div>",
+                             sanitized_description="<b>Bla</b>")
+    self.assertEqual(1,fill_sanitized_descriptions())
+    self.assertEqual(" <b>Hello</b> ",
+                     Reference.objects.get(url="http://mouf")\
+                     .sanitized_description)
+    self.assertEqual("<b>Bla</b>",
+                     Reference.objects.get(url="http://bla")\
+                     .sanitized_description)
+    self.assertEqual(0,fill_sanitized_descriptions())
+    self.assertEqual(2,fill_sanitized_descriptions(force=True))
+    self.assertEqual(" <b>Bla</b> ",
+                     Reference.objects.get(url="http://bla")\
+                     .sanitized_description)
+
+
+class SanitizedHTMLCacheTest(TestCase):
+
+  def setUp(self):
+    self.html = "<div><b>Hello</b><script>bad</script></div>"
+    
+  def test_same_text_sanitized_once(self):
+    html_cache = SanitizedHTMLCache(10)
+    self.assertEqual(" <b>Hello</b> ",html_cache.sanitize(self.html,False))
+    self.assertEqual(" <b>Hello</b> ",html_cache.sanitize(self.html,False))
+    stats = html_cache.stats()
+    self.assertEqual(1,stats["hits"])
+    self.assertEqual(1,stats["misses"])
+    self.assertEqual(0.5,stats["hit_rate"])
+    self.assertTrue(stats["time_saved"]>=0)
+
+  def test_escaped_and_unescaped_text_cached_separately(self):
+    html_cache = SanitizedHTMLCache(10)
+    unescaped = html_cache.sanitize(self.html,False)
+    escaped = html_cache.sanitize(self.html,True)
+    self.assertNotEqual(unescaped,escaped)
+    self.assertIn("&lt;b&gt;",escaped)
+    self.assertEqual(0,html_cache.stats()["hits"])
+    # safe text isn't escaped and shares the unescaped entry
+    self.assertEqual(unescaped,html_cache.sanitize(mark_safe(self.html),True))
+    self.assertEqual(1,html_cache.stats()["hits"])
+
+  def test_least_recently_used_entries_evicted(self):
+    html_cache = SanitizedHTMLCache(2)
+    html_cache.sanitize("<b>1</b>",False)
+    html_cache.sanitize("<b>2</b>",False)
+    html_cache.sanitize("<b>1</b>",False)
+    html_cache.sanitize("<b>3</b>",False)
+    self.assertEqual(2,html_cache.stats()["size"])
+    html_cache.sanitize("<b>1</b>",False)
+    self.assertEqual(2,html_cache.stats()["hits"])
+    html_cache.sanitize("<b>2</b>",False)
+    self.assertEqual(2,html_cache.stats()["hits"])
+
+  def test_repeated_hits_keep_the_access_history_bounded(self):
+    html_cache = SanitizedHTMLCache(2)
+    html_cache.sanitize("<b>1</b>",False)
+    html_cache.sanitize("<b>2</b>",False)
+    for i in range(100):
+      html_cache.sanitize("<b>1</b>",False)
+    self.assertTrue(len(html_cache._accesses)<=4)
+    html_cache.sanitize("<b>3</b>",False)
+    html_cache.sanitize("<b>1</b>",False)
+    self.assertEqual(101,html_cache.stats()["hits"])
+
+  def test_entries_shared_through_django_cache(self):
+    html_cache = SanitizedHTMLCache(10,use_django_cache=True)
+    other_cache = SanitizedHTMLCache(10,use_django_cache=True)
+    try:
+      html_cache.sanitize(self.html,False)
+      self.assertEqual(" <b>Hello</b> ",other_cache.sanitize(self.html,False))
+      self.assertEqual(1,other_cache.stats()["hits"])
+    finally:
+      cache.delete(html_cache.get_key(self.html,False))
+
+
+class SQLiteProfileTest(TestCase):
+
+  def setUp(self):
+    import wom_pebbles.models
+    self.profile = wom_pebbles.models.SQLITE_PROFILE
+    self.db_dir = tempfile.mkdtemp()
+    
+  def tearDown(self):
+    import wom_pebbles.models
+    wom_pebbles.models.SQLITE_PROFILE = self.profile
+    shutil.rmtree(self.db_dir)
+    
+  def get_pragmas(self):
+    """Open a new connection on a SQLite file and return the value of
+    the profile's pragmas."""
+    settings_dict = dict(connection.settings_dict,
+                         NAME=os.path.join(self.db_dir,"db.sql3"))
+    new_connection = DatabaseWrapper(settings_dict,"sqlite_profile_test")
+    try:
+      cursor = new_connection.cursor()
+      pragmas = {}
+      for name in ("journal_mode","synchronous","busy_timeout"):
+        cursor.execute("PRAGMA %s" % name)
+        pragmas[name] = cursor.fetchone()[0]
+      return pragmas
+    finally:
+      new_connection.close()
+    
+  def test_pragmas_set_on_new_connections_if_activated(self):
+    import wom_pebbles.models
+    wom_pebbles.models.SQLITE_PROFILE = False
+    self.assertEqual("delete",self.get_pragmas()["journal_mode"])
+    wom_pebbles.models.SQLITE_PROFILE = True
+    self.assertEqual({"journal_mode": "wal","synchronous": 1,
+                      "busy_timeout": 20000},self.get_pragmas())
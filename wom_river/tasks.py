@@ -18,16 +18,16 @@
 # along with WaterOnMars.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-import feedparser
 from datetime import datetime
 from django.utils import timezone
 from django.utils.html import strip_tags
 
 from django.db import transaction
-from django.core.exceptions import ObjectDoesNotExist
-from django.core.exceptions import MultipleObjectsReturned
+from django.db.models import F
 
 from wom_pebbles.models import Reference
+from wom_pebbles.models import normalize_url
+from wom_pebbles.models import get_references_by_normalized_url
 
 from wom_river.models import WebFeed
 from wom_river.utils.read_opml import parse_opml
@@ -36,6 +36,10 @@ from wom_pebbles.models import URL_MAX_LENGTH
 
 from wom_pebbles.tasks import truncate_reference_title
 from wom_pebbles.tasks import sanitize_url
+from wom_pebbles.tasks import split_in_chunks
+from wom_pebbles.templatetags.html_sanitizers import sanitize_html
+
+from wom_pebbles.settings import IMPORT_CHUNK_SIZE
 
 
 import logging
@@ -104,6 +108,7 @@ when importing references from feed." % (len(url),URL_MAX_LENGTH))
   else:
     ref = previous_ref
   ref.description = " ".join((info,entry.get("description","")))
+  ref.sanitized_description = sanitize_html(ref.description)
   ref.pub_date = date
   return (ref,tags)
 
@@ -124,8 +129,7 @@ def add_new_references_from_feedparser_entries(feed,entries):
   new_entries = [(e,d) for e,d in entries_with_dates \
                  if d>feed_last_update_check]
   entries_url = [e.link for e,_ in new_entries if e.get("link",None)]
-  existing_references = list(Reference.objects.filter(url__in=entries_url).all())
-  existing_references_by_url = dict([(r.url,r) for r in existing_references])
+  existing_references_by_url = get_references_by_normalized_url(entries_url)
   for entry,date in new_entries:
     entry_link = entry.get("link",None)
     if not entry_link:
@@ -133,12 +137,13 @@ def add_new_references_from_feedparser_entries(feed,entries):
       # link as well
       logger.warning("Skipping a feed entry without 'link' : %s." % entry)
       continue
-    previous_ref = existing_references_by_url.get(entry_link,None)
+    normalized_link = normalize_url(entry_link)
+    previous_ref = existing_references_by_url.get(normalized_link,None)
     if previous_ref is None:
       # there may also be duplicate in the current feed list of items
-      previous_ref = ref_by_url.get(entry_link,None)
+      previous_ref = ref_by_url.get(normalized_link,None)
     r,tags = create_reference_from_feedparser_entry(entry,date,previous_ref)
-    ref_by_url[r.url] = r
+    ref_by_url[normalized_link] = r
     current_ref_date = r.pub_date
     all_references.append((r,tags))
     if current_ref_date > latest_item_date:
@@ -162,6 +167,9 @@ def collect_new_references_for_feed(feed):
   """Get the feed data from its URL and collect the new references into the db.
   Return a dictionary mapping the new references to a corresponding set of tags.
   """
+  # imported here to keep it out of the startup of the processes that
+  # never fetch feeds
+  import feedparser
   try:
     d = feedparser.parse(feed.xmlURL)
   except Exception,e:
@@ -187,38 +195,82 @@ def import_feedsources_from_opml(opml_txt):
   Return a dictionary assiociating each feed with a set of tags {feed:tagSet,...).
   """
   collected_feeds,_ = parse_opml(opml_txt,False)
-  db_new_feedsources = []
+  return import_collected_feedsources(collected_feeds)
+
+
+def import_collected_feedsources(collected_feeds):
+  """
+  Save in the db the feeds collected from an OPML file (by chunks of
+  IMPORT_CHUNK_SIZE).
+  Return a dictionary assiociating each feed with a set of tags {feed:tagSet,...).
+  """
   feeds_and_tags = []
-  newly_referenced_source = []
-  for current_feed in collected_feeds:
-    try:
-      feed_source = WebFeed.objects.get(xmlURL=current_feed.xmlUrl)
-    except MultipleObjectsReturned:
-      feed_source = WebFeed.objects.all()[0]
-    except ObjectDoesNotExist:
-      url_id = current_feed.htmlUrl or current_feed.xmlUrl
-      try:
-        ref = Reference.objects.get(url=url_id)
-      except ObjectDoesNotExist:
-        ref = Reference(url=url_id,title=HTMLUnescape(current_feed.title),
-                        pub_date=datetime.now(timezone.utc))
-        ref.save()
-      feed_source = WebFeed(source=ref,xmlURL=current_feed.xmlUrl)
-      feed_source.last_update_check = datetime.utcfromtimestamp(0)\
-                                              .replace(tzinfo=timezone.utc)
-      newly_referenced_source.append(ref)
-      db_new_feedsources.append(feed_source)
-    feeds_and_tags.append((feed_source,current_feed.tags))
-  with transaction.commit_on_success():
-    for f in db_new_feedsources:
-      f.save()
-      # make sure to record the fact
-    for r in newly_referenced_source:
-      r.save_count += 1
-      r.save()
+  for feed_chunk in split_in_chunks(collected_feeds,IMPORT_CHUNK_SIZE):
+    feeds_and_tags.extend(import_feedsources_from_opml_chunk(feed_chunk))
   return dict(feeds_and_tags)
 
 
+def get_feeds_by_xmlURL(xml_urls):
+  """Return a dictionary mapping the urls to the corresponding
+  WebFeed instances (with the lowest id when several feeds share the
+  same url).
+  """
+  feeds_by_xmlURL = {}
+  for feed in WebFeed.objects.filter(xmlURL__in=xml_urls)\
+                             .select_related("source").order_by("-id"):
+    feeds_by_xmlURL[feed.xmlURL] = feed
+  return feeds_by_xmlURL
+
+  
+def import_feedsources_from_opml_chunk(collected_feeds):
+  """Save the feeds collected from an OPML file with a constant number
+  of queries and in a single transaction.
+
+  Return a list of (feed,tagSet) pairs.
+  """
+  with transaction.commit_on_success():
+    feeds_by_xmlURL = get_feeds_by_xmlURL([f.xmlUrl for f in collected_feeds])
+    new_feeds = [f for f in collected_feeds
+                 if f.xmlUrl not in feeds_by_xmlURL]
+    if new_feeds:
+      source_url_by_xmlURL = dict((f.xmlUrl,f.htmlUrl or f.xmlUrl)
+                                  for f in new_feeds)
+      refs_by_url = get_references_by_normalized_url(
+        source_url_by_xmlURL.values())
+      date_now = datetime.now(timezone.utc)
+      new_refs_by_url = {}
+      source_key_by_xmlURL = {}
+      for current_feed in new_feeds:
+        url_id = source_url_by_xmlURL[current_feed.xmlUrl]
+        source_key = normalize_url(url_id)
+        source_key_by_xmlURL[current_feed.xmlUrl] = source_key
+        if source_key not in refs_by_url \
+           and source_key not in new_refs_by_url:
+          new_refs_by_url[source_key] = Reference(
+            url=url_id,title=HTMLUnescape(current_feed.title),
+            pub_date=date_now)
+      if new_refs_by_url:
+        Reference.objects.bulk_create(new_refs_by_url.values())
+        # bulk_create doesn't set the primary keys so fetch them back
+        refs_by_url.update(get_references_by_normalized_url(
+          r.url for r in new_refs_by_url.values()))
+      last_update_check = datetime.utcfromtimestamp(0)\
+                                  .replace(tzinfo=timezone.utc)
+      WebFeed.objects.bulk_create(
+        [WebFeed(source=refs_by_url[source_key_by_xmlURL[f.xmlUrl]],
+                 xmlURL=f.xmlUrl,last_update_check=last_update_check)
+         for f in new_feeds])
+      # make sure to record the fact that the sources are referenced
+      # by new feeds
+      Reference.objects\
+        .filter(id__in=set(refs_by_url[k].id
+                           for k in source_key_by_xmlURL.values()))\
+        .update(save_count=F("save_count")+1)
+      feeds_by_xmlURL.update(
+        get_feeds_by_xmlURL(source_url_by_xmlURL.keys()))
+  return [(feeds_by_xmlURL[f.xmlUrl],f.tags) for f in collected_feeds]
+
+
 # TODO put this in a function of wom_user with the appropriate tests.
   # with transaction.commit_on_success():
   #   for f,tags in feeds_and_tags:
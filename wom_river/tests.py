@@ -21,6 +21,13 @@
 from datetime import datetime
 from django.utils import timezone
 
+import os
+import time
+import shutil
+import tempfile
+import threading
+from cStringIO import StringIO
+
 import feedparser
 
 from django.test import TestCase
@@ -32,9 +39,18 @@ from wom_river.models import URL_MAX_LENGTH
 
 from wom_river.tasks import import_feedsources_from_opml
 from wom_river.tasks import add_new_references_from_feedparser_entries
+from wom_river.tasks import collect_news_from_feeds
+
+from wom_river.utils.netscape_bookmarks import iter_netscape_bookmarks
+from wom_river.utils.netscape_bookmarks import expand_urls
+from wom_river.utils.netscape_bookmarks import expand_short_urls
+from wom_river.utils.netscape_bookmarks import ExpandedURLCache
+from wom_river.utils.read_opml import parse_opml
 
 from django.contrib.auth.models import User
 
+from benchmarks.feed_server import FeedServer
+
 class WebFeedModelTest(TestCase):
 
   def setUp(self):
@@ -68,6 +84,135 @@ class WebFeedModelTest(TestCase):
     self.assertEqual(max_length_xmlURL,s.xmlURL)
 
     
+class IterNetscapeBookmarksTest(TestCase):
+
+  def test_bookmarks_yielded_with_all_their_info(self):
+    nsbmk_lines = iter("""\
+<!DOCTYPE NETSCAPE-Bookmark-file-1>
+<TITLE>Bookmarks</TITLE>
+<DL><p>
+<DT><A HREF="http://www.example.com" ADD_DATE="1367951483" PRIVATE="1" TAGS="example,html">The example</A>
+<DD>An example bookmark.
+<DT><H3 FOLDED>A folder</H3>
+<DT><A TAGS="test" PRIVATE="0" HREF="http://mouf/a">The mouf</A>
+<DT><A HREF="http://mouf/b"></A>
+</DL><p>
+""".splitlines(True))
+    bmks = list(iter_netscape_bookmarks(nsbmk_lines))
+    self.assertEqual(3,len(bmks))
+    self.assertEqual({"url": "http://www.example.com",
+                      "title": "The example",
+                      "posix_timestamp": "1367951483",
+                      "private": "1",
+                      "tags": "example,html",
+                      "note": "An example bookmark."},bmks[0])
+    self.assertEqual({"url": "http://mouf/a",
+                      "title": "The mouf",
+                      "private": "0",
+                      "tags": "test"},bmks[1])
+    self.assertEqual({"url": "http://mouf/b", "title": ""},bmks[2])
+
+  def test_wrong_doctype_raises_value_error(self):
+    bmks = iter_netscape_bookmarks(["<html>",
+                                    '<DT><A HREF="http://mouf/a">a</A>'])
+    self.assertRaises(ValueError,list,bmks)
+
+
+class ExpandShortURLsTest(TestCase):
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.cache_path = os.path.join(self.tmp_dir,"cache.json")
+    self.expanded = []
+    self.lock = threading.Lock()
+    self.running_by_host = {}
+    self.max_running_by_host = {}
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+    
+  def fake_expand(self,url,opener):
+    host = url.split("/")[2]
+    with self.lock:
+      self.expanded.append(url)
+      self.running_by_host[host] = self.running_by_host.get(host,0)+1
+      self.max_running_by_host[host] = max(self.running_by_host[host],
+                                           self.max_running_by_host.get(host,0))
+    time.sleep(0.01)
+    with self.lock:
+      self.running_by_host[host] -= 1
+    return url.replace("http://short","http://long")
+
+  def test_each_url_expanded_once_with_limited_connections_per_host(self):
+    urls = ["http://short%d/%d" % (i%2,i) for i in range(10)]*2
+    expanded_urls = expand_urls(urls,num_threads=8,
+                                max_connections_per_host=2,
+                                expand_func=self.fake_expand)
+    self.assertEqual(10,len(self.expanded))
+    self.assertEqual("http://long1/3",expanded_urls["http://short1/3"])
+    self.assertEqual(10,len(expanded_urls))
+    self.assertTrue(all(n<=2 for n in self.max_running_by_host.values()))
+
+  def test_cached_urls_not_expanded_again(self):
+    cache = ExpandedURLCache(self.cache_path)
+    cache.set("http://short0/0","http://cached/0")
+    expanded_urls = expand_urls(["http://short0/0","http://short0/1"],cache,
+                                expand_func=self.fake_expand)
+    self.assertEqual(["http://short0/1"],self.expanded)
+    self.assertEqual("http://cached/0",expanded_urls["http://short0/0"])
+    self.assertEqual("http://long0/1",cache.get("http://short0/1"))
+
+  def test_expand_short_urls_saves_the_cache(self):
+    nsbmk = StringIO("""\
+<!DOCTYPE NETSCAPE-Bookmark-file-1>
+<DT><A HREF="http://short0/a">A</A>
+<DT><A HREF="http://short0/a">None</A> from twitter
+""")
+    output = StringIO()
+    expand_short_urls(nsbmk,output,ExpandedURLCache(self.cache_path),
+                      expand_func=self.fake_expand)
+    self.assertEqual(["http://short0/a"],self.expanded)
+    self.assertIn('<A HREF="http://long0/a">A</A>',output.getvalue())
+    self.assertIn('<A HREF="http://long0/a">http://long0/a</A>',
+                  output.getvalue())
+    self.assertEqual("http://long0/a",
+                     ExpandedURLCache(self.cache_path).get("http://short0/a"))
+
+
+class ParseOPMLTest(TestCase):
+
+  def test_tags_follow_the_outline_paths(self):
+    opml_txt = """\
+<?xml version="1.0" encoding="UTF-8"?>
+<opml version="2.0">
+<head><outline text="H" xmlUrl="http://head"/></head>
+<body>
+<outline text="News">
+  <outline text="A" xmlUrl="http://a" htmlUrl="http://ha" category="c1,c2"/>
+  <outline><outline text="B" xmlUrl="http://b"/></outline>
+  <foo><outline text="C" xmlUrl="http://c"/></foo>
+  <outline text="R" type="rss"><outline text="D" xmlUrl="http://d"/></outline>
+  <outline text="F" xmlUrl="http://f"><outline text="G" xmlUrl="http://g"/></outline>
+</outline>
+<outline text="Culture"><outline text="A bis" xmlUrl="http://a"/></outline>
+</body>
+</opml>"""
+    feeds,tags = parse_opml(opml_txt,False)
+    feeds_by_url = dict((f.xmlUrl,f) for f in feeds)
+    self.assertEqual(set(["http://a","http://b","http://f"]),
+                     set(feeds_by_url.keys()))
+    self.assertEqual("A",feeds_by_url["http://a"].title)
+    self.assertEqual("http://ha",feeds_by_url["http://a"].htmlUrl)
+    self.assertEqual(set(["News","Culture","c1","c2"]),
+                     feeds_by_url["http://a"].tags)
+    self.assertEqual(set(["News"]),feeds_by_url["http://b"].tags)
+    self.assertEqual(set(["News"]),feeds_by_url["http://f"].tags)
+    self.assertEqual(set(["News","Culture","c1","c2"]),tags)
+
+  def test_wrong_root_raises_runtime_error(self):
+    self.assertRaises(RuntimeError,parse_opml,"<html><body/></html>",False)
+
+
 class ImportFeedSourcesFromOPMLTaskTest(TestCase):
   
   def setUp(self):
@@ -149,6 +294,54 @@ class ImportFeedSourcesFromOPMLTaskTest(TestCase):
     f = WebFeed.objects.get(xmlURL="http://www.openculture.com/feed")
     self.assertIn("Culture",self.feeds_and_tags[f])
 
+  def test_check_new_sources_save_count_incremented(self):
+    self.assertEqual(1,Reference.objects.get(url="http://scripting.com/")\
+                     .save_count)
+    self.assertEqual(0,Reference.objects.get(url="http://mouf").save_count)
+
+
+class ImportFeedSourcesFromOPMLChunksTest(TestCase):
+
+  def setUp(self):
+    date = datetime.now(timezone.utc)
+    r1 = Reference.objects.create(url="http://mouf",title="f1",pub_date=date)
+    self.fs1 = WebFeed.objects.create(xmlURL="http://mouf/rss.xml",
+                                      last_update_check=date,
+                                      source=r1)
+    # a duplicate feed
+    WebFeed.objects.create(xmlURL="http://mouf/rss.xml",
+                           last_update_check=date,
+                           source=r1)
+    Reference.objects.create(url="http://greuh",title="f3",pub_date=date)
+    self.opml_txt = """\
+<?xml version="1.0" encoding="UTF-8"?>
+<opml version="1.0">
+  <body>
+    <outline text="Mouf" xmlUrl="http://mouf/rss.xml" htmlUrl="http://mouf"/>
+    <outline text="Greuh" xmlUrl="http://greuh/rss.xml" htmlUrl="http://greuh"/>
+    <outline text="Greuh atom" xmlUrl="http://greuh/atom.xml" htmlUrl="http://greuh"/>
+    <outline text="Glop" xmlUrl="http://glop/rss.xml"/>
+  </body>
+</opml>
+"""
+
+  def test_constant_number_of_queries(self):
+    # 1 lookup of the feeds, 1 of the references, 2 queries to create
+    # the references and fetch them back, 1 to create the feeds, 1 to
+    # update the save counts and 1 to fetch the new feeds.
+    with self.assertNumQueries(7):
+      feeds_and_tags = import_feedsources_from_opml(self.opml_txt)
+    self.assertEqual(4,len(feeds_and_tags))
+    self.assertEqual(5,WebFeed.objects.count())
+    self.assertEqual(3,Reference.objects.count())
+    self.assertEqual("http://glop/rss.xml",
+                     WebFeed.objects.get(xmlURL="http://glop/rss.xml")\
+                     .source.url)
+    self.assertEqual(1,Reference.objects.get(url="http://greuh").save_count)
+    
+  def test_oldest_of_duplicated_feeds_is_returned(self):
+    feeds_and_tags = import_feedsources_from_opml(self.opml_txt)
+    self.assertIn(self.fs1,feeds_and_tags)
 
 
 class AddReferencesFromFeedParserEntriesTask(TestCase):
@@ -233,6 +426,10 @@ class AddReferencesFromFeedParserEntriesTask(TestCase):
     # description field to 'save' url info from oblivion.
     self.assertIn("http://uuu",
                   Reference.objects.get(url__contains="uuu").description)
+
+  def test_references_are_added_with_sanitized_description(self):
+    ref = Reference.objects.get(url="http://mouf/a")
+    self.assertIn("<p>This is just a test</p>",ref.sanitized_description)
     
   def test_references_are_added_with_correct_sources(self):
     references_in_db = list(Reference.objects.all())
@@ -339,3 +536,64 @@ class AddReferencesFromFeedParserTaskOnBrokenFeed(TestCase):
       if ref!=self.source:
         self.assertIn(self.source,ref.sources.all(),ref)
 
+
+
+class CollectNewsFromFeedServerTest(TestCase):
+  """Collect the news end to end from the local feed server."""
+  
+  def setUp(self):
+    self.server = FeedServer(num_feeds=4,entries_per_feed=5,churn=2,
+                             churn_period=0).start()
+    self.addCleanup(self.server.stop)
+    date = datetime(2000,1,1,tzinfo=timezone.utc)
+    for i in range(self.server.num_feeds):
+      source = Reference.objects.create(url=self.server.site_url(i),
+                                        title=u"site %d" % i,
+                                        pub_date=date)
+      WebFeed.objects.create(xmlURL=self.server.feed_url(i),
+                             last_update_check=date,source=source)
+      
+  def get_num_items(self):
+    return Reference.objects.filter(sources__isnull=False).count()
+  
+  def test_collect_rss_and_atom_feeds(self):
+    self.assertEqual([False,True],[self.server.is_atom(i) for i in (0,1)])
+    collect_news_from_feeds()
+    self.assertEqual(4*5,self.get_num_items())
+    for i in (0,1):
+      self.assertEqual(5,Reference.objects.get(url=self.server.site_url(i))\
+                       .productions.count())
+    
+  def test_collect_only_new_entries(self):
+    collect_news_from_feeds()
+    self.server.advance()
+    collect_news_from_feeds()
+    self.assertEqual(4*(5+2),self.get_num_items())
+    self.assertEqual(8,self.server.stats["feeds"])
+
+  def test_collect_skips_feeds_with_errors(self):
+    self.server.error_rate = 1
+    collect_news_from_feeds()
+    self.assertEqual(0,self.get_num_items())
+    self.assertEqual(4,self.server.stats["errors"])
+    self.server.error_rate = 0
+    collect_news_from_feeds()
+    self.assertEqual(4*5,self.get_num_items())
+
+  def test_conditional_requests(self):
+    d = feedparser.parse(self.server.feed_url(0))
+    self.assertEqual(200,d.status)
+    self.assertEqual(304,feedparser.parse(self.server.feed_url(0),
+                                          etag=d.etag).status)
+    self.assertEqual(304,feedparser.parse(self.server.feed_url(0),
+                                          modified=d.modified).status)
+    self.server.advance()
+    self.assertEqual(200,feedparser.parse(self.server.feed_url(0),
+                                          etag=d.etag).status)
+    
+  def test_feed_discovery(self):
+    from wom_river.utils import feedfinder
+    self.assertEqual([self.server.feed_url(2)],
+                     feedfinder.feeds(self.server.site_url(2)))
+    self.assertTrue(feedfinder.isFeed(self.server.feed_url(2)))
+    self.assertFalse(feedfinder.isFeed(self.server.site_url(2)))
@@ -44,9 +44,12 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 
 import urllib2
+import urlparse
 import sys
 import os
 import re
+import json
+import threading
 
 
 # The following prefix is not enough to identify a bookmark line (may
@@ -57,12 +60,16 @@ BOOKMARK_NOTE_PREFIX = "<DD>"
 DOCTYPE_LINE = "<!DOCTYPE NETSCAPE-Bookmark-file-1>"
 # Regular expression to extract info about the bookmark
 RE_BOOKMARK_URL = re.compile('HREF="(?P<url>[^"]+)"')
-RE_BOOKMARK_COMPONENTS = {
-  "posix_timestamp" : re.compile('ADD_DATE="(?P<posix_timestamp>\d+)"'),
-  "tags"   : re.compile('TAGS="(?P<tags>[\w,]+)"'),
-  "private": re.compile('PRIVATE="(?P<private>\d)"'),
-  "title"  : re.compile('<A[^>]*>(?P<title>[^<]*)<'),
-  }
+# Single regular expression extracting all the bookmark's info in one
+# pass, the lookaheads making it independent of the attributes' order.
+RE_BOOKMARK_LINE = re.compile(
+  '<A(?=[^>]*HREF="(?P<url>[^"]+)")'
+  '(?:(?=[^>]*ADD_DATE="(?P<posix_timestamp>\d+)"))?'
+  '(?:(?=[^>]*TAGS="(?P<tags>[\w,]+)"))?'
+  '(?:(?=[^>]*PRIVATE="(?P<private>\d)"))?'
+  '[^>]*>(?:(?P<title>[^<]*)<)?')
+# Default path of the file where the expanded urls are cached.
+DEFAULT_EXPANDED_URL_CACHE = "~/.netscape_bookmarks_expanded_urls.json"
 
 
 def is_netscape_bookmarks_file(candidateFile):
@@ -79,46 +86,65 @@ def is_netscape_bookmarks_file(candidateFile):
   return False
 
 
-def parse_netscape_bookmarks(bookmarkHTMFile):
-  """Extract bookmarks and return them in a list of dictionaries formatted in the following way:
-  [ {"url":"http://...", "title":"the title", "private":"0"/"1", "tags":"tag1,tag2,...", "posix_timestamp"="<unix time>", "note":"description"}]
-  Raise a ValueError if the format is wrong.
+def iter_netscape_bookmarks(bookmarkLines):
+  """Yield the bookmarks one by one as dictionaries formatted in the following way:
+  {"url":"http://...", "title":"the title", "private":"0"/"1", "tags":"tag1,tag2,...", "posix_timestamp"="<unix time>", "note":"description"}
+
+  bookmarkLines can be any iterable over the lines of the file (an
+  open file for instance) so that the whole content doesn't have to
+  be loaded in memory.
+  Raise a ValueError (when reached) if the format is wrong.
   """
-  bookmark_list = []
-  last_line_is_bmk = False
+  pending_bmk = None
   correct_doctype_found = False
-  for line in bookmarkHTMFile.splitlines():
-    line = line.lstrip()
-    if line.startswith("<!DOCTYPE NETSCAPE-Bookmark-file-1>"):
+  for line in bookmarkLines:
+    line = line.strip()
+    if line.startswith(DOCTYPE_LINE):
       correct_doctype_found = True
       continue
-    if line.rstrip() and not correct_doctype_found:
-      raise ValueError("Couldn't find a correct DOCTYPE in the bookmark file (wrong format?)")
-    if not line.rstrip():
+    if not line:
       continue
+    if not correct_doctype_found:
+      raise ValueError("Couldn't find a correct DOCTYPE in the bookmark file (wrong format?)")
+    if pending_bmk is not None:
+      # a bookmark is only complete once we know whether the next
+      # line is a note attached to it
+      if line.startswith(BOOKMARK_NOTE_PREFIX):
+        pending_bmk["note"] = line[4:].strip()
+        yield pending_bmk
+        pending_bmk = None
+        continue
+      yield pending_bmk
+      pending_bmk = None
     if line.startswith(BOOKMARK_LINE_PREFIX):
-      # we will successively apply the various regexes until we get
-      # all the bookmark's info
-      m = RE_BOOKMARK_URL.search(line)
+      m = RE_BOOKMARK_LINE.search(line)
       if not m:
         # No url => skip this line
         continue
-      bmk = {"url":m.group("url")}
-      for cpnt_name,cpnt_re in RE_BOOKMARK_COMPONENTS.items():
-        m = cpnt_re.search(line)
-        if m: bmk[cpnt_name] = m.group(cpnt_name)
-      bookmark_list.append(bmk)
-      last_line_is_bmk = True
-    elif last_line_is_bmk and line.startswith(BOOKMARK_NOTE_PREFIX):
-      last_line_is_bmk = False
-      bookmark_list[-1]["note"] = line[4:].strip()
-    else:
-      last_line_is_bmk = False
-  return bookmark_list
+      pending_bmk = dict((k,v) for k,v in m.groupdict().items()
+                         if v is not None)
+  if pending_bmk is not None:
+    yield pending_bmk
+
 
-def expand_url(url):
+def parse_netscape_bookmarks(bookmarkHTMFile):
+  """Extract bookmarks and return them in a list of dictionaries formatted in the following way:
+  [ {"url":"http://...", "title":"the title", "private":"0"/"1", "tags":"tag1,tag2,...", "posix_timestamp"="<unix time>", "note":"description"}]
+  Raise a ValueError if the format is wrong.
+  """
+  return list(iter_netscape_bookmarks(bookmarkHTMFile.splitlines()))
+
+def build_url_opener():
   opener = urllib2.build_opener()
   opener.addheaders = [('User-agent', 'netscape_bookmarks.py')]
+  return opener
+
+
+def expand_url(url,opener=None):
+  """Follow the redirections from url and return the final url (or
+  url itself in case of error)."""
+  if opener is None:
+    opener = build_url_opener()
   initial_url = url
   new_url = None
   while new_url != url:
@@ -126,7 +152,7 @@ def expand_url(url):
       url = new_url
     try:
       res = opener.open(url)
-      if str(res.getcode())[0] in (5,4):
+      if str(res.getcode())[0] in ("5","4"):
         # something bad happened, reutrn the url as is
         print "Keeping url %s as is because of an HTTP error %s" % (initial_url,res.getcode())
         return initial_url
@@ -141,57 +167,163 @@ def expand_url(url):
       return initial_url
     new_url = res.geturl()
   return url
+
+
+class ExpandedURLCache:
+  """Short->long url mappings that can be saved in a JSON file to be
+  reused across runs."""
+  
+  def __init__(self,path=None):
+    self.path = path
+    self.mappings = {}
+    self.lock = threading.Lock()
+    if path and os.path.exists(path):
+      with open(path) as cache_file:
+        self.mappings = json.load(cache_file)
+
+  def get(self,url,default=None):
+    return self.mappings.get(url,default)
+
+  def __contains__(self,url):
+    return url in self.mappings
+
+  def __len__(self):
+    return len(self.mappings)
+  
+  def set(self,url,expanded_url):
+    with self.lock:
+      self.mappings[url] = expanded_url
+
+  def save(self):
+    """Write the mappings in the cache file (atomically so that a
+    concurrent reader never sees a partial file)."""
+    if not self.path:
+      return
+    with self.lock:
+      tmp_path = self.path+".tmp"
+      with open(tmp_path,"w") as cache_file:
+        json.dump(self.mappings,cache_file)
+      os.rename(tmp_path,self.path)
+
+
+def expand_urls(urls,cache=None,num_threads=8,max_connections_per_host=2,
+                expand_func=expand_url):
+  """Expand the urls with a pool of threads and return a dictionary
+  mapping each url to its expanded version.
+
+  Each distinct url is expanded only once and only if it is not
+  already in the cache (the cache is updated with the new
+  expansions). No more than max_connections_per_host urls of a same
+  host will be expanded at the same time.
+  """
+  if cache is None:
+    cache = ExpandedURLCache()
+  expanded_urls = {}
+  urls_to_expand = set()
+  for url in urls:
+    if url in cache:
+      expanded_urls[url] = cache.get(url)
+    else:
+      urls_to_expand.add(url)
+  if not urls_to_expand:
+    return expanded_urls
+  host_semaphores = dict(
+    (host,threading.BoundedSemaphore(max_connections_per_host))
+    for host in set(urlparse.urlparse(u).netloc for u in urls_to_expand))
+  # one opener per thread
+  thread_data = threading.local()
+  def expand(url):
+    opener = getattr(thread_data,"opener",None)
+    if opener is None:
+      opener = thread_data.opener = build_url_opener()
+    with host_semaphores[urlparse.urlparse(url).netloc]:
+      return url,expand_func(url,opener)
+  from multiprocessing.pool import ThreadPool
+  pool = ThreadPool(min(num_threads,len(urls_to_expand)))
+  try:
+    for url,expanded_url in pool.imap_unordered(expand,urls_to_expand):
+      cache.set(url,expanded_url)
+      expanded_urls[url] = expanded_url
+  finally:
+    pool.close()
+    pool.join()
+  return expanded_urls
+
   
-def expand_short_urls(bookmarkHTMFile,outputFile):
-  """Filter the bookmark file in such a way that the shortened url are expanded.""" 
+def expand_short_urls(bookmarkHTMFile,outputFile,cache=None,num_threads=8,
+                      max_connections_per_host=2,expand_func=expand_url):
+  """Filter the bookmark file in such a way that the shortened url are expanded.
+
+  The lines are processed by blocks whose urls are expanded in
+  parallel (see expand_urls).
+  """
   correct_doctype_found = False
   outputLines = []
-  for line in bookmarkHTMFile:
-    line = line.lstrip()
-    if line.startswith("<!DOCTYPE NETSCAPE-Bookmark-file-1>"):
-      correct_doctype_found = True
-    if not line and not correct_doctype_found:
-      raise ValueError("Couldn't find a correct DOCTYPE in the bookmark file (wrong format?)")
-    if line.startswith(BOOKMARK_LINE_PREFIX):
-      # we will successively apply the various regexes until we get
-      # all the bookmark's info
+  def flush():
+    urls = [m.group("url") for m in (RE_BOOKMARK_URL.search(l)
+                                     for l in outputLines
+                                     if l.startswith(BOOKMARK_LINE_PREFIX))
+            if m]
+    expanded_urls = expand_urls(urls,cache,num_threads,
+                                max_connections_per_host,expand_func)
+    for i,line in enumerate(outputLines):
+      if not line.startswith(BOOKMARK_LINE_PREFIX):
+        continue
       m = RE_BOOKMARK_URL.search(line)
       if m:
         bmk_url = m.group("url")
-        expanded_url = expand_url(bmk_url)
-        # if bmk_url != expanded_url:
-        #   print "Expanding %s to %s" % (bmk_url, expanded_url)
+        expanded_url = expanded_urls[bmk_url]
         line = line.replace(bmk_url,expanded_url)
         # specific line for Delicous export that have several "None"
         # titled links when the link has itself been extracted from twitter.
         if "from twitter" in line:
           line = line.replace(">None</A>",">%s</A>" % expanded_url)
+        outputLines[i] = line
+    outputFile.write("".join(outputLines))
+    del outputLines[:]
+    if cache is not None:
+      cache.save()
+  for line in bookmarkHTMFile:
+    line = line.lstrip()
+    if line.startswith("<!DOCTYPE NETSCAPE-Bookmark-file-1>"):
+      correct_doctype_found = True
+    if not line and not correct_doctype_found:
+      raise ValueError("Couldn't find a correct DOCTYPE in the bookmark file (wrong format?)")
+    if not line.endswith("\n"):
+      line += "\n"
     outputLines.append(line)
     if len(outputLines)==1000:
-      print "flush %s" % outputLines[0]
-      outputFile.write("\n".join(outputLines))
-      del outputLines[:]
-  outputFile.write("\n".join(outputLines))
+      print "flush %s" % outputLines[0].rstrip()
+      flush()
+  flush()
 
   
   
 if __name__ == '__main__':
   USAGE = """\
 USAGE: netscape_bookmarks.py PRINT bookmarkfilepath.html
-    or netscape_bookmarks.py EXPAND  bookmarkfilepath.html
+    or netscape_bookmarks.py EXPAND  bookmarkfilepath.html [cachefilepath.json]
 In the second case a new file is created called bookmarkfilepath_expanded.html
-"""
-  if len(sys.argv) !=3:
+and the expanded urls are saved in the cache file (%s by default)
+to be reused by later runs.
+""" % DEFAULT_EXPANDED_URL_CACHE
+  if len(sys.argv) not in (3,4):
     print USAGE
     sys.exit(2)
   if sys.argv[1]=="PRINT":
-    bookmarks = parse_netscape_bookmarks(open(sys.argv[2], 'r+').read())
-    print "Found %d bookmarks" % len(bookmarks)
-    for b in bookmarks:
+    num_bookmarks = 0
+    for b in iter_netscape_bookmarks(open(sys.argv[2], 'r')):
       print "  - %s: %s (%s)" % (b.get("title","<no title>"), b["url"], b.get("note",""))
+      num_bookmarks += 1
+    print "Found %d bookmarks" % num_bookmarks
   elif sys.argv[1]=="EXPAND":
     input_file_path = os.path.abspath(sys.argv[2])
     input_path,input_ext = os.path.splitext(input_file_path)
     new_file_path = input_path+"_expanded"+input_ext
-    expand_short_urls(open(input_file_path,"r+"),open(new_file_path,"w"))
+    if len(sys.argv)==4:
+      cache_file_path = sys.argv[3]
+    else:
+      cache_file_path = os.path.expanduser(DEFAULT_EXPANDED_URL_CACHE)
+    cache = ExpandedURLCache(cache_file_path)
+    expand_short_urls(open(input_file_path,"r+"),open(new_file_path,"w"),cache)
     print "Bookmarks file with expanded short urls is at %s" % new_file_path
@@ -40,7 +40,12 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 """
 
-from xml.etree import ElementTree
+try:
+  from xml.etree import cElementTree as ElementTree
+except ImportError:
+  from xml.etree import ElementTree
+from cStringIO import StringIO
+
 
 class Feed:
 
@@ -55,71 +60,111 @@ class Feed:
   
 def warning(txt):
   print "WARNING: " + txt
-  
+
+
+# What to do with the children of an element met during the parsing.
+IGNORE_CHILDREN  = 0
+BODY_CHILDREN    = 1
+OUTLINE_CHILDREN = 2
+
 
 def parse_opml(opml_file,isPath=True):
-  if isPath:
-    tree = ElementTree.parse(opml_file)
-    root = tree.getroot()
-  else:
-    root = ElementTree.fromstring(opml_file)
+  """Return the set of feeds and the set of tags found in the OPML file.
+
+  The file is read in a streaming fashion (via iterparse) and the
+  elements are discarded as soon as they have been processed so that
+  big files can be parsed in a reasonable time and memory.
+  """
+  if not isPath:
+    if isinstance(opml_file,unicode):
+      opml_file = opml_file.encode("utf-8")
+    opml_file = StringIO(opml_file)
+  collected_feeds = {}
+  collected_tags = set()
+  # Stack of (element,what to do with its children,tags of the
+  # children) for all the currently open elements.
+  open_elements = []
+  body_found = False
+  for event,elem in ElementTree.iterparse(opml_file,events=("start","end")):
+    if event == "end":
+      open_elements.pop()
+      elem.clear()
+      if open_elements:
+        # all the previous siblings have been processed too
+        del open_elements[-1][0][:]
+      continue
+    if not open_elements:
+      check_opml_root(elem)
+      open_elements.append((elem,BODY_CHILDREN,None))
+      continue
+    _,parent_children,parent_tags = open_elements[-1]
+    children = IGNORE_CHILDREN
+    tags = None
+    if parent_children == BODY_CHILDREN:
+      if elem.tag == "body" and not body_found:
+        body_found = True
+        children = OUTLINE_CHILDREN
+        tags = set()
+    elif parent_children == OUTLINE_CHILDREN:
+      children,tags = parse_outline(elem,parent_tags,
+                                    collected_feeds,collected_tags)
+    open_elements.append((elem,children,tags))
+  return set(collected_feeds.values()),collected_tags
+
+
+def check_opml_root(root):
   if root.tag != "opml":
     raise RuntimeError("Not an opml file (expected <opml >root tag but found <%s>)" % root.tag)
   opml_version = root.attrib.get("version",None)
   if opml_version is None or opml_version[0] not in ("1","2"):
     raise RuntimeError("Unhandled opml version: %s"% opml_version)
-  opml_body = root.find("body")
-  current_tags = set()
-  collected_feeds = set()
-  collected_tags = set()
-  parse_outlines(opml_body,current_tags,collected_feeds,collected_tags)
-  return collected_feeds,collected_tags
 
-  
-def parse_outlines(parent_tag,current_tags,collected_feeds,collected_tags):
-  for outline in parent_tag:
-    if outline.tag != "outline":
-      warning("Ignoring tag that is not an <outline> but a <%s>" % outline.tag)
-      continue
-    outline_text = outline.attrib.get("text",None)
-    if outline_text is None:
-      warning("Ignoring attributes of an outline tag who has no text: %s" % outline_text)
-      new_current_tags = current_tags.copy()
-      parse_outlines(outline,new_current_tags,collected_feeds,collected_tags)
-    elif "xmlUrl" not in outline.attrib:
-      if outline.attrib.get("type",None) in ("rss","atom"):
-        warning("Ignoring attributes of an outline tag who has no xmlUrl attribute but looks like a feed anyway: %s" % outline.attrib)
-      else:
-        # here we use the outline text as a tag
-        new_current_tags = current_tags.copy()
-        text_as_tag = outline.attrib.get("text")
-        if text_as_tag:
-          new_current_tags.add(text_as_tag)
-        parse_outlines(outline,new_current_tags,collected_feeds,collected_tags)
-    else:
-      # this is most probably a feed's link, so let's process it as one
-      current_xmlUrl = outline.attrib["xmlUrl"]
-      current_feed = None
-      for previousFeed in collected_feeds:
-        if previousFeed.xmlUrl == current_xmlUrl:
-          current_feed = previousFeed
-          break
-      if current_feed is None:
-        current_feed = Feed()
-        current_feed.xmlUrl = current_xmlUrl
-        # TODO check the conformity of these attributes in the case
-        # when a previousFeed with the same xmlUrl has been found
-        current_feed.title = outline.attrib["text"]
-        current_feed.htmlUrl = outline.attrib.get("htmlUrl",None)
-      category_as_txt = outline.attrib.get("category","")
-      if category_as_txt:
-        category = category_as_txt.split(",")
-      else:
-        category = []
-      current_feed.tags |= current_tags.union(category)
-      # update the list of tags
-      collected_tags.update(current_feed.tags)
-      collected_feeds.add(current_feed)
+
+def parse_outline(outline,current_tags,collected_feeds,collected_tags):
+  """Process an element found among the outlines of the body.
+
+  collected_feeds: a dictionary mapping each xmlUrl to the
+  corresponding Feed instance.
+
+  Return what should be done with the outline's children and the tags
+  to be applied to them.
+  """
+  if outline.tag != "outline":
+    warning("Ignoring tag that is not an <outline> but a <%s>" % outline.tag)
+    return IGNORE_CHILDREN,None
+  outline_text = outline.attrib.get("text",None)
+  if outline_text is None:
+    warning("Ignoring attributes of an outline tag who has no text: %s" % outline_text)
+    return OUTLINE_CHILDREN,current_tags.copy()
+  elif "xmlUrl" not in outline.attrib:
+    if outline.attrib.get("type",None) in ("rss","atom"):
+      warning("Ignoring attributes of an outline tag who has no xmlUrl attribute but looks like a feed anyway: %s" % outline.attrib)
+      return IGNORE_CHILDREN,None
+    # here we use the outline text as a tag
+    new_current_tags = current_tags.copy()
+    if outline_text:
+      new_current_tags.add(outline_text)
+    return OUTLINE_CHILDREN,new_current_tags
+  # this is most probably a feed's link, so let's process it as one
+  current_xmlUrl = outline.attrib["xmlUrl"]
+  current_feed = collected_feeds.get(current_xmlUrl)
+  if current_feed is None:
+    current_feed = Feed()
+    current_feed.xmlUrl = current_xmlUrl
+    # TODO check the conformity of these attributes in the case
+    # when a previousFeed with the same xmlUrl has been found
+    current_feed.title = outline_text
+    current_feed.htmlUrl = outline.attrib.get("htmlUrl",None)
+    collected_feeds[current_xmlUrl] = current_feed
+  category_as_txt = outline.attrib.get("category","")
+  if category_as_txt:
+    category = category_as_txt.split(",")
+  else:
+    category = []
+  current_feed.tags |= current_tags.union(category)
+  # update the list of tags
+  collected_tags.update(current_feed.tags)
+  return IGNORE_CHILDREN,None
 
 
 
@@ -23,8 +23,12 @@ from django.contrib import admin
 from wom_user.models import UserProfile
 from wom_user.models import UserBookmark
 from wom_user.models import ReferenceUserStatus
+from wom_user.models import UserSourceTag
+from wom_user.models import Job
 
 admin.site.register(UserProfile)
 admin.site.register(UserBookmark)
 admin.site.register(ReferenceUserStatus)
+admin.site.register(UserSourceTag)
+admin.site.register(Job)
 
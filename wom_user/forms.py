@@ -32,9 +32,11 @@ from wateronmars import settings
 from wom_pebbles.models import URL_MAX_LENGTH
 from wom_pebbles.models import REFERENCE_TITLE_MAX_LENGTH
 from wom_pebbles.models import Reference
+from wom_pebbles.models import get_reference_by_url
 from wom_pebbles.tasks import build_reference_title_from_url
 from wom_pebbles.tasks import build_source_url_from_reference_url
 from wom_pebbles.tasks import sanitize_url
+from wom_pebbles.templatetags.html_sanitizers import sanitize_html
 
 from wom_river.models import WebFeed
 
@@ -42,8 +44,6 @@ from wom_user.models import UserProfile
 from wom_user.models import UserBookmark
 from wom_user.models import ReferenceUserStatus
 
-from wom_river.utils import feedfinder
-feedfinder.setUserAgent(settings.USER_AGENT)
 
 
 class OPMLFileUploadForm(forms.Form):
@@ -114,7 +114,7 @@ class UserBookmarkAdditionForm(forms.Form):
                or build_reference_title_from_url(src_url)
     # Find or create a matching reference
     try:
-      bookmarked_ref = Reference.objects.get(url=url)
+      bookmarked_ref = get_reference_by_url(url)
       # Arbitrarily chose one of the possible sources
       src_query = bookmarked_ref.sources
       if src_query.count() > 1:
@@ -123,7 +123,7 @@ class UserBookmarkAdditionForm(forms.Form):
         ref_src = src_query.get()
     except ObjectDoesNotExist:
       try:
-        ref_src = Reference.objects.get(url=src_url)
+        ref_src = get_reference_by_url(src_url)
       except ObjectDoesNotExist:
         ref_src = Reference(url=src_url,title=src_title,pub_date=pub_date)
         ref_src.save()
@@ -169,6 +169,15 @@ class UserBookmarkAdditionForm(forms.Form):
     return bmk
 
 
+def get_feedfinder():
+  """Return the feedfinder module, imported (with its sgmllib,
+  robotparser and xmlrpclib dependencies) on first use only.
+  """
+  from wom_river.utils import feedfinder
+  feedfinder.setUserAgent(settings.USER_AGENT)
+  return feedfinder
+
+
 class UserSourceAdditionForm(forms.Form):
   """Collect all necessary data to subscribe to a new source."""
 
@@ -194,6 +203,7 @@ class UserSourceAdditionForm(forms.Form):
     if not url:
       raise forms.ValidationError("The source URL is required.")
     feed_url = cleaned_data.get("feed_url")
+    feedfinder = get_feedfinder()
     if feed_url and feedfinder.isFeed(feed_url.encode("utf-8"),checkRobotAllowed=False):
       return cleaned_data
     if feedfinder.isFeed(url.encode("utf-8"),checkRobotAllowed=False):
@@ -247,11 +257,19 @@ class UserSourceAdditionForm(forms.Form):
     form_url,_ = sanitize_url(self.cleaned_data["url"])
     form_title = self.cleaned_data["title"]
     form_feed_url,_ = sanitize_url(self.cleaned_data["feed_url"])
-    if self.user.userprofile.web_feeds.filter(source__url=form_url).exists():
+    try:
+      source_ref = get_reference_by_url(form_url)
+    except ObjectDoesNotExist:
+      source_ref = None
+    if source_ref is not None \
+       and self.user.userprofile.web_feeds.filter(source=source_ref).exists():
       # nothing to do
       return
     # try a bigger look-up anyway
-    same_sources = WebFeed.objects.filter(source__url=form_url).all()
+    if source_ref is not None:
+      same_sources = WebFeed.objects.filter(source=source_ref).all()
+    else:
+      same_sources = []
     # url are unique for sources
     if same_sources:
       new_feed = same_sources[0]
@@ -260,9 +278,7 @@ class UserSourceAdditionForm(forms.Form):
         source_title = form_title
       else:
         source_title = build_reference_title_from_url(form_url)
-      try:
-        source_ref = Reference.objects.get(url=form_url)
-      except ObjectDoesNotExist:
+      if source_ref is None:
         source_ref = Reference(url=form_url,title=source_title,
                                pub_date=datetime.now(timezone.utc))
         source_ref.save()
@@ -286,6 +302,11 @@ class ReferenceEditForm(ModelForm):
     model = Reference
     fields = ("title", "description", "pub_date")
 
+  def save(self, *args, **kwargs):
+    self.instance.sanitized_description = sanitize_html(
+      self.instance.description)
+    return super(ReferenceEditForm,self).save(*args, **kwargs)
+
 
 class UserBookmarkEditForm(ModelForm):
   """Designed to modify a bookmark."""
@@ -0,0 +1,407 @@
+# -*- coding: utf-8; indent-tabs-mode: nil; python-indent: 2 -*-
+#
+# Copyright 2013 Thibauld Nion
+#
+# This file is part of WaterOnMars (https://github.com/tibonihoo/wateronmars) 
+#
+# WaterOnMars is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# WaterOnMars is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with WaterOnMars.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+"""
+A minimal task queue stored in the Job table, used in place of celery
+to run the tasks of wom_user.tasks out of the web requests (see the
+wom_worker command).
+"""
+
+import os
+import socket
+import base64
+import threading
+import traceback
+import cPickle as pickle
+from datetime import timedelta
+
+from django.db import connection
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.importlib import import_module
+
+from wom_user.models import Job
+
+from wom_user.settings import JOB_MAX_ATTEMPTS
+from wom_user.settings import JOB_RETRY_DELAY
+from wom_user.settings import JOB_HEARTBEAT_TIMEOUT
+from wom_user.settings import JOB_HISTORY
+from wom_user.settings import WORKER_CONCURRENCY
+from wom_user.settings import WORKER_POLL_INTERVAL
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# The task functions, by name
+TASKS = {}
+
+# The schedules of the periodic tasks, by name
+PERIODIC_TASKS = {}
+
+# Number of due jobs a worker tries to claim before giving up (when
+# other workers claim them first)
+CLAIM_CANDIDATES = 10
+
+# Keep track of the job run by each thread
+_current = threading.local()
+
+
+def parse_crontab_field(spec,min_value,max_value):
+  """Return the set of values matched by a crontab field like "*",
+  "*/20", "0,30" or "8-18/2"."""
+  values = set()
+  for part in str(spec).split(","):
+    step = 1
+    if "/" in part:
+      part,step = part.split("/")
+      step = int(step)
+    if part=="*":
+      start,end = min_value,max_value
+    elif "-" in part:
+      start,end = [int(v) for v in part.split("-")]
+    else:
+      start = int(part)
+      end = max_value if step>1 else start
+    values.update(range(start,end+1,step))
+  return values
+
+
+class crontab(object):
+  """A schedule matching the same dates as celery's crontab (days of
+  the week start with 0 for Sunday), evaluated in UTC."""
+
+  def __init__(self,minute="*",hour="*",day_of_week="*"):
+    self.minutes = parse_crontab_field(minute,0,59)
+    self.hours = parse_crontab_field(hour,0,23)
+    self.days_of_week = parse_crontab_field(day_of_week,0,6)
+
+  def next_after(self,date):
+    """Return the first date of the schedule strictly after the given one."""
+    date = date.replace(second=0,microsecond=0)+timedelta(minutes=1)
+    while True:
+      if (date.weekday()+1)%7 not in self.days_of_week:
+        date = date.replace(hour=0,minute=0)+timedelta(days=1)
+      elif date.hour not in self.hours:
+        date = date.replace(minute=0)+timedelta(hours=1)
+      elif date.minute not in self.minutes:
+        date += timedelta(minutes=1)
+      else:
+        return date
+
+
+def get_task_name(func):
+  return "%s.%s" % (func.__module__,func.__name__)
+
+
+def task(max_attempts=None,**options):
+  """Register the decorated function as a task (the other options of
+  celery's decorator are accepted and ignored).
+
+  The function can still be called directly and gets a 'delay' method
+  that enqueues a call to be run by a worker instead.
+  """
+  def wrap(func):
+    name = get_task_name(func)
+    TASKS[name] = func
+    def delay(*args,**kwargs):
+      return enqueue(name,args,kwargs,max_attempts=max_attempts)
+    func.delay = delay
+    return func
+  return wrap
+
+
+def periodic_task(run_every,max_attempts=None,**options):
+  """Register the decorated function as a task that the workers run
+  according to the 'run_every' crontab."""
+  def wrap(func):
+    func = task(max_attempts=max_attempts)(func)
+    PERIODIC_TASKS[get_task_name(func)] = run_every
+    return func
+  return wrap
+
+
+def get_task(name):
+  if name not in TASKS:
+    # tasks are registered when their module is imported
+    import_module(name.rsplit(".",1)[0])
+  return TASKS[name]
+
+
+def enqueue(name,args=(),kwargs=None,run_after=None,max_attempts=None,
+            unique=False,owner=None):
+  """Add a job calling the task of the given name and return it.
+
+  If unique is True and a job of the same task is already queued or
+  running, this job is returned instead (whatever its arguments).
+
+  owner: the user on behalf of whom the job is run, who will be
+  allowed to check its progress.
+  """
+  if unique:
+    pending = list(Job.objects.filter(name=name,
+                                      status__in=(Job.QUEUED,Job.RUNNING))\
+                   .order_by("id")[:1])
+    if pending:
+      return pending[0]
+  arguments = base64.b64encode(pickle.dumps((tuple(args),kwargs or {}),
+                                            pickle.HIGHEST_PROTOCOL))
+  return Job.objects.create(name=name,arguments=arguments,
+                            run_after=run_after or timezone.now(),
+                            max_attempts=max_attempts or JOB_MAX_ATTEMPTS,
+                            owner=owner)
+
+
+def claim_next_job(worker_id):
+  """Mark the next due job as running on behalf of the given worker and
+  return it, or return None if there is no job to run."""
+  now = timezone.now()
+  candidate_ids = Job.objects.filter(status=Job.QUEUED,run_after__lte=now)\
+                             .order_by("run_after","id")\
+                             .values_list("id",flat=True)[:CLAIM_CANDIDATES]
+  for job_id in list(candidate_ids):
+    # the status filter makes sure that no other worker claimed it first
+    claimed = Job.objects.filter(id=job_id,status=Job.QUEUED)\
+                         .update(status=Job.RUNNING,started_date=now,
+                                 heartbeat_date=now,worker=worker_id,
+                                 attempts=F("attempts")+1)
+    if claimed:
+      return Job.objects.get(id=job_id)
+  return None
+
+
+def run_job(job):
+  """Run a claimed job and record its outcome, a failed job being queued
+  again (after an exponentially growing delay) as long as it has
+  attempts left.
+
+  The outcome is only recorded if the job hasn't been claimed again in
+  the meantime (after its worker was considered dead).
+
+  Return the new status of the job.
+  """
+  outcome = {}
+  _current.job = job
+  try:
+    args,kwargs = pickle.loads(base64.b64decode(job.arguments))
+    get_task(job.name)(*args,**kwargs)
+  except Exception:
+    transaction.rollback_unless_managed()
+    outcome["last_error"] = traceback.format_exc()
+    if job.attempts<job.max_attempts:
+      outcome["status"] = Job.QUEUED
+      outcome["run_after"] = timezone.now()\
+                             +JOB_RETRY_DELAY*2**(job.attempts-1)
+      logger.warning("Job %s failed, will retry (%s)" \
+                     % (job,outcome["last_error"]))
+    else:
+      outcome["status"] = Job.FAILED
+      outcome["finished_date"] = timezone.now()
+      logger.error("Job %s failed (%s)" % (job,outcome["last_error"]))
+  else:
+    outcome["status"] = Job.DONE
+    outcome["finished_date"] = timezone.now()
+  finally:
+    _current.job = None
+  recorded = Job.objects.filter(id=job.id,status=Job.RUNNING,
+                                worker=job.worker,attempts=job.attempts)\
+                        .update(**outcome)
+  if not recorded:
+    logger.warning("Job %s was claimed again while running, its outcome "
+                   "(%s) is discarded" % (job,outcome["status"]))
+    return None
+  for name,value in outcome.items():
+    setattr(job,name,value)
+  return job.status
+
+
+def get_current_job():
+  """Return the job run by the current thread or None when the task is
+  called directly."""
+  return getattr(_current,"job",None)
+
+
+def report_progress(processed,total=None):
+  """Record the number of items processed by the job run by the current
+  thread (out of total items if known), if any."""
+  job = get_current_job()
+  if job is None:
+    return
+  job.processed = processed
+  job.total = max(total,processed) if total is not None else processed
+  Job.objects.filter(id=job.id,status=Job.RUNNING,worker=job.worker,
+                     attempts=job.attempts)\
+             .update(processed=job.processed,total=job.total)
+
+
+def run_pending_jobs(worker_id=None):
+  """Run the due jobs one after the other until there is none left and
+  return the number of jobs run."""
+  worker_id = worker_id or get_worker_id()
+  count = 0
+  job = claim_next_job(worker_id)
+  while job is not None:
+    run_job(job)
+    count += 1
+    job = claim_next_job(worker_id)
+  return count
+
+
+def beat(worker_ids,now=None):
+  """Show that the given workers are alive by updating the heartbeat of
+  the jobs they are running."""
+  Job.objects.filter(status=Job.RUNNING,worker__in=worker_ids)\
+             .update(heartbeat_date=now or timezone.now())
+
+
+class Heartbeat(object):
+  """Context manager beating for the given workers in a background
+  thread, every 'interval' seconds, while its block runs."""
+
+  def __init__(self,worker_ids,interval=None):
+    self.worker_ids = worker_ids
+    self.interval = interval or WORKER_POLL_INTERVAL
+    self.stopping = threading.Event()
+    self.thread = threading.Thread(target=self.run)
+    self.thread.daemon = True
+
+  def run(self):
+    try:
+      while not self.stopping.is_set():
+        try:
+          beat(self.worker_ids)
+        except Exception:
+          logger.exception("Could not update the jobs' heartbeat")
+        self.stopping.wait(self.interval)
+    finally:
+      connection.close()
+
+  def __enter__(self):
+    self.thread.start()
+    return self
+
+  def __exit__(self,exc_type,exc_value,traceback):
+    self.stopping.set()
+    self.thread.join()
+
+
+def schedule_periodic_tasks(now=None):
+  """Make sure that each periodic task has a job queued for its next
+  run and return the number of jobs added."""
+  now = now or timezone.now()
+  pending_names = set(Job.objects.filter(name__in=PERIODIC_TASKS.keys(),
+                                         status__in=(Job.QUEUED,Job.RUNNING))\
+                      .values_list("name",flat=True))
+  count = 0
+  for name,schedule in PERIODIC_TASKS.items():
+    if name not in pending_names:
+      enqueue(name,run_after=schedule.next_after(now))
+      count += 1
+  return count
+
+
+def requeue_stale_jobs(now=None):
+  """Queue again the running jobs whose worker died (ie that have had
+  no heartbeat for longer than JOB_HEARTBEAT_TIMEOUT), or mark them as
+  failed when they have no attempt left, and return the number of jobs
+  queued again."""
+  now = now or timezone.now()
+  stale_qs = Job.objects.filter(status=Job.RUNNING,
+                                heartbeat_date__lt=now-JOB_HEARTBEAT_TIMEOUT)
+  stale_qs.filter(attempts__gte=F("max_attempts"))\
+          .update(status=Job.FAILED,finished_date=now,
+                  last_error="Timed out")
+  return stale_qs.update(status=Job.QUEUED,run_after=now)
+
+
+def delete_old_jobs(now=None):
+  """Delete the jobs finished since longer than JOB_HISTORY."""
+  now = now or timezone.now()
+  Job.objects.filter(status__in=(Job.DONE,Job.FAILED),
+                     finished_date__lt=now-JOB_HISTORY).delete()
+
+
+def get_worker_id():
+  return "%s:%d" % (socket.gethostname(),os.getpid())
+
+
+class Worker(object):
+  """Run the due jobs in several threads while keeping the periodic
+  tasks scheduled, until stop is called.
+
+  The running jobs' heartbeat is updated every poll interval, so that
+  other workers don't take them for the jobs of a dead worker.
+
+  NOTE: a single worker process should be running at a time, since
+  several of them would schedule the periodic tasks concurrently.
+  """
+
+  def __init__(self,concurrency=None,poll_interval=None):
+    self.concurrency = concurrency or WORKER_CONCURRENCY
+    self.poll_interval = poll_interval or WORKER_POLL_INTERVAL
+    self.stopping = threading.Event()
+
+  def get_thread_worker_id(self,thread_index):
+    return "%s/%d" % (get_worker_id(),thread_index)
+    
+  def run_jobs(self,thread_index):
+    worker_id = self.get_thread_worker_id(thread_index)
+    try:
+      while not self.stopping.is_set():
+        try:
+          job = claim_next_job(worker_id)
+          if job is not None:
+            run_job(job)
+        except Exception:
+          logger.exception("Worker %s could not run a job" % worker_id)
+          job = None
+        if job is None:
+          self.stopping.wait(self.poll_interval)
+    finally:
+      connection.close()
+
+  def run(self):
+    threads = [threading.Thread(target=self.run_jobs,args=(i,))
+               for i in range(self.concurrency)]
+    worker_ids = [self.get_thread_worker_id(i)
+                  for i in range(self.concurrency)]
+    for t in threads:
+      t.daemon = True
+      t.start()
+    try:
+      while not self.stopping.is_set():
+        try:
+          beat(worker_ids)
+          requeue_stale_jobs()
+          delete_old_jobs()
+          schedule_periodic_tasks()
+        except Exception:
+          logger.exception("Could not schedule the periodic tasks")
+        self.stopping.wait(self.poll_interval)
+    finally:
+      # let the running jobs finish
+      self.stop()
+      for t in threads:
+        t.join()
+
+  def stop(self):
+    self.stopping.set()
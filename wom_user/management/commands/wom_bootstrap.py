@@ -0,0 +1,32 @@
+# -*- coding: utf-8; indent-tabs-mode: nil; python-indent: 2 -*-
+#
+# Copyright 2013 Thibauld Nion
+#
+# This file is part of WaterOnMars (https://github.com/tibonihoo/wateronmars) 
+#
+# WaterOnMars is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# WaterOnMars is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with WaterOnMars.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+from django.core.management.base import BaseCommand
+
+import wateronmars.startup as startup
+
+
+class Command(BaseCommand):
+  help = "Run the startup tasks (like the setup of the demo user in DEMO mode) if they haven't been run yet on the database, so that the web workers don't have to."
+
+  def handle(self, *args, **options):
+    startup.run(force=True)
+    self.stdout.write("Startup tasks done.\n")
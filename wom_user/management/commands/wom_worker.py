@@ -0,0 +1,64 @@
+# -*- coding: utf-8; indent-tabs-mode: nil; python-indent: 2 -*-
+#
+# Copyright 2013 Thibauld Nion
+#
+# This file is part of WaterOnMars (https://github.com/tibonihoo/wateronmars) 
+#
+# WaterOnMars is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# WaterOnMars is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with WaterOnMars.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from wom_user.settings import WORKER_CONCURRENCY
+from wom_user.settings import WORKER_POLL_INTERVAL
+
+
+class Command(BaseCommand):
+  help = "Run the background tasks queued in the database and schedule the periodic ones (unless celery is used)."
+
+  option_list = BaseCommand.option_list + (
+    make_option("--concurrency", type="int", default=WORKER_CONCURRENCY,
+                help="Number of jobs run at the same time."),
+    make_option("--poll-interval", type="float", dest="poll_interval",
+                default=WORKER_POLL_INTERVAL,
+                help="Seconds to wait before looking for new jobs when the queue is empty."),
+    make_option("--once", action="store_true", default=False,
+                help="Run the jobs that are due and exit (eg to be called by cron)."),
+    )
+
+  def handle(self, *args, **options):
+    if settings.USE_CELERY:
+      raise CommandError("Background tasks are run by celery (USE_CELERY is set).")
+    # importing the tasks registers them (and their schedules)
+    import wom_user.tasks
+    import wom_user.jobs as jobs
+    if options["once"]:
+      jobs.requeue_stale_jobs()
+      jobs.schedule_periodic_tasks()
+      worker_id = jobs.get_worker_id()
+      with jobs.Heartbeat([worker_id],options["poll_interval"]):
+        count = jobs.run_pending_jobs(worker_id)
+      self.stdout.write("%d job(s) run.\n" % count)
+    else:
+      worker = jobs.Worker(concurrency=options["concurrency"],
+                           poll_interval=options["poll_interval"])
+      try:
+        worker.run()
+      except KeyboardInterrupt:
+        self.stdout.write("Worker stopped.\n")
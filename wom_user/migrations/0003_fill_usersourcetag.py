@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import DataMigration
+from django.db import models
+
+class Migration(DataMigration):
+
+    depends_on = (
+        ("wom_classification", "0001_initial"),
+        ("wom_river", "0001_initial"),
+    )
+
+    def forwards(self, orm):
+        "Map the tags of the users' web feeds to the feeds' sources."
+        try:
+            feed_type = orm['contenttypes.ContentType'].objects.get(
+                app_label="wom_river", model="webfeed")
+        except orm['contenttypes.ContentType'].DoesNotExist:
+            return
+        feed_tags = list(
+            orm['wom_classification.ClassificationData'].tags.through.objects\
+            .filter(classificationdata__content_type=feed_type)\
+            .values_list("classificationdata__owner",
+                         "classificationdata__object_id", "tag"))
+        feed_sources = dict(orm['wom_river.WebFeed'].objects\
+                            .values_list("id", "source"))
+        source_tags = set((owner_id, feed_sources[feed_id], tag_id)
+                          for owner_id, feed_id, tag_id in feed_tags
+                          if feed_id in feed_sources)
+        orm['wom_user.UserSourceTag'].objects.bulk_create(
+            [orm['wom_user.UserSourceTag'](owner_id=owner_id,
+                                           source_id=source_id,
+                                           tag_id=tag_id)
+             for owner_id, source_id, tag_id in source_tags])
+
+    def backwards(self, orm):
+        "Drop the precomputed associations."
+        orm['wom_user.UserSourceTag'].objects.all().delete()
+
+    models = {
+        'auth.group': {
+            'Meta': {'object_name': 'Group'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '80'}),
+            'permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'})
+        },
+        'auth.permission': {
+            'Meta': {'ordering': "('content_type__app_label', 'content_type__model', 'codename')", 'unique_together': "(('content_type', 'codename'),)", 'object_name': 'Permission'},
+            'codename': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'})
+        },
+        'auth.user': {
+            'Meta': {'object_name': 'User'},
+            'date_joined': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75', 'blank': 'True'}),
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'groups': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Group']", 'symmetrical': 'False', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'is_staff': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'is_superuser': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'last_login': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'password': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'user_permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'}),
+            'username': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '30'})
+        },
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        'wom_classification.classificationdata': {
+            'Meta': {'object_name': 'ClassificationData'},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'object_id': ('django.db.models.fields.PositiveIntegerField', [], {}),
+            'owner': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']"}),
+            'tags': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['wom_classification.Tag']", 'symmetrical': 'False'})
+        },
+        'wom_classification.tag': {
+            'Meta': {'object_name': 'Tag'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '100', 'db_index': 'True'})
+        },
+        'wom_classification.tagusage': {
+            'Meta': {'unique_together': "(('owner', 'tag', 'content_type'),)", 'object_name': 'TagUsage'},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'count': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'owner': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']"}),
+            'tag': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['wom_classification.Tag']"})
+        },
+        'wom_pebbles.reference': {
+            'Meta': {'object_name': 'Reference'},
+            'description': ('django.db.models.fields.TextField', [], {'default': "''"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'pub_date': ('django.db.models.fields.DateTimeField', [], {}),
+            'save_count': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'sources': ('django.db.models.fields.related.ManyToManyField', [], {'related_name': "'productions'", 'symmetrical': 'False', 'to': "orm['wom_pebbles.Reference']"}),
+            'title': ('django.db.models.fields.CharField', [], {'max_length': '150'}),
+            'url': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '255'})
+        },
+        'wom_river.webfeed': {
+            'Meta': {'object_name': 'WebFeed'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_update_check': ('django.db.models.fields.DateTimeField', [], {}),
+            'source': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['wom_pebbles.Reference']"}),
+            'xmlURL': ('django.db.models.fields.CharField', [], {'max_length': '255'})
+        },
+        'wom_user.referenceuserstatus': {
+            'Meta': {'object_name': 'ReferenceUserStatus'},
+            'has_been_read': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'has_been_saved': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'main_source': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'+'", 'to': "orm['wom_pebbles.Reference']"}),
+            'owner': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']"}),
+            'reference': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['wom_pebbles.Reference']"}),
+            'reference_pub_date': ('django.db.models.fields.DateTimeField', [], {})
+        },
+        'wom_user.userbookmark': {
+            'Meta': {'object_name': 'UserBookmark'},
+            'comment': ('django.db.models.fields.TextField', [], {'default': "''"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_public': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'owner': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']"}),
+            'reference': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['wom_pebbles.Reference']"}),
+            'saved_date': ('django.db.models.fields.DateTimeField', [], {})
+        },
+        'wom_user.userprofile': {
+            'Meta': {'object_name': 'UserProfile'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'owner': ('django.db.models.fields.related.OneToOneField', [], {'to': "orm['auth.User']", 'unique': 'True'}),
+            'public_sources': ('django.db.models.fields.related.ManyToManyField', [], {'related_name': "'publicly_related_userprofile'", 'symmetrical': 'False', 'to': "orm['wom_pebbles.Reference']"}),
+            'sources': ('django.db.models.fields.related.ManyToManyField', [], {'related_name': "'userprofile'", 'symmetrical': 'False', 'to': "orm['wom_pebbles.Reference']"}),
+            'web_feeds': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['wom_river.WebFeed']", 'symmetrical': 'False'})
+        },
+        'wom_user.usersourcetag': {
+            'Meta': {'unique_together': "(('owner', 'tag', 'source'),)", 'object_name': 'UserSourceTag'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'owner': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']"}),
+            'source': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'+'", 'to': "orm['wom_pebbles.Reference']"}),
+            'tag': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['wom_classification.Tag']"})
+        }
+    }
+
+    complete_apps = ['wom_classification', 'wom_user']
+    symmetrical = True
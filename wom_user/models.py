@@ -26,6 +26,20 @@ from wom_pebbles.models import Reference
 
 from wom_river.models import WebFeed
 
+from django.contrib.contenttypes.models import ContentType
+
+from django.db import transaction
+from django.db.models import Max
+from django.db.models.signals import m2m_changed
+from django.db.models.signals import post_save
+from django.db.models.signals import post_delete
+
+from django.utils import timezone
+
+from collections import defaultdict
+
+from wom_classification.models import Tag
+from wom_classification.models import ClassificationData
 from wom_classification.models import get_item_tag_names
 
 
@@ -41,11 +55,76 @@ class UserProfile(models.Model):
   sources = models.ManyToManyField(Reference,related_name="userprofile")
   # Public sources of a user bookmarks and web_feeds
   public_sources = models.ManyToManyField(Reference,related_name="publicly_related_userprofile")
+  # Last time the sources, the web_feeds selection or their tags
+  # changed (used as a validator for cached exports of the sources)
+  sources_last_modified = models.DateTimeField(default=timezone.now)
+  # Last time the bookmarks or their tags changed
+  collection_last_modified = models.DateTimeField(default=timezone.now)
+  # Last time the statuses of the news items were created, deleted or
+  # marked as read
+  news_last_modified = models.DateTimeField(default=timezone.now)
   
   def __unicode__(self):
     return "%s>Profile" % self.owner
 
 
+def touch_user_sources(**profile_filters):
+  """Mark the sources of the profiles matching the filters as modified."""
+  UserProfile.objects.filter(**profile_filters)\
+                     .update(sources_last_modified=timezone.now())
+
+
+def touch_user_collection(**profile_filters):
+  """Mark the bookmarks of the profiles matching the filters as modified."""
+  UserProfile.objects.filter(**profile_filters)\
+                     .update(collection_last_modified=timezone.now())
+
+
+def touch_user_news(**profile_filters):
+  """Mark the news statuses of the profiles matching the filters as
+  modified and return the modification date."""
+  now = timezone.now()
+  UserProfile.objects.filter(**profile_filters)\
+                     .update(news_last_modified=now)
+  return now
+
+  
+# Map the relationship tables of the profile's sources to the name of
+# the corresponding relationship
+PROFILE_SOURCES_RELATIONSHIPS = {
+  UserProfile.web_feeds.through: "web_feeds",
+  UserProfile.sources.through: "sources",
+  UserProfile.public_sources.through: "public_sources",
+  }
+
+def on_user_sources_changed(sender,instance,action,reverse,pk_set,**kwargs):
+  if action not in ("post_add","post_remove","pre_clear"):
+    return
+  if not reverse:
+    touch_user_sources(id=instance.id)
+  elif pk_set:
+    touch_user_sources(id__in=pk_set)
+  elif action=="pre_clear":
+    touch_user_sources(**{PROFILE_SOURCES_RELATIONSHIPS[sender]: instance})
+
+for relationship_table in PROFILE_SOURCES_RELATIONSHIPS:
+  m2m_changed.connect(on_user_sources_changed,sender=relationship_table)
+
+
+def on_classification_tags_changed(sender,instance,action,reverse,**kwargs):
+  if reverse or action not in ("post_add","post_remove","post_clear"):
+    return
+  if instance.content_type_id==ContentType.objects.get_for_model(WebFeed).id:
+    touch_user_sources(owner=instance.owner_id)
+    rebuild_user_source_tags(instance.owner)
+  elif instance.content_type_id==ContentType.objects\
+                                            .get_for_model(Reference).id:
+    touch_user_collection(owner=instance.owner_id)
+
+m2m_changed.connect(on_classification_tags_changed,
+                    sender=ClassificationData.tags.through)
+
+  
 class UserBookmark(models.Model):
   """This is the "personal" facette of a Reference and may contain
   stuff modified by the user.
@@ -111,6 +190,56 @@ class UserBookmark(models.Model):
     self.save()
     
     
+def add_sources_of_references_to_profile(profile,reference_ids):
+  """Add the sources of the references to the profile's (private)
+  sources with a single insert in the relationship's table.
+  """
+  source_ids = set(Reference.sources.through.objects\
+                   .filter(from_reference__in=reference_ids)\
+                   .values_list("to_reference_id",flat=True))
+  if not source_ids:
+    return
+  ProfileSources = UserProfile.sources.through
+  source_ids.difference_update(
+    ProfileSources.objects.filter(userprofile=profile,
+                                  reference__in=source_ids)\
+    .values_list("reference_id",flat=True))
+  if not source_ids:
+    return
+  ProfileSources.objects.bulk_create(
+    [ProfileSources(userprofile_id=profile.id,reference_id=src_id)
+     for src_id in source_ids])
+  touch_user_sources(id=profile.id)
+
+
+def get_visible_sources_by_reference(owner,reference_ids,public_only):
+  """Return a dictionary mapping each of the references (given by
+  their ids) to the list of its sources that are also sources of the
+  owner (only the public ones if public_only is True), with a single
+  query.
+  """
+  if public_only:
+    profile_filter = {"to_reference__publicly_related_userprofile__owner":
+                      owner}
+  else:
+    profile_filter = {"to_reference__userprofile__owner": owner}
+  sources_by_reference = defaultdict(list)
+  for link in Reference.sources.through.objects\
+                                       .filter(from_reference__in=reference_ids,
+                                               **profile_filter)\
+                                       .select_related("to_reference")\
+                                       .order_by("to_reference__title"):
+    sources_by_reference[link.from_reference_id].append(link.to_reference)
+  return dict(sources_by_reference)
+
+    
+def on_user_bookmark_changed(sender,instance,**kwargs):
+  touch_user_collection(owner=instance.owner_id)
+
+post_save.connect(on_user_bookmark_changed,sender=UserBookmark)
+post_delete.connect(on_user_bookmark_changed,sender=UserBookmark)
+
+    
 class ReferenceUserStatus(models.Model):
   """
   Mainly represents the "unread" flag: if no instance exists for a
@@ -139,3 +268,109 @@ class ReferenceUserStatus(models.Model):
   def get_tag_names(self):
     """Get the names of the tags related to this reference."""
     return get_item_tag_names(self.owner,self.reference)
+
+
+def get_user_news_marker(user):
+  """Return a value that changes whenever new items come from the
+  user's feeds, computed with a cheap query that doesn't require to
+  check all the user's feeds for unread items.
+
+  NOTE: the changes of the items' statuses are tracked by the
+  profile's news_last_modified instead.
+  """
+  return Reference.sources.through.objects\
+    .filter(to_reference__webfeed__userprofile__owner=user)\
+    .aggregate(Max("from_reference"))["from_reference__max"]
+
+  
+class UserSourceTag(models.Model):
+  """
+  Precomputed association between a tag and the source of a web feed
+  that a user has classified with this tag, used to filter the river
+  and the sieve by tag without going through the generic
+  classification data.
+  """
+  # The user who tagged the feed
+  owner = models.ForeignKey(User)
+  # The tag attributed to the feed
+  tag = models.ForeignKey(Tag)
+  # The source of the tagged feed
+  source = models.ForeignKey(Reference,related_name="+")
+
+  class Meta:
+    unique_together = (("owner","tag","source"),)
+
+  def __unicode__(self):
+    return "%s>%s: %s" % (self.owner,self.tag,self.source)
+
+
+def rebuild_user_source_tags(user):
+  """Recompute the association between the tags and the sources of the
+  web feeds classified by a given user.
+  """
+  feed_type = ContentType.objects.get_for_model(WebFeed)
+  feed_tags = list(ClassificationData.tags.through.objects\
+                   .filter(classificationdata__owner=user,
+                           classificationdata__content_type=feed_type)\
+                   .values_list("classificationdata__object_id","tag_id"))
+  feed_sources = dict(WebFeed.objects\
+                      .filter(id__in=set(f for f,_ in feed_tags))\
+                      .values_list("id","source_id"))
+  source_tags = set((feed_sources[feed_id],tag_id) \
+                    for feed_id,tag_id in feed_tags \
+                    if feed_id in feed_sources)
+  with transaction.commit_on_success():
+    UserSourceTag.objects.filter(owner=user).delete()
+    UserSourceTag.objects.bulk_create(
+      [UserSourceTag(owner=user,source_id=source_id,tag_id=tag_id)
+       for source_id,tag_id in source_tags])
+
+
+def get_user_source_ids_with_tag(user,tag_name):
+  """Return the list of the ids of the sources of the web feeds to which
+  the user attributed the tag with the given name.
+  """
+  return list(UserSourceTag.objects.filter(owner=user,tag__name=tag_name)\
+                                   .values_list("source_id",flat=True))
+
+
+class Job(models.Model):
+  """
+  A call to a background task waiting to be run (or already run) by
+  the wom_worker command.
+  """
+  QUEUED = "queued"
+  RUNNING = "running"
+  DONE = "done"
+  FAILED = "failed"
+  STATUS_CHOICES = ((QUEUED,"Queued"),(RUNNING,"Running"),
+                    (DONE,"Done"),(FAILED,"Failed"))
+  # The dotted path of the task function
+  name = models.CharField(max_length=255,db_index=True)
+  # The arguments of the call (pickled and base64 encoded)
+  arguments = models.TextField(blank=True)
+  status = models.CharField(max_length=10,choices=STATUS_CHOICES,
+                            default=QUEUED,db_index=True)
+  # The date before which the job must not be run
+  run_after = models.DateTimeField(db_index=True)
+  # Number of times the job has been started
+  attempts = models.PositiveIntegerField(default=0)
+  max_attempts = models.PositiveIntegerField(default=1)
+  created_date = models.DateTimeField(auto_now_add=True)
+  started_date = models.DateTimeField(null=True,blank=True)
+  finished_date = models.DateTimeField(null=True,blank=True)
+  # Last time the worker running the job showed it was alive
+  heartbeat_date = models.DateTimeField(null=True,blank=True)
+  # Identifies the worker that runs (or has run) the job
+  worker = models.CharField(max_length=100,blank=True)
+  # The user on behalf of whom the job is run (if any)
+  owner = models.ForeignKey(User,null=True,blank=True)
+  # Progress of the job, as reported by its task
+  processed = models.PositiveIntegerField(default=0)
+  total = models.PositiveIntegerField(default=0)
+  # The traceback of the last failed attempt
+  last_error = models.TextField(blank=True)
+
+  def __unicode__(self):
+    return "%s (%s, %d/%d attempts)" % (self.name,self.status,
+                                        self.attempts,self.max_attempts)
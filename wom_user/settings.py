@@ -38,6 +38,56 @@ if hasattr(settings,"WOM_USER_MAX_ITEMS_PER_PAGE"):
 else:
   MAX_ITEMS_PER_PAGE = 100
 
+if hasattr(settings,"WOM_USER_IMPORT_BATCH_SIZE"):
+  IMPORT_BATCH_SIZE = settings.WOM_USER_IMPORT_BATCH_SIZE
+else:
+  IMPORT_BATCH_SIZE = 500
+
+if hasattr(settings,"WOM_USER_IMPORT_UPLOAD_DIR"):
+  IMPORT_UPLOAD_DIR = settings.WOM_USER_IMPORT_UPLOAD_DIR
+else:
+  IMPORT_UPLOAD_DIR = "imports"
+
+if hasattr(settings,"WOM_USER_EXPORT_BATCH_SIZE"):
+  EXPORT_BATCH_SIZE = settings.WOM_USER_EXPORT_BATCH_SIZE
+else:
+  EXPORT_BATCH_SIZE = 500
+
+if hasattr(settings,"WOM_USER_OPML_CACHE_TIMEOUT"):
+  OPML_CACHE_TIMEOUT = settings.WOM_USER_OPML_CACHE_TIMEOUT
+else:
+  OPML_CACHE_TIMEOUT = 24*3600
+
+if hasattr(settings,"WOM_USER_JOB_MAX_ATTEMPTS"):
+  JOB_MAX_ATTEMPTS = settings.WOM_USER_JOB_MAX_ATTEMPTS
+else:
+  JOB_MAX_ATTEMPTS = 3
+
+if hasattr(settings,"WOM_USER_JOB_RETRY_DELAY"):
+  JOB_RETRY_DELAY = settings.WOM_USER_JOB_RETRY_DELAY
+else:
+  JOB_RETRY_DELAY = timedelta(minutes=2)
+
+if hasattr(settings,"WOM_USER_JOB_HEARTBEAT_TIMEOUT"):
+  JOB_HEARTBEAT_TIMEOUT = settings.WOM_USER_JOB_HEARTBEAT_TIMEOUT
+else:
+  JOB_HEARTBEAT_TIMEOUT = timedelta(minutes=5)
+
+if hasattr(settings,"WOM_USER_JOB_HISTORY"):
+  JOB_HISTORY = settings.WOM_USER_JOB_HISTORY
+else:
+  JOB_HISTORY = timedelta(days=7)
+
+if hasattr(settings,"WOM_USER_WORKER_CONCURRENCY"):
+  WORKER_CONCURRENCY = settings.WOM_USER_WORKER_CONCURRENCY
+else:
+  WORKER_CONCURRENCY = 2
+
+if hasattr(settings,"WOM_USER_WORKER_POLL_INTERVAL"):
+  WORKER_POLL_INTERVAL = settings.WOM_USER_WORKER_POLL_INTERVAL
+else:
+  WORKER_POLL_INTERVAL = 5
+
 if hasattr(settings,"WOM_USER_HUMANS_TEAM"):
   HUMANS_TEAM = settings.WOM_USER_HUMANS_TEAM
 else:
@@ -18,9 +18,12 @@
 # along with WaterOnMars.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+from contextlib import contextmanager
+
 from django.db import transaction
+from django.db.models import F
 from django.core.exceptions import ObjectDoesNotExist
-from django.core.exceptions import MultipleObjectsReturned
+from django.core.files.storage import default_storage
 
 from datetime import datetime
 from django.utils import timezone
@@ -32,34 +35,44 @@ if settings.USE_CELERY:
   from celery.decorators import periodic_task  
   from celery.decorators import task  
 else:
-  def crontab(*args,**kwargs):
-    return None
-  def periodic_task(*args,**kwargs):
-    def wrap(f):
-      return f
-    return wrap
-  def task(*args,**kwargs):
-    def wrap(f):
-      return f
-    return wrap
+  from wom_user.jobs import crontab
+  from wom_user.jobs import periodic_task
+  from wom_user.jobs import task
 
 
     
 from wom_pebbles.tasks import delete_old_references
-from wom_pebbles.tasks import import_references_from_ns_bookmark_list
+from wom_pebbles.tasks import import_references_from_ns_bookmarks
+from wom_pebbles.tasks import split_in_chunks
 
 from wom_river.tasks import collect_news_from_feeds
-from wom_river.tasks import import_feedsources_from_opml
+from wom_river.tasks import import_collected_feedsources
+
+from wom_river.utils.netscape_bookmarks import iter_netscape_bookmarks
+from wom_river.utils.read_opml import parse_opml
 
 from wom_user.settings import NEWS_TIME_THRESHOLD
+from wom_user.settings import IMPORT_BATCH_SIZE
+from wom_user.settings import MAX_ITEMS_PER_PAGE
 
 from wom_pebbles.models import Reference
+from wom_river.models import WebFeed
 from wom_user.models import UserBookmark
 from wom_user.models import UserProfile
 from wom_user.models import ReferenceUserStatus
+from wom_user.models import rebuild_user_source_tags
+from wom_user.models import add_sources_of_references_to_profile
+from wom_user.models import touch_user_sources
+from wom_user.models import touch_user_collection
+from wom_user.models import touch_user_news
 
 from wom_classification.models import TAG_NAME_MAX_LENGTH
-from wom_classification.models import set_item_tag_names
+from wom_classification.models import set_items_tag_names
+
+from wateronmars.profiling import record_time
+
+from wom_user.jobs import get_current_job
+from wom_user.jobs import report_progress
 
 import logging
 logger = logging.getLogger(__name__)
@@ -73,63 +86,188 @@ def collect_all_new_references_regularly():
   collect_news_from_feeds()
 
 
-@periodic_task(run_every=crontab(hour="*/12", day_of_week="*"))
+@periodic_task(run_every=crontab(hour="*/12", minute="0", day_of_week="*"))
 def delete_old_references_regularly():
-  delete_old_references(datetime.now(timezone.utc)-NEWS_TIME_THRESHOLD)
+  deleted_rows = delete_old_references(datetime.now(timezone.utc)\
+                                       -NEWS_TIME_THRESHOLD)
+  logger.info("Old references cleanup deleted: %s" \
+              % ", ".join("%d rows from %s" % (count,table)
+                          for table,count in sorted(deleted_rows.items())))
+  if deleted_rows.get(ReferenceUserStatus._meta.db_table):
+    # the statuses are deleted without knowing their owners
+    touch_user_news()
 
 
 @task()
-def import_user_bookmarks_from_ns_list(user,nsbmk_txt):
-  ref_and_metadata = import_references_from_ns_bookmark_list(nsbmk_txt)
+def update_all_references():
+  """Cleanup the references that have never been saved (past an
+  arbitrary delay) and collect the news from all known feeds.
+  """
+  delete_old_references_regularly()
+  collect_news_from_feeds()
+  if settings.DEMO:
+    # keep only a short number of refs (the most recent) to avoid bloating the demo
+    with transaction.commit_on_success():
+      for ref in list(Reference.objects\
+                      .filter(save_count=0)\
+                      .order_by("-pub_date")[MAX_ITEMS_PER_PAGE:]):
+        ref.delete()
+      touch_user_news()
+
+
+@contextmanager
+def open_uploaded_file(file_name):
+  """Open a file saved in the default storage for a background import
+  and delete it once the import is over (but not if the import failed
+  and the job will be retried)."""
+  uploaded_file = default_storage.open(file_name)
+  try:
+    yield uploaded_file
+  except Exception:
+    uploaded_file.close()
+    job = get_current_job()
+    if job is None or job.attempts>=job.max_attempts:
+      default_storage.delete(file_name)
+    raise
+  uploaded_file.close()
+  default_storage.delete(file_name)
+
+
+def import_user_bookmarks_by_batches(user,nsbmk):
+  """Import the bookmarks of a Netscape-style bookmark file by batches
+  of IMPORT_BATCH_SIZE, yielding the size of each imported batch.
+
+  nsbmk: either the full content of the file as a string or any
+  iterable over its lines (like an uploaded file), the latter making
+  it possible to import big files without loading them in memory.
+  """
+  if isinstance(nsbmk,basestring):
+    nsbmk = nsbmk.splitlines()
+  for bmk_batch in split_in_chunks(iter_netscape_bookmarks(nsbmk),
+                                   IMPORT_BATCH_SIZE):
+    import_user_bookmarks_batch(user,bmk_batch)
+    yield len(bmk_batch)
+
+
+@task()
+def import_user_bookmarks_from_ns_list(user,nsbmk):
+  """Import the bookmarks of a Netscape-style bookmark file (given as a
+  string or as an iterable over its lines) in user's collection."""
+  processed = 0
+  for batch_size in import_user_bookmarks_by_batches(user,nsbmk):
+    processed += batch_size
+    report_progress(processed)
+
+
+@task()
+def import_user_bookmarks_from_ns_file(user,file_name):
+  """Import the bookmarks of a Netscape-style bookmark file saved in the
+  default storage in user's collection, and delete the file.
+
+  The file is streamed and the progress is reported, after each batch,
+  as the number of bytes read out of the file's size.
+  """
+  with open_uploaded_file(file_name) as nsbmk_file:
+    total = nsbmk_file.size
+    for _ in import_user_bookmarks_by_batches(user,nsbmk_file):
+      report_progress(min(nsbmk_file.tell(),total),total)
+    report_progress(total,total)
+
+
+def import_user_bookmarks_batch(user,collected_bmks):
+  ref_and_metadata = import_references_from_ns_bookmarks(collected_bmks)
+  if not ref_and_metadata:
+    return
+  existing_bmks = dict((b.reference_id,b) for b in UserBookmark.objects\
+                       .filter(owner=user,
+                               reference__in=[r.id for r in ref_and_metadata]))
   bmk_to_process = []
+  new_bmks = []
+  modified_bmks = []
   for ref,meta in ref_and_metadata.items():
-    try:
-      bmk = UserBookmark.objects.get(owner=user,reference=ref)
-    except ObjectDoesNotExist:
+    bmk = existing_bmks.get(ref.id)
+    if bmk is None:
       bmk = UserBookmark(owner=user,reference=ref,
-                         saved_date=ref.pub_date)
-      ref.save_count += 1
-      for src in ref.sources.all():
-        user.userprofile.sources.add(src)
-    bmk.is_public = meta.is_public
-    bmk.comment = meta.note
+                         saved_date=ref.pub_date,
+                         is_public=meta.is_public,
+                         comment=meta.note)
+      new_bmks.append(bmk)
+    elif bmk.is_public!=meta.is_public or bmk.comment!=meta.note:
+      bmk.is_public = meta.is_public
+      bmk.comment = meta.note
+      modified_bmks.append(bmk)
     # pile up the bookmarks for tag attribution
     bmk_to_process.append((bmk,meta))
+  new_ref_ids = [b.reference.id for b in new_bmks]
   with transaction.commit_on_success():
-    for b,_ in bmk_to_process:
-      b.reference.save()
+    UserBookmark.objects.bulk_create(new_bmks)
+    for b in modified_bmks:
       b.save()
-  classif_data_to_save = []
+    if new_ref_ids:
+      Reference.objects.filter(id__in=new_ref_ids)\
+                       .update(save_count=F("save_count")+1)
+      add_sources_of_references_to_profile(user.userprofile,new_ref_ids)
+    # bulk_create doesn't send the signals that track collection changes
+    touch_user_collection(owner=user)
+  tag_names_by_ref_id = {}
   for bmk,meta in bmk_to_process:
     valid_tags = [t for t in meta.tags if len(t)<=TAG_NAME_MAX_LENGTH]
     if len(valid_tags)!=len(meta.tags):
       invalid_tags = [t for t in meta.tags if len(t)>TAG_NAME_MAX_LENGTH]
       logger.error("Could not import some bmk tags with too long names (%s>%s)"\
-                   % (",".join(len(t) for t in invalid_tags),TAG_NAME_MAX_LENGTH))
-    classif_data_to_save.append(set_item_tag_names(user,bmk.reference,valid_tags))
-  with transaction.commit_on_success():
-    for cd in classif_data_to_save:
-      cd.save()
+                   % (",".join(str(len(t)) for t in invalid_tags),
+                      TAG_NAME_MAX_LENGTH))
+    tag_names_by_ref_id[bmk.reference.id] = valid_tags
+  set_items_tag_names(user,Reference,tag_names_by_ref_id)
+  # the tags are inserted in bulk too, without the signals that would
+  # otherwise mark the collection as modified
+  touch_user_collection(owner=user)
+
+
+def import_user_feedsources(user,collected_feeds):
+  """Import the feeds collected from an OPML file in user's sources by
+  batches of IMPORT_BATCH_SIZE, the progress being reported after each
+  batch when run as a background job.
+  """
+  profile = UserProfile.objects.get(owner=user)
+  processed = 0
+  for collected_chunk in split_in_chunks(collected_feeds,IMPORT_BATCH_SIZE):
+    feeds_and_tags = import_collected_feedsources(collected_chunk)
+    profile.web_feeds.add(*feeds_and_tags.keys())
+    profile.sources.add(*set(feed.source for feed in feeds_and_tags))
+    tag_names_by_feed_id = {}
+    for feed,tags in feeds_and_tags.items():
+      valid_tags = [t for t in tags if len(t)<=TAG_NAME_MAX_LENGTH]
+      if len(valid_tags)!=len(tags):
+        invalid_tags = [t for t in tags if len(t)>TAG_NAME_MAX_LENGTH]
+        logger.error("Could not import some source tags with too long names (%s>%s)"\
+                     % (",".join(str(len(t)) for t in invalid_tags),
+                        TAG_NAME_MAX_LENGTH))
+      tag_names_by_feed_id[feed.id] = valid_tags
+    set_items_tag_names(user,WebFeed,tag_names_by_feed_id)
+    # the tags are inserted in bulk, without the signals that would
+    # otherwise mark the sources as modified
+    touch_user_sources(owner=user)
+    processed += len(collected_chunk)
+    report_progress(processed,len(collected_feeds))
+  rebuild_user_source_tags(user)
 
 
 @task()
 def import_user_feedsources_from_opml(user,opml_txt):
-  feeds_and_tags = import_feedsources_from_opml(opml_txt)
-  profile = UserProfile.objects.get(owner=user)
-  classif_data_to_save = []
-  for feed,tags in feeds_and_tags.items():
-    profile.web_feeds.add(feed)
-    profile.sources.add(feed.source)
-    valid_tags = [t for t in tags if len(t)<=TAG_NAME_MAX_LENGTH]
-    if len(valid_tags)!=len(tags):
-      invalid_tags = [t for t in tags if len(t)>TAG_NAME_MAX_LENGTH]
-      logger.error("Could not import some source tags with too long names (%s>%s)"\
-                   % (",".join(str(len(t)) for t in invalid_tags),
-                      TAG_NAME_MAX_LENGTH))
-    classif_data_to_save.append(set_item_tag_names(user,feed,valid_tags))
-  with transaction.commit_on_success():
-    for cd in classif_data_to_save:
-      cd.save()
+  """Import the feeds of an OPML file (given as a string) in user's
+  sources."""
+  collected_feeds,_ = parse_opml(opml_txt,False)
+  import_user_feedsources(user,collected_feeds)
+
+
+@task()
+def import_user_feedsources_from_opml_file(user,file_name):
+  """Import the feeds of an OPML file saved in the default storage in
+  user's sources, and delete the file."""
+  with open_uploaded_file(file_name) as opml_file:
+    collected_feeds,_ = parse_opml(opml_file)
+    import_user_feedsources(user,collected_feeds)
 
 
 class FakeReferenceUserStatus:
@@ -138,32 +276,55 @@ class FakeReferenceUserStatus:
     self.user = None 
 
 
+def get_unknown_source():
+  """Return the reference used as the main source of the news items
+  that have no known source (creating it if needed)."""
+  try:
+    return Reference.objects.get(url="<unknown>")
+  except ObjectDoesNotExist:
+    s = Reference(url="<unknown>",title="<unknown>",
+                  save_count=1,
+                  pub_date=datetime.utcfromtimestamp(0)\
+                  .replace(tzinfo=timezone.utc))
+    s.save()
+    return s
+
+
+def get_main_source_ids(user,reference_ids):
+  """Return a dictionary mapping the ids of the references to the id
+  of their oldest source among the user's sources (with one query per
+  batch of IMPORT_BATCH_SIZE references).
+  """
+  main_source_ids = {}
+  ReferenceSources = Reference.sources.through
+  for id_chunk in split_in_chunks(reference_ids,IMPORT_BATCH_SIZE):
+    # the oldest source comes last and wins
+    main_source_ids.update(ReferenceSources.objects\
+      .filter(from_reference__in=id_chunk,
+              to_reference__userprofile=user.userprofile)\
+      .order_by("-to_reference__pub_date")\
+      .values_list("from_reference_id","to_reference_id"))
+  return main_source_ids
+
+
 def generate_reference_user_status(user,references):
   """Generate reference user status instances for a given set of references.
   WARNING: the new instances are not saved in the database!
   """
   new_ref_status = []
+  main_source_ids = get_main_source_ids(user,[r.id for r in references])
+  unknown_source = None
   for ref in references:
     rust = ReferenceUserStatus()
     rust.owner = user
     rust.reference = ref
     rust.reference_pub_date = ref.pub_date
-    source_query = ref.sources.filter(userprofile=user.userprofile)\
-                              .distinct().order_by("pub_date")
-    try:
-      rust.main_source = source_query.get()
-    except MultipleObjectsReturned:
-      rust.main_source = source_query.all()[0]
-    except ObjectDoesNotExist:
-      try:
-        rust.main_source = Reference.objects.get(url="<unknown>")
-      except ObjectDoesNotExist:
-        s = Reference(url="<unknown>",title="<unknown>",
-                      save_count=1,
-                      pub_date=datetime.utcfromtimestamp(0)\
-                      .replace(tzinfo=timezone.utc))        
-        s.save()
-        rust.main_source = s
+    if ref.id in main_source_ids:
+      rust.main_source_id = main_source_ids[ref.id]
+    else:
+      if unknown_source is None:
+        unknown_source = get_unknown_source()
+      rust.main_source = unknown_source
     new_ref_status.append(rust)
   return new_ref_status
 
@@ -173,35 +334,28 @@ def clean_corrupted_rusts(user):
   valid reference and a valid main_source.
   """
   # first cleanup strange corruption happening sometimes in the db
-  for rust in ReferenceUserStatus.objects.filter(owner=user,has_been_read=False):
-    corrupted = False
-    try:
-      rust_ref = unicode(rust.reference)
-    except ObjectDoesNotExist:
-      rust_ref = "not-found"
-      corrupted = True
-    except Exception,e:
-      rust_ref = "err(%s)" % e
-    try:
-      rust_src = unicode(rust.main_source)
-    except ObjectDoesNotExist:
-      rust_src = "not-found"
-      corrupted = True
-    except Exception,e:
-      rust_src = "err(%s)" % e
-    if corrupted:
-      logger.warning("Deleting corrupted ReferenceUserStatus: \
+  valid_ids = Reference.objects.values("id")
+  corrupted_rusts = list(ReferenceUserStatus.objects\
+                         .filter(owner=user,has_been_read=False)\
+                         .exclude(reference__in=valid_ids,
+                                  main_source__in=valid_ids))
+  if not corrupted_rusts:
+    return
+  for rust in corrupted_rusts:
+    logger.warning("Deleting corrupted ReferenceUserStatus: \
 read %s, pub_date %s, reference %s, source %s." \
-                     % (rust.has_been_read,rust.reference_pub_date,
-                        rust_ref,rust_src))
-      try:
-        rust.delete()
-      except Exception,e:
-        logger.error("Could not delete a corrupted ReferenceUserStatus (%s)." % e)
-        continue
+                   % (rust.has_been_read,rust.reference_pub_date,
+                      rust.reference_id,rust.main_source_id))
+  try:
+    ReferenceUserStatus.objects.filter(id__in=[r.id for r in corrupted_rusts])\
+                               .delete()
+    user.userprofile.news_last_modified = touch_user_news(owner=user)
+  except Exception,e:
+    logger.error("Could not delete corrupted ReferenceUserStatus (%s)." % e)
 
   
 @task()  
+@record_time("unread_check")
 def check_user_unread_feed_items(user):
   """Browse all feed sources registered by a given user and create as
   many ReferenceUserStatus instances as there are unread items.
@@ -224,7 +378,9 @@ def check_user_unread_feed_items(user):
     if discarded_ref_count:
       logger.debug("Discarded {0} duplicate feed items from news feed {1}."\
                    .format(discarded_ref_count,feed.xmlURL))
-  with transaction.commit_on_success():
-    for r in new_ref_status:
-      r.save()
+  if new_ref_status:
+    with transaction.commit_on_success():
+      ReferenceUserStatus.objects.bulk_create(new_ref_status,
+                                              batch_size=IMPORT_BATCH_SIZE)
+      user.userprofile.news_last_modified = touch_user_news(owner=user)
   return len(new_ref_status)
@@ -18,6 +18,13 @@
 # along with WaterOnMars.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import os
+import base64
+import pickle
+import shutil
+import pstats
+import tempfile
+from StringIO import StringIO
 from datetime import datetime
 from datetime import timedelta
 from django.utils import timezone
@@ -27,8 +34,19 @@ from django.http import HttpResponse
 from django.core.urlresolvers import reverse
 
 from django.test import TestCase
+from django.test.utils import override_settings
+from django.core.files.storage import default_storage
+from django.utils.functional import empty
 
 from django.test.client import RequestFactory
+from django.core.management import call_command
+from django.conf import settings
+
+import wateronmars.startup as startup
+import wateronmars.profiling as profiling
+from wateronmars.testing import QueryBudgetTestMixin
+import benchmarks.startup
+from benchmarks.feed_server import FeedServer
 
 from wom_pebbles.models import Reference
 from wom_river.models import WebFeed
@@ -36,18 +54,45 @@ from wom_river.models import WebFeed
 from wom_user.models import UserProfile
 from wom_user.models import UserBookmark
 from wom_user.models import ReferenceUserStatus
+from wom_user.models import get_user_source_ids_with_tag
 
 
+import wom_user.tasks
+import wom_user.views
 from wom_user.views import MAX_ITEMS_PER_PAGE
 from wom_user.views import check_and_set_owner
 from wom_user.views import loggedin_and_owner_required
 from wom_user.tasks import import_user_feedsources_from_opml
 from wom_user.tasks import import_user_bookmarks_from_ns_list
 from wom_user.tasks import check_user_unread_feed_items
+from wom_user.tasks import update_all_references
+from wom_user.tasks import delete_old_references_regularly
+from wom_user.tasks import collect_all_new_references_regularly
+
+from wom_user.models import Job
+from wom_user.jobs import task
+from wom_user.jobs import crontab
+from wom_user.jobs import get_task_name
+from wom_user.jobs import claim_next_job
+from wom_user.jobs import run_pending_jobs
+from wom_user.jobs import schedule_periodic_tasks
+from wom_user.jobs import requeue_stale_jobs
+from wom_user.jobs import run_job
+from wom_user.jobs import beat
+from wom_user.jobs import report_progress
+from wom_user.settings import JOB_HEARTBEAT_TIMEOUT
+from wom_user.settings import IMPORT_BATCH_SIZE
+from wom_user.settings import IMPORT_UPLOAD_DIR
+
+from wom_pebbles.tasks import delete_old_references
+
+from wom_river.utils.netscape_bookmarks import iter_netscape_bookmarks
+from wom_river.utils.read_opml import parse_opml
 
 from wom_classification.models import Tag
 from wom_classification.models import get_item_tag_names
 from wom_classification.models import set_item_tag_names
+from wom_classification.models import set_items_tag_names
 
 from django.contrib.auth.models import User
 from django.contrib.auth.models import AnonymousUser
@@ -604,6 +649,10 @@ class UserBookmarkAddTestMixin:
     self.assertEqual(0,len(new_item_reference.sources.all()))
     
 
+# Number of queries needed to display a page of the collection
+# (whatever the number of bookmarks on the page)
+COLLECTION_PAGE_QUERY_BUDGET = 9
+
 class UserCollectionViewTest(TestCase,UserBookmarkAddTestMixin):
 
   def setUp(self):
@@ -645,6 +694,51 @@ class UserCollectionViewTest(TestCase,UserBookmarkAddTestMixin):
     self.assertNotIn(False,[hasattr(b,"get_tag_names") \
                             for b in resp.context["user_bookmarks"]])
   
+  def test_get_html_owner_sees_private_sources_and_tags(self):
+    set_item_tag_names(self.user,self.bkm.reference,["tagA"])
+    self.assertTrue(self.client.login(username="uA",password="pA"))
+    resp = self.client.get(
+      reverse("wom_user.views.user_collection",
+          kwargs={"owner_name":"uA"}))
+    self.assertEqual(200,resp.status_code)
+    bookmarks = dict((b.id,b) for b in resp.context["user_bookmarks"])
+    self.assertEqual([self.source],bookmarks[self.bkm.id].visible_sources)
+    self.assertEqual(["tagA"],bookmarks[self.bkm.id].visible_tag_names)
+    self.assertEqual([],bookmarks[self.bkm_private.id].visible_tag_names)
+    self.assertIn('href="http://mouf"',resp.content)
+
+  def test_get_html_visitor_only_sees_public_sources(self):
+    resp = self.client.get(
+      reverse("wom_user.views.user_collection",
+          kwargs={"owner_name":"uA"}))
+    self.assertEqual(200,resp.status_code)
+    self.assertEqual([[]],[b.visible_sources
+                           for b in resp.context["user_bookmarks"]])
+    self.user.userprofile.public_sources.add(self.source)
+    resp = self.client.get(
+      reverse("wom_user.views.user_collection",
+          kwargs={"owner_name":"uA"}))
+    self.assertEqual([[self.source]],[b.visible_sources
+                                      for b in resp.context["user_bookmarks"]])
+
+  def test_get_html_with_fixed_number_of_queries(self):
+    url = reverse("wom_user.views.user_collection",
+                  kwargs={"owner_name":"uA"})
+    self.assertTrue(self.client.login(username="uA",password="pA"))
+    with self.assertNumQueries(COLLECTION_PAGE_QUERY_BUDGET):
+      self.client.get(url)
+    date = datetime.now(timezone.utc)
+    for i in range(20):
+      ref = Reference.objects.create(url=u"http://mouf/%d" % i,
+                                     title=u"mouf%d" % i,pub_date=date)
+      ref.sources.add(self.source)
+      UserBookmark.objects.create(owner=self.user,reference=ref,
+                                  saved_date=date,is_public=True)
+      set_item_tag_names(self.user,ref,["t%d" % i,"common"])
+    with self.assertNumQueries(COLLECTION_PAGE_QUERY_BUDGET):
+      resp = self.client.get(url)
+    self.assertEqual(22,len(resp.context["user_bookmarks"]))
+    
   def test_get_html_non_owner_logged_in_user_returns_all(self):
     # login as uA and make sure it succeeds
     self.assertTrue(self.client.login(username="uA",
@@ -680,7 +774,83 @@ class UserCollectionViewTest(TestCase,UserBookmarkAddTestMixin):
     self.assertEqual([self.bkm],
              list(resp.context["user_bookmarks"]))
 
+  def test_get_json_visitor_only_gets_public_bookmarks(self):
+    url = reverse("wom_user.views.user_collection",
+                  kwargs={"owner_name":"uA"})
+    # owner, validators (profile and latest bookmark) and items
+    with self.assertNumQueries(4):
+      resp = self.client.get(url,{"format":"json",
+                                  "fields":"url,title,public,comment"})
+    self.assertEqual(200,resp.status_code)
+    data = simplejson.loads(resp.content)
+    self.assertEqual([{"url": "http://mouf/a", "title": "glop",
+                       "public": True, "comment": ""}],data["items"])
+    self.assertEqual(None,data["next_cursor"])
+    self.assertTrue(self.client.login(username="uA",password="pA"))
+    data = simplejson.loads(self.client.get(url,{"format":"json"}).content)
+    self.assertEqual(set(["http://mouf/a","http://mouf/p"]),
+                     set(i["url"] for i in data["items"]))
+    
+  def test_get_html_not_modified_until_collection_changes(self):
+    url = reverse("wom_user.views.user_collection",
+                  kwargs={"owner_name":"uA"})
+    resp = self.client.get(url)
+    self.assertEqual(200,resp.status_code)
+    # the page depends on the visitor, so no Last-Modified date is
+    # given for clients that would only send an If-Modified-Since
+    self.assertFalse(resp.has_header("Last-Modified"))
+    etag = resp["ETag"]
+    resp = self.client.get(url,HTTP_IF_NONE_MATCH=etag)
+    self.assertEqual(304,resp.status_code)
+    # the owner doesn't see the same page
+    self.assertTrue(self.client.login(username="uA",password="pA"))
+    resp = self.client.get(url,HTTP_IF_NONE_MATCH=etag)
+    self.assertEqual(200,resp.status_code)
+    self.client.logout()
+    set_item_tag_names(self.user,self.bkm.reference,["t1"])
+    resp = self.client.get(url,HTTP_IF_NONE_MATCH=etag)
+    self.assertEqual(200,resp.status_code)
+    etag = resp["ETag"]
+    self.bkm.comment = u"new comment"
+    self.bkm.save()
+    resp = self.client.get(url,HTTP_IF_NONE_MATCH=etag)
+    self.assertEqual(200,resp.status_code)
+    
+  def test_get_ns_bmk_list_owner_returns_all_with_tags(self):
+    set_item_tag_names(self.user,self.bkm.reference,["t1","t2"])
+    self.bkm_private.comment = u"<b>Private</b> & sure"
+    self.bkm_private.save()
+    self.assertTrue(self.client.login(username="uA",password="pA"))
+    resp = self.client.get(
+      reverse("wom_user.views.user_collection",
+          kwargs={"owner_name":"uA"}),{"format": "ns-bmk-list"})
+    self.assertEqual(200,resp.status_code)
+    self.assertTrue(resp["Content-Type"].startswith("text/html"))
+    bmks = dict((b["url"],b) for b in iter_netscape_bookmarks(
+      resp.content.splitlines()))
+    self.assertEqual(set(["http://mouf/a","http://mouf/p"]),set(bmks.keys()))
+    self.assertEqual("t1,t2",bmks["http://mouf/a"]["tags"])
+    self.assertEqual("0",bmks["http://mouf/a"]["private"])
+    self.assertEqual("glop",bmks["http://mouf/a"]["title"])
+    self.assertEqual("1",bmks["http://mouf/p"]["private"])
+    self.assertEqual("Private &amp; sure",bmks["http://mouf/p"]["note"])
+    
+  def test_get_ns_bmk_list_anonymous_returns_public_only(self):
+    import wom_user.views
+    initial_batch_size = wom_user.views.EXPORT_BATCH_SIZE
+    wom_user.views.EXPORT_BATCH_SIZE = 1
+    try:
+      resp = self.client.get(
+        reverse("wom_user.views.user_collection",
+                kwargs={"owner_name":"uA"}),{"format": "ns-bmk-list"})
+      self.assertEqual(200,resp.status_code)
+      self.assertEqual(["http://mouf/a"],
+                       [b["url"] for b in iter_netscape_bookmarks(
+                         resp.content.splitlines())])
+    finally:
+      wom_user.views.EXPORT_BATCH_SIZE = initial_batch_size
 
+      
 class UserCollectionAddTest(TestCase,UserBookmarkAddTestMixin):
   
   def setUp(self):
@@ -738,17 +908,16 @@ class UserSourceAddTestMixin:
       title=u"a glop",
       pub_date=self.date)
     self.other_profile.sources.add(self.source_b)
+    self.feed_server = FeedServer(num_feeds=2).start()
+    self.addCleanup(self.feed_server.stop)
 
   def test_add_new_feed_source_to_owner(self):
-    """
-    WARNING: dependent on an internet access !
-    """
     # login as uA and make sure it succeeds
     self.assertTrue(self.client.login(username="uA",
                       password="pA"))
     self.assertEqual(2,self.user_profile.sources.count())
     self.assertEqual(1,self.user_profile.web_feeds.count())
-    new_feed_url = u"http://cyber.law.harvard.edu/rss/examples/rss2sample.xml"
+    new_feed_url = unicode(self.feed_server.feed_url(0))
     self.add_request("uA",
                      {"url": new_feed_url,
                       "feed_url": new_feed_url,
@@ -765,16 +934,25 @@ class UserSourceAddTestMixin:
     new_w = WebFeed.objects.get(source=new_s)
     self.assertEqual(new_feed_url,new_w.xmlURL)
     
+  def test_add_new_source_with_wrong_feed_url_suggests_feed(self):
+    self.assertTrue(self.client.login(username="uA",
+                      password="pA"))
+    site_url = unicode(self.feed_server.site_url(1))
+    resp = self.add_request("uA",
+                            {"url": site_url,
+                             "feed_url": site_url,
+                             "title": u"a site"},
+                            expectedStatusCode=200)
+    self.assertEqual(2,self.user_profile.sources.count())
+    self.assertIn(self.feed_server.feed_url(1),resp.content)
+    
   def test_add_new_feed_source_to_other_user_fails(self):
-    """
-    WARNING: dependent on an internet access !
-    """
     # login as uA and make sure it succeeds
     self.assertTrue(self.client.login(username="uA",
                       password="pA"))
     self.assertEqual(2,self.user_profile.sources.count())
     self.assertEqual(1,self.user_profile.web_feeds.count())
-    new_feed_url = u"http://cyber.law.harvard.edu/rss/examples/rss2sample.xml"
+    new_feed_url = unicode(self.feed_server.feed_url(0))
     self.add_request("uB",
              {"url": new_feed_url,
               "feed_url": new_feed_url,
@@ -884,6 +1062,15 @@ Do Not Edit! -->
     
   def test_check_bookmarks_not_added_to_other_user(self):
     self.assertEqual(0,self.other_user.userbookmark_set.count())
+
+  def test_existing_bookmark_updated(self):
+    bmk = UserBookmark.objects.get(id=self.bkm.id)
+    self.assertTrue(bmk.is_public)
+    self.assertEqual("",bmk.comment)
+    
+  def test_sources_of_new_bookmarks_added_to_profile(self):
+    self.assertEqual(set(["http://mouf","#internal-bookmark-import"]),
+                     set(s.url for s in self.user_profile.sources.all()))
   
   def test_check_tags_correctly_added(self):
     # Check that tags were added too
@@ -903,6 +1090,51 @@ Do Not Edit! -->
     self.assertEqual(set(["test"]),set(ref_tags))
 
 
+class ImportUserBookmarksFromNSFileByBatches(TestCase):
+
+  def setUp(self):
+    self.user = User.objects.create_user(username="uA",
+                                         password="pA")
+    self.user_profile = UserProfile.objects.create(owner=self.user)
+    self.num_bmks = 7
+    nsbmk_lines = ["<!DOCTYPE NETSCAPE-Bookmark-file-1>\n","<DL><p>\n"]
+    for i in range(self.num_bmks):
+      nsbmk_lines.append('<DT><A HREF="http://mouf/%d" TAGS="t%d">R%d</A>\n'\
+                         % (i,i%2,i))
+      nsbmk_lines.append("<DD>Note %d\n" % i)
+    # make sure we don't rely on a string
+    nsbmk_file = iter(nsbmk_lines)
+    import wom_user.tasks
+    self.initial_batch_size = wom_user.tasks.IMPORT_BATCH_SIZE
+    wom_user.tasks.IMPORT_BATCH_SIZE = 3
+    import_user_bookmarks_from_ns_list(self.user,nsbmk_file)
+
+  def tearDown(self):
+    import wom_user.tasks
+    wom_user.tasks.IMPORT_BATCH_SIZE = self.initial_batch_size
+    
+  def test_all_bookmarks_are_added_with_their_metadata(self):
+    self.assertEqual(self.num_bmks,self.user.userbookmark_set.count())
+    for i in range(self.num_bmks):
+      bmk = UserBookmark.objects.get(owner=self.user,
+                                     reference__url="http://mouf/%d" % i)
+      self.assertEqual("R%d" % i,bmk.reference.title)
+      self.assertEqual("Note %d" % i,bmk.comment)
+      self.assertEqual(["t%d" % (i%2)],
+                       get_item_tag_names(self.user,bmk.reference))
+
+  def test_reimport_does_not_duplicate_bookmarks(self):
+    import_user_bookmarks_from_ns_list(
+      self.user,
+      '<!DOCTYPE NETSCAPE-Bookmark-file-1>\n'
+      '<DT><A HREF="http://mouf/0" TAGS="t0">R0</A>\n'
+      '<DD>Note 0\n'
+      '<DT><A HREF="http://mouf/new">New</A>\n')
+    self.assertEqual(self.num_bmks+1,self.user.userbookmark_set.count())
+    self.assertEqual(1,Reference.objects.get(url="http://mouf/0").save_count)
+    self.assertEqual(1,Reference.objects.get(url="http://mouf/new").save_count)
+
+
 class ImportUserFeedSourceFromOPMLTaskTest(TestCase):
 
   def setUp(self):
@@ -992,6 +1224,80 @@ class ImportUserFeedSourceFromOPMLTaskTest(TestCase):
       WebFeed.objects.get(source__url="http://www.openculture.com"))
     self.assertEqual(["Culture"],src_tags)
 
+  def test_check_tags_correctly_mapped_to_feed_sources(self):
+    self.assertEqual(
+      [Reference.objects.get(url="http://www.openculture.com").id],
+      get_user_source_ids_with_tag(self.user,"Culture"))
+    self.assertEqual(
+      set(Reference.objects.filter(url__in=[
+        "http://scripting.com/","http://mouf",
+        "http://stallman.org/archives/polnotes.html"])\
+          .values_list("id",flat=True)),
+      set(get_user_source_ids_with_tag(self.user,"News")))
+    self.assertEqual([],get_user_source_ids_with_tag(self.other_user,"News"))
+
+class DeleteOldReferencesTest(TestCase):
+
+  def setUp(self):
+    import wom_pebbles.tasks
+    self.initial_chunk_settings = (wom_pebbles.tasks.DELETE_CHUNK_SIZE,
+                                   wom_pebbles.tasks.DELETE_PAUSE)
+    wom_pebbles.tasks.DELETE_CHUNK_SIZE = 2
+    wom_pebbles.tasks.DELETE_PAUSE = 0
+    self.user = User.objects.create_user(username="uA",password="pA")
+    profile = UserProfile.objects.create(owner=self.user)
+    self.date = datetime.now(timezone.utc)
+    old_date = self.date-timedelta(weeks=10)
+    self.kept_source = Reference.objects.create(url=u"http://kept",
+                                                title=u"kept",
+                                                pub_date=self.date)
+    old_source = Reference.objects.create(url=u"http://old",title=u"old",
+                                          pub_date=old_date)
+    feed = WebFeed.objects.create(xmlURL=u"http://old/rss.xml",
+                                  last_update_check=old_date,
+                                  source=old_source)
+    profile.web_feeds.add(feed)
+    profile.sources.add(old_source,self.kept_source)
+    profile.public_sources.add(old_source)
+    for i in range(5):
+      r = Reference.objects.create(url=u"http://kept/%d" % i,
+                                   title=u"old %d" % i,
+                                   pub_date=old_date)
+      r.sources.add(self.kept_source)
+      ReferenceUserStatus.objects.create(reference=r,owner=self.user,
+                                         reference_pub_date=old_date,
+                                         main_source=self.kept_source)
+    saved = Reference.objects.create(url=u"http://kept/saved",
+                                     title=u"saved",pub_date=old_date,
+                                     save_count=1)
+    saved.sources.add(old_source)
+    Reference.objects.create(url=u"http://kept/new",title=u"new",
+                             pub_date=self.date)
+
+  def tearDown(self):
+    import wom_pebbles.tasks
+    wom_pebbles.tasks.DELETE_CHUNK_SIZE,wom_pebbles.tasks.DELETE_PAUSE \
+      = self.initial_chunk_settings
+
+  def test_old_unsaved_references_deleted_with_dependencies(self):
+    deleted_rows = delete_old_references(self.date-timedelta(weeks=4))
+    self.assertEqual(set([u"http://kept",u"http://kept/saved",
+                          u"http://kept/new"]),
+                     set(Reference.objects.values_list("url",flat=True)))
+    self.assertEqual(0,WebFeed.objects.count())
+    self.assertEqual(0,ReferenceUserStatus.objects.count())
+    self.assertEqual([self.kept_source],
+                     list(self.user.userprofile.sources.all()))
+    self.assertEqual(0,self.user.userprofile.public_sources.count())
+    self.assertEqual(0,self.user.userprofile.web_feeds.count())
+    self.assertEqual(0,Reference.objects.get(url=u"http://kept/saved")\
+                     .sources.count())
+    self.assertEqual(6,deleted_rows[Reference._meta.db_table])
+    self.assertEqual(5,deleted_rows[ReferenceUserStatus._meta.db_table])
+    self.assertEqual(1,deleted_rows[WebFeed._meta.db_table])
+    self.assertEqual(6,deleted_rows[Reference.sources.through._meta.db_table])
+    
+    
 class UserRiverViewTest(TestCase):
 
     def setUp(self):
@@ -1090,6 +1396,99 @@ class UserRiverViewTest(TestCase):
         referenceNumbers = [int(rust.reference.title[3:]) for rust in items]
         self.assertEqual(list(reversed(sorted(referenceNumbers))),referenceNumbers)
 
+    def test_get_html_filtered_by_tag_returns_only_tagged_sources_items(self):
+        """
+        Make sure the river can be restricted to the sources with a given tag.
+        """
+        f3 = WebFeed.objects.get(xmlURL="http://greuh/rss.xml")
+        self.user1.userprofile.sources.add(
+          WebFeed.objects.get(xmlURL="http://mouf/rss.xml").source,f3.source)
+        set_item_tag_names(self.user1,f3,["T3"])
+        resp = self.client.get(reverse("wom_user.views.user_river_view",
+                                       kwargs={"owner_name":"uA"}),
+                               {"tag": "T3"})
+        self.assertEqual(200,resp.status_code)
+        self.assertEqual("T3",resp.context["tag_name"])
+        items = resp.context["news_items"]
+        self.assertLess(0,len(items))
+        sourceNames = set(int(rust.reference.title[1]) for rust in items)
+        self.assertEqual(set((3,)),sourceNames)
+        self.assertIn("tag=T3&amp;page=2",resp.content)
+
+
+    def test_get_json_pages_follow_cursors(self):
+        """
+        Make sure the JSON river can be browsed with cursors.
+        """
+        url = reverse("wom_user.views.user_river_view",
+                      kwargs={"owner_name":"uA"})
+        resp = self.client.get(url,{"format":"json"})
+        self.assertEqual(200,resp.status_code)
+        self.assertEqual("application/json",resp["Content-Type"])
+        data = simplejson.loads(resp.content)
+        self.assertEqual(MAX_ITEMS_PER_PAGE,len(data["items"]))
+        self.assertEqual(set(["url","title","date"]),set(data["items"][0]))
+        items = data["items"]
+        cursor = data["next_cursor"]
+        while cursor is not None:
+          data = simplejson.loads(
+            self.client.get(url,{"format":"json","cursor":cursor}).content)
+          items.extend(data["items"])
+          cursor = data["next_cursor"]
+        self.assertEqual(2*(MAX_ITEMS_PER_PAGE+1),len(items))
+        self.assertEqual(len(items),len(set(i["url"] for i in items)))
+        dates = [i["date"] for i in items]
+        self.assertEqual(list(reversed(sorted(dates))),dates)
+
+    def test_get_json_with_selected_fields(self):
+        """
+        Make sure only the requested fields are sent.
+        """
+        url = reverse("wom_user.views.user_river_view",
+                      kwargs={"owner_name":"uA"})
+        resp = self.client.get(url,{"format":"json","count":2,
+                                    "fields":"url,title,read"})
+        data = simplejson.loads(resp.content)
+        self.assertEqual(2,len(data["items"]))
+        self.assertEqual({"url": "http://moufc%d" % MAX_ITEMS_PER_PAGE,
+                          "title": "s3r%d" % MAX_ITEMS_PER_PAGE,
+                          "read": False},
+                         data["items"][0])
+        resp = self.client.get(url,{"format":"json","fields":"url,password"})
+        self.assertEqual(400,resp.status_code)
+        resp = self.client.get(url,{"format":"json","cursor":"mouf"})
+        self.assertEqual(400,resp.status_code)
+        
+    def test_get_html_not_modified_until_new_items_come(self):
+        """
+        Make sure an unchanged river is answered with a 304 without
+        checking the user's feeds.
+        """
+        url = reverse("wom_user.views.user_river_view",
+                      kwargs={"owner_name":"uA"})
+        resp = self.client.get(url)
+        self.assertEqual(200,resp.status_code)
+        etag = resp["ETag"]
+        def fail_check(user):
+          self.fail("Feeds should not be checked for a not modified river")
+        wom_user.views.check_user_unread_feed_items = fail_check
+        try:
+          resp = self.client.get(url,HTTP_IF_NONE_MATCH=etag)
+        finally:
+          wom_user.views.check_user_unread_feed_items = \
+            check_user_unread_feed_items
+        self.assertEqual(304,resp.status_code)
+        resp = self.client.get(url,{"page": 2},HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200,resp.status_code)
+        r = Reference.objects.create(url="http://moufnew",title="s1new",
+                                     pub_date=datetime.now(timezone.utc))
+        r.sources.add(WebFeed.objects.get(xmlURL="http://mouf/rss.xml").source)
+        resp = self.client.get(url,HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200,resp.status_code)
+        self.assertTrue(ReferenceUserStatus.objects.filter(owner=self.user1,
+                                                           reference=r)\
+                        .exists())
+
 
 class UserSieveViewTest(TestCase):
 
@@ -1184,6 +1583,24 @@ class UserSieveViewTest(TestCase):
           expected_source = getattr(self,"s%d" % int(rust.reference.title[1]))
           self.assertEqual(expected_source,rust.main_source,"Wrong main source for %s" % rust)
         
+    def test_get_html_filtered_by_tag_returns_only_tagged_sources_items(self):
+        """
+        Make sure the sieve can be restricted to the sources with a given tag.
+        """
+        set_item_tag_names(self.user1,
+                           WebFeed.objects.get(xmlURL="http://greuh/rss.xml"),
+                           ["T3"])
+        self.assertTrue(self.client.login(username="uA",password="pA"))
+        resp = self.client.get(reverse("wom_user.views.user_river_sieve",
+                                       kwargs={"owner_name":"uA"}),
+                               {"tag": "T3"})
+        self.assertEqual(200,resp.status_code)
+        self.assertEqual(self.num_items_per_source,
+                         resp.context["num_unread_references"])
+        items = resp.context["oldest_unread_references"]
+        rustTitles = set([int(r.reference.title[1]) for r in items])
+        self.assertEqual(set((3,)),rustTitles)
+        
     def test_get_html_for_non_owner_logged_user_is_forbidden(self):
         """
         Make sure a logged in user can see another user's river.
@@ -1335,6 +1752,70 @@ class UserSieveViewTest(TestCase):
         self.assertEqual(302,resp.status_code)
 
         
+    def test_get_json_returns_oldest_unread_items_first(self):
+        """
+        Make sure the JSON sieve lists the unread items oldest first.
+        """
+        self.assertTrue(self.client.login(username="uA",password="pA"))
+        url = reverse("wom_user.views.user_river_sieve",
+                      kwargs={"owner_name":"uA"})
+        data = simplejson.loads(
+          self.client.get(url,{"format":"json","count":3}).content)
+        self.assertEqual(["http://r1","http://r3","http://r11"],
+                         [i["url"] for i in data["items"]])
+        data = simplejson.loads(
+          self.client.get(url,{"format":"json","count":1,
+                               "cursor":data["next_cursor"]}).content)
+        self.assertEqual(["http://r31"],[i["url"] for i in data["items"]])
+        
+    def test_get_html_not_modified_until_items_are_read(self):
+        """
+        Make sure an unchanged sieve is answered with a 304.
+        """
+        self.assertTrue(self.client.login(username="uA",password="pA"))
+        url = reverse("wom_user.views.user_river_sieve",
+                      kwargs={"owner_name":"uA"})
+        etag = self.client.get(url)["ETag"]
+        resp = self.client.get(url,HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304,resp.status_code)
+        resp = self.client.post(url,
+                                simplejson.dumps({"action":"read",
+                                                  "references":["http://r1"]}),
+                                content_type="application/json",
+                                HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200,resp.status_code)
+        resp = self.client.get(url,HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200,resp.status_code)
+        self.assertNotIn("http://r1",[r.reference.url for r in
+                                      resp.context["oldest_unread_references"]])
+
+    def test_get_html_modified_when_read_statuses_are_deleted(self):
+        """
+        Make sure the sieve's ETag changes when an item is read while
+        an already read item's status is deleted by the cleanup.
+        """
+        self.assertTrue(self.client.login(username="uA",password="pA"))
+        url = reverse("wom_user.views.user_river_sieve",
+                      kwargs={"owner_name":"uA"})
+        def read(reference_url):
+          self.client.post(url,
+                           simplejson.dumps({"action":"read",
+                                             "references":[reference_url]}),
+                           content_type="application/json")
+        self.client.get(url)
+        read("http://r1")
+        etag = self.client.get(url)["ETag"]
+        Reference.objects.filter(url="http://r1")\
+                         .update(pub_date=datetime.now(timezone.utc)\
+                                 -timedelta(weeks=10))
+        delete_old_references_regularly()
+        read("http://r3")
+        self.assertEqual(1,ReferenceUserStatus.objects\
+                         .filter(owner=self.user1,has_been_read=True).count())
+        resp = self.client.get(url,HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200,resp.status_code)
+
+
 class UserSourcesViewTest(TestCase):
 
     def setUp(self):
@@ -1467,17 +1948,118 @@ class UserSourcesViewTest(TestCase):
         resp = self.client.get(reverse("wom_user.views.user_river_sources",
                                        kwargs={"owner_name":"uA"})+"?format=opml")
         self.assertEqual(200,resp.status_code)
-        self.assertIn("sources_opml.xml",[t.name for t in resp.templates])
-        self.assertIn("tagged_web_feeds", resp.context)
+        self.assertTrue(resp["Content-Type"].startswith("text/xml"))
         # All feeds being systematically public they should all be
         # visible (NB: in practice the app guarantees that a source
         # associated to a feed is always public which is not the case
         # here with s3)
-        feed_items = resp.context["tagged_web_feeds"]
-        feedNames = set([int(s.source.title[1]) for s in feed_items])
+        feed_items,_ = parse_opml(resp.content,False)
+        feedNames = set([int(f.title[1]) for f in feed_items])
         self.assertEqual(feedNames,set((1,3)))
-        feedTypes = set([s.source.title[0] for s in feed_items])
+        feedTypes = set([f.title[0] for f in feed_items])
         self.assertEqual(set(("f",)),feedTypes)
+        self.assertEqual(set(["http://mouf/rss.xml","http://greuh/rss.xml"]),
+                         set(f.xmlUrl for f in feed_items))
+
+    def test_get_opml_groups_feeds_by_main_tag(self):
+        """
+        Make sure the feeds are exported under the first of their tags.
+        """
+        f1 = WebFeed.objects.get(xmlURL="http://mouf/rss.xml")
+        f3 = WebFeed.objects.get(xmlURL="http://greuh/rss.xml")
+        set_item_tag_names(self.user1,f1,["zorg","blip"])
+        set_item_tag_names(self.user1,f3,["zorg"])
+        resp = self.client.get(reverse("wom_user.views.user_river_sources",
+                                       kwargs={"owner_name":"uA"})+"?format=opml")
+        self.assertEqual(200,resp.status_code)
+        feed_items,tags = parse_opml(resp.content,False)
+        self.assertEqual(set(["blip","zorg"]),tags)
+        tags_by_url = dict((f.xmlUrl,f.tags) for f in feed_items)
+        self.assertEqual(set(["blip"]),tags_by_url["http://mouf/rss.xml"])
+        self.assertEqual(set(["zorg"]),tags_by_url["http://greuh/rss.xml"])
+
+    def test_get_opml_with_current_etag_is_not_modified(self):
+        """
+        Make sure that repeated downloads of an unchanged OPML export
+        get a 304 response.
+        """
+        url = reverse("wom_user.views.user_river_sources",
+                      kwargs={"owner_name":"uA"})+"?format=opml"
+        resp = self.client.get(url)
+        self.assertEqual(200,resp.status_code)
+        etag = resp["ETag"]
+        resp = self.client.get(url,HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304,resp.status_code)
+        
+    def test_get_html_not_modified_until_sources_change(self):
+        """
+        Make sure an unchanged list of sources is answered with a 304.
+        """
+        url = reverse("wom_user.views.user_river_sources",
+                      kwargs={"owner_name":"uA"})
+        resp = self.client.get(url)
+        self.assertFalse(resp.has_header("Last-Modified"))
+        etag = resp["ETag"]
+        resp = self.client.get(url,HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304,resp.status_code)
+        s4 = Reference.objects.create(url="http://s4",title="s4",
+                                      pub_date=datetime.now(timezone.utc))
+        self.user1.userprofile.public_sources.add(s4)
+        resp = self.client.get(url,HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200,resp.status_code)
+        self.assertIn(s4,resp.context["other_sources"])
+        
+    def test_get_opml_etag_changes_with_feeds_and_tags(self):
+        """
+        Make sure that the validator of the OPML export changes when
+        the feeds or their tags are modified.
+        """
+        url = reverse("wom_user.views.user_river_sources",
+                      kwargs={"owner_name":"uA"})+"?format=opml"
+        etag = self.client.get(url)["ETag"]
+        f2 = WebFeed.objects.get(xmlURL="http://bla/rss.xml")
+        self.user1.userprofile.web_feeds.add(f2)
+        resp = self.client.get(url,HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200,resp.status_code)
+        self.assertIn("http://bla/rss.xml",resp.content)
+        self.assertNotEqual(etag,resp["ETag"])
+        etag = resp["ETag"]
+        set_item_tag_names(self.user1,f2,["newtag"])
+        resp = self.client.get(url,HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200,resp.status_code)
+        self.assertIn("newtag",resp.content)
+        self.assertNotEqual(etag,resp["ETag"])
+        # other users' changes don't invalidate the export
+        etag = resp["ETag"]
+        set_item_tag_names(self.user2,f2,["othertag"])
+        resp = self.client.get(url,HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304,resp.status_code)
+
+    def test_get_opml_etag_changes_when_import_only_adds_tags(self):
+        """
+        Make sure that the OPML export downloaded while an import is
+        running is invalidated once the imported tags are set, even
+        when the import doesn't add any new feed.
+        """
+        url = reverse("wom_user.views.user_river_sources",
+                      kwargs={"owner_name":"uA"})+"?format=opml"
+        import_user_feedsources_from_opml(self.user1,startup.OPML_TXT)
+        etag = self.client.get(url)["ETag"]
+        etags_during_import = []
+        def set_tags_after_download(*args):
+          etags_during_import.append(self.client.get(url)["ETag"])
+          set_items_tag_names(*args)
+        wom_user.tasks.set_items_tag_names = set_tags_after_download
+        try:
+          import_user_feedsources_from_opml(
+            self.user1,startup.OPML_TXT.replace("News","Politics"))
+        finally:
+          wom_user.tasks.set_items_tag_names = set_items_tag_names
+        self.assertEqual(1,len(etags_during_import))
+        resp = self.client.get(url,HTTP_IF_NONE_MATCH=etags_during_import[0])
+        self.assertEqual(200,resp.status_code)
+        self.assertNotEqual(etags_during_import[0],resp["ETag"])
+        self.assertNotEqual(etag,resp["ETag"])
 
 
 class ReferenceUserStatusModelTest(TestCase):
@@ -1596,6 +2178,24 @@ class UserSourceItemViewTest(TestCase):
                          "ref-description": u"blah"}, 302)
     self.assertEqual(newTitle, Reference.objects.get(url=self.source.url).title)
     
+  def test_change_user_source_title_changes_sources_etags(self):
+    self.assertTrue(self.client.login(username="uA",password="pA"))
+    url = reverse("wom_user.views.user_river_sources",
+                  kwargs={"owner_name":"uA"})
+    for source in (self.source,self.feed_source):
+      html_etag = self.client.get(url)["ETag"]
+      opml_etag = self.client.get(url+"?format=opml")["ETag"]
+      self.change_request("uA",source.url,
+                          {"ref-title": source.title+"MOUF",
+                           "ref-description": u"blah"}, 302)
+      resp = self.client.get(url,HTTP_IF_NONE_MATCH=html_etag)
+      self.assertEqual(200,resp.status_code)
+      self.assertIn(source.title+"MOUF",resp.content)
+      resp = self.client.get(url+"?format=opml",HTTP_IF_NONE_MATCH=opml_etag)
+      self.assertEqual(200,resp.status_code)
+      self.assertNotEqual(opml_etag,resp["ETag"])
+    self.assertIn(self.feed_source.title+"MOUF",resp.content)
+    
   def test_change_user_source_title_updates_dont_mess_subscriptions(self):
     # login as uA and make sure it succeeds
     self.assertTrue(self.client.login(username="uA",password="pA"))
@@ -1713,3 +2313,534 @@ class UserBookmarkViewTest(TestCase):
                         {"bmk-is_public": newPrivacy}, 302)
     self.assertEqual(newPrivacy,
                      UserBookmark.objects.get(reference=self.reference).is_public)
+
+
+class StartupTest(TestCase):
+
+  def setUp(self):
+    self.demo = settings.DEMO
+    self.marker_file = settings.BOOTSTRAP_MARKER_FILE
+    self.lock_file = settings.BOOTSTRAP_LOCK_FILE
+    self.tmp_dir = tempfile.mkdtemp()
+    settings.DEMO = True
+    settings.BOOTSTRAP_MARKER_FILE = os.path.join(self.tmp_dir,"done")
+    settings.BOOTSTRAP_LOCK_FILE = os.path.join(self.tmp_dir,"lock")
+    self.bootstrap = startup.bootstrap
+    self.num_bootstraps = 0
+    def counting_bootstrap():
+      self.num_bootstraps += 1
+      self.bootstrap()
+    startup.bootstrap = counting_bootstrap
+
+  def tearDown(self):
+    startup.bootstrap = self.bootstrap
+    settings.DEMO = self.demo
+    settings.BOOTSTRAP_MARKER_FILE = self.marker_file
+    settings.BOOTSTRAP_LOCK_FILE = self.lock_file
+    shutil.rmtree(self.tmp_dir)
+    
+  def test_run_sets_up_demo_user_once(self):
+    startup.run()
+    self.assertEqual(1,self.num_bootstraps)
+    demo_user = User.objects.get(username=settings.DEMO_USER_NAME)
+    self.assertEqual(203,UserBookmark.objects.filter(owner=demo_user).count())
+    # a worker boot is then only a check of the marker file
+    with self.assertNumQueries(0):
+      startup.run()
+    self.assertEqual(1,self.num_bootstraps)
+    
+  def test_bootstrap_command_is_idempotent(self):
+    call_command("wom_bootstrap",stdout=StringIO())
+    call_command("wom_bootstrap",stdout=StringIO())
+    self.assertEqual(2,self.num_bootstraps)
+    self.assertEqual(1,User.objects.filter(username=settings.DEMO_USER_NAME)\
+                     .count())
+    with self.assertNumQueries(0):
+      startup.run()
+
+
+
+PROFILING_MIDDLEWARE_CLASSES = settings.MIDDLEWARE_CLASSES \
+                               + ("wateronmars.profiling.ProfilingMiddleware",)
+
+@override_settings(PROFILING_SAMPLE_RATE=0)
+class ProfilingMiddlewareTest(TestCase):
+
+  def setUp(self):
+    self.user = User.objects.create_user(username="uA",password="pA")
+    UserProfile.objects.create(owner=self.user)
+    self.dump_dir = tempfile.mkdtemp()
+    dump_dir_override = override_settings(PROFILING_DUMP_DIR=self.dump_dir)
+    dump_dir_override.enable()
+    self.addCleanup(dump_dir_override.disable)
+    self.river_url = reverse("wom_user.views.user_river_view",
+                             kwargs={"owner_name":"uA"})
+    
+  def tearDown(self):
+    shutil.rmtree(self.dump_dir)
+
+  def test_server_timing_header(self):
+    with override_settings(MIDDLEWARE_CLASSES=PROFILING_MIDDLEWARE_CLASSES):
+      resp = self.client.get(self.river_url)
+    self.assertEqual(200,resp.status_code)
+    self.assertEqual(set(["sql","template","total","unread_check"]),
+                     set(m.split(";")[0] for m in
+                         resp["Server-Timing"].split(", ")))
+    self.assertRegexpMatches(resp["Server-Timing"],
+                             r'sql;dur=[0-9.]+;desc="\d+ queries"')
+    self.assertEqual([],os.listdir(self.dump_dir))
+
+  def test_view_percentiles(self):
+    view_name = "wom_user.views.user_river_view"
+    count = profiling.view_timings.get(view_name)["count"]
+    with override_settings(MIDDLEWARE_CLASSES=PROFILING_MIDDLEWARE_CLASSES):
+      self.client.get(self.river_url)
+      self.client.get(self.river_url)
+    stats = profiling.view_timings.get(view_name)
+    self.assertEqual(count+2,stats["count"])
+    self.assertTrue(0<stats["p50"]<=stats["p90"]<=stats["p99"])
+
+  def test_rolling_percentiles(self):
+    percentiles = profiling.RollingPercentiles(100)
+    for i in range(150):
+      percentiles.add("v",i)
+    self.assertEqual({"count":100,"p50":100,"p90":140,"p99":149},
+                     percentiles.get("v"))
+    self.assertEqual({"count":0,"p50":None,"p90":None,"p99":None},
+                     percentiles.get("other"))
+    
+  def test_profile_dumped_for_staff_header_or_sampled_requests(self):
+    with override_settings(MIDDLEWARE_CLASSES=PROFILING_MIDDLEWARE_CLASSES):
+      self.client.get(self.river_url,HTTP_X_WOM_PROFILE="1")
+      self.assertEqual([],os.listdir(self.dump_dir))
+      self.user.is_staff = True
+      self.user.save()
+      self.assertTrue(self.client.login(username="uA",password="pA"))
+      resp = self.client.get(self.river_url,HTTP_X_WOM_PROFILE="1")
+      self.assertEqual(200,resp.status_code)
+      dumps = os.listdir(self.dump_dir)
+      self.assertEqual(1,len(dumps))
+      stats = pstats.Stats(os.path.join(self.dump_dir,dumps[0]))
+      self.assertIn("check_user_unread_feed_items",
+                    [f[2] for f in stats.stats.keys()])
+      with override_settings(PROFILING_SAMPLE_RATE=1):
+        self.client.get(self.river_url)
+      self.assertEqual(2,len(os.listdir(self.dump_dir)))
+
+
+class StartupImportsTest(TestCase):
+
+  def test_heavy_modules_not_imported_by_worker_boot(self):
+    _,heavy_modules = benchmarks.startup.measure(
+      benchmarks.startup.WSGI_BOOT_SCRIPT,1)
+    self.assertEqual(set(),heavy_modules)
+
+
+# Sizes of the datasets on which the query budgets are checked
+QUERY_BUDGET_SIZES = (5,40)
+
+class QueryBudgetTest(TestCase,QueryBudgetTestMixin):
+  """Check that the number of queries run by the views and tasks
+  doesn't depend on the number of items they handle."""
+  
+  def setUp(self):
+    self.user = User.objects.create_user(username="uA",password="pA")
+    self.profile = UserProfile.objects.create(owner=self.user)
+    self.date = datetime.now(timezone.utc)-timedelta(days=1)
+    self.feeds = []
+    for name in ("a","b"):
+      source = Reference.objects.create(url=u"http://%s" % name,
+                                        title=name,pub_date=self.date)
+      feed = WebFeed.objects.create(xmlURL=u"http://%s/rss.xml" % name,
+                                    last_update_check=self.date,
+                                    source=source)
+      self.profile.web_feeds.add(feed)
+      self.profile.sources.add(source)
+      set_item_tag_names(self.user,feed,[u"tag_%s" % name])
+      self.feeds.append(feed)
+    self.num_items = 0
+    self.num_bookmarks = 0
+    self.num_sources = 0
+    self.assertTrue(self.client.login(username="uA",password="pA"))
+    
+  def add_news_items(self,size):
+    """Make sure that each feed has size items."""
+    for feed in self.feeds:
+      for i in range(self.num_items,size):
+        r = Reference.objects.create(url=u"%s/%d" % (feed.source.url,i),
+                                     title=u"item %d" % i,
+                                     description=u"<p>item</p>",
+                                     pub_date=self.date+timedelta(hours=i))
+        r.sources.add(feed.source)
+    self.num_items = size
+    
+  def add_read_news_items(self,size):
+    self.add_news_items(size)
+    check_user_unread_feed_items(self.user)
+    
+  def add_bookmarks(self,size):
+    for i in range(self.num_bookmarks,size):
+      r = Reference.objects.create(url=u"http://bmk/%d" % i,
+                                   title=u"bmk %d" % i,
+                                   pub_date=self.date)
+      r.sources.add(self.feeds[i % 2].source)
+      UserBookmark.objects.create(owner=self.user,reference=r,
+                                  saved_date=self.date,is_public=True)
+      set_item_tag_names(self.user,r,[u"t%d" % i,u"common"])
+    self.num_bookmarks = size
+    
+  def add_sources(self,size):
+    for i in range(self.num_sources,size):
+      source = Reference.objects.create(url=u"http://src/%d" % i,
+                                        title=u"src %d" % i,
+                                        pub_date=self.date)
+      feed = WebFeed.objects.create(xmlURL=u"http://src/%d/rss.xml" % i,
+                                    last_update_check=self.date,
+                                    source=source)
+      self.profile.web_feeds.add(feed)
+      self.profile.sources.add(source)
+      set_item_tag_names(self.user,feed,[u"t%d" % i,u"common"])
+    self.num_sources = size
+
+  def get_page(self,view_name,query=""):
+    url = reverse(view_name,kwargs={"owner_name":"uA"})+query
+    def get():
+      resp = self.client.get(url)
+      self.assertEqual(200,resp.status_code)
+    return get
+
+  def check_page(self,budget,view_name,prepare,query=""):
+    get = self.get_page(view_name,query)
+    self.assertQueryBudget(budget,QUERY_BUDGET_SIZES,
+                           lambda size: prepare(size) or (),get)
+    
+  def test_river_page(self):
+    self.check_page(12,"wom_user.views.user_river_view",
+                    self.add_read_news_items)
+
+  def test_river_page_json(self):
+    self.check_page(11,"wom_user.views.user_river_view",
+                    self.add_read_news_items,"?format=json")
+
+  def test_sieve_page(self):
+    self.check_page(12,"wom_user.views.user_river_sieve",
+                    self.add_read_news_items)
+    
+  def test_sieve_page_json(self):
+    self.check_page(11,"wom_user.views.user_river_sieve",
+                    self.add_read_news_items,"?format=json")
+    
+  def test_collection_page(self):
+    self.check_page(COLLECTION_PAGE_QUERY_BUDGET,
+                    "wom_user.views.user_collection",self.add_bookmarks)
+    
+  def test_collection_page_json(self):
+    self.check_page(COLLECTION_PAGE_QUERY_BUDGET,
+                    "wom_user.views.user_collection",self.add_bookmarks,
+                    "?format=json")
+
+  def test_collection_ns_bookmark_list(self):
+    self.check_page(COLLECTION_PAGE_QUERY_BUDGET,
+                    "wom_user.views.user_collection",self.add_bookmarks,
+                    "?format=ns_bmk_list")
+    
+  def test_sources_page(self):
+    self.check_page(9,"wom_user.views.user_river_sources",self.add_sources)
+
+  def test_sources_opml(self):
+    self.check_page(5,"wom_user.views.user_river_sources",self.add_sources,
+                    "?format=opml")
+
+  def test_check_user_unread_feed_items(self):
+    self.assertQueryBudget(9,QUERY_BUDGET_SIZES,
+                           lambda size: self.add_news_items(size) \
+                           or (self.user,),
+                           check_user_unread_feed_items)
+
+  def test_mark_sieve_items_as_read(self):
+    def prepare(size):
+      self.add_read_news_items(size)
+      return ([r.url for r in Reference.objects\
+               .filter(url__startswith=u"http://a/")],)
+    def post_read(urls):
+      resp = self.client.post(
+        reverse("wom_user.views.user_river_sieve",kwargs={"owner_name":"uA"}),
+        simplejson.dumps({"action":"read","references":urls}),
+        content_type="application/json")
+      self.assertEqual(200,resp.status_code)
+    self.assertQueryBudget(5,QUERY_BUDGET_SIZES,prepare,post_read)
+    
+  def test_import_opml(self):
+    def prepare(size):
+      return (self.user,"""<?xml version="1.0" encoding="UTF-8"?>
+<opml version="2.0"><head><title>t</title></head><body>
+<outline text="folder">%s</outline></body></opml>""" \
+              % "".join('<outline text="f%d" type="rss" '
+                        'xmlUrl="http://opml%d/%d/rss" '
+                        'htmlUrl="http://opml%d/%d"/>' % (i,size,i,size,i)
+                        for i in range(size)))
+    self.assertQueryBudget(31,QUERY_BUDGET_SIZES,prepare,
+                           import_user_feedsources_from_opml)
+
+  def test_import_ns_bookmarks(self):
+    def prepare(size):
+      return (self.user,"<!DOCTYPE NETSCAPE-Bookmark-file-1>\n"+"\n".join(
+        '<DT><A HREF="http://nsbmk%d/%d" ADD_DATE="1367951483" PRIVATE="0" '
+        'TAGS="t%d,common">Bookmark %d</A>' % (size,i,i,i)
+        for i in range(size)))
+    self.assertQueryBudget(27,QUERY_BUDGET_SIZES,prepare,
+                           import_user_bookmarks_from_ns_list)
+
+  def test_delete_old_references(self):
+    def prepare(size):
+      old_date = self.date-timedelta(weeks=10)
+      for i in range(size):
+        r = Reference.objects.create(url=u"http://old%d/%d" % (size,i),
+                                     title=u"old",pub_date=old_date)
+        r.sources.add(self.feeds[0].source)
+        ReferenceUserStatus.objects.create(reference=r,owner=self.user,
+                                           reference_pub_date=old_date,
+                                           main_source=self.feeds[0].source)
+      return (self.date-timedelta(weeks=4),)
+    self.assertQueryBudget(11,QUERY_BUDGET_SIZES,prepare,
+                           delete_old_references)
+
+  def test_failure_lists_the_duplicated_queries(self):
+    def get_bookmark_titles():
+      return [b.reference.title for b in UserBookmark.objects.all()]
+    with self.assertRaises(AssertionError) as cm:
+      self.assertQueryBudget(100,QUERY_BUDGET_SIZES,
+                             lambda size: self.add_bookmarks(size) or (),
+                             get_bookmark_titles)
+    self.assertIn("grows with the size",str(cm.exception))
+    self.assertIn('   40x SELECT "wom_pebbles_reference"."id"',
+                  str(cm.exception))
+
+
+
+# Values received by record_job_call
+JOB_CALLS = []
+
+@task(max_attempts=2)
+def record_job_call(value,fail=False):
+  JOB_CALLS.append(value)
+  if fail:
+    raise ValueError("Failing on purpose")
+
+
+class JobQueueTest(TestCase):
+
+  def setUp(self):
+    del JOB_CALLS[:]
+
+  def test_delay_queues_a_job_for_the_worker(self):
+    job = record_job_call.delay(1)
+    self.assertEqual(Job.QUEUED,job.status)
+    self.assertEqual([],JOB_CALLS)
+    self.assertEqual(1,run_pending_jobs())
+    self.assertEqual([1],JOB_CALLS)
+    job = Job.objects.get(id=job.id)
+    self.assertEqual(Job.DONE,job.status)
+    self.assertEqual(1,job.attempts)
+    
+  def test_failed_job_is_retried_later_then_marked_failed(self):
+    job = record_job_call.delay(2,fail=True)
+    self.assertEqual(1,run_pending_jobs())
+    job = Job.objects.get(id=job.id)
+    self.assertEqual(Job.QUEUED,job.status)
+    self.assertTrue(job.run_after>timezone.now())
+    self.assertIn("Failing on purpose",job.last_error)
+    Job.objects.filter(id=job.id).update(run_after=timezone.now())
+    self.assertEqual(1,run_pending_jobs())
+    job = Job.objects.get(id=job.id)
+    self.assertEqual(Job.FAILED,job.status)
+    self.assertEqual(2,job.attempts)
+    self.assertEqual([2,2],JOB_CALLS)
+
+  def test_job_is_claimed_by_a_single_worker(self):
+    job = record_job_call.delay(3)
+    self.assertEqual(job.id,claim_next_job("first").id)
+    self.assertEqual(None,claim_next_job("second"))
+    self.assertEqual("first",Job.objects.get(id=job.id).worker)
+    
+  def test_job_of_dead_worker_is_queued_again(self):
+    job = record_job_call.delay(4)
+    claim_next_job("dead")
+    long_ago = timezone.now()-2*JOB_HEARTBEAT_TIMEOUT
+    Job.objects.filter(id=job.id).update(started_date=long_ago,
+                                         heartbeat_date=long_ago)
+    self.assertEqual(1,requeue_stale_jobs())
+    self.assertEqual(1,run_pending_jobs())
+    self.assertEqual([4],JOB_CALLS)
+
+  def test_long_job_of_living_worker_is_not_queued_again(self):
+    job = record_job_call.delay(5)
+    claim_next_job("alive")
+    long_ago = timezone.now()-2*JOB_HEARTBEAT_TIMEOUT
+    Job.objects.filter(id=job.id).update(started_date=long_ago,
+                                         heartbeat_date=long_ago)
+    beat(["alive"])
+    self.assertEqual(0,requeue_stale_jobs())
+    self.assertEqual(Job.RUNNING,Job.objects.get(id=job.id).status)
+
+  def test_outcome_of_reclaimed_job_is_discarded(self):
+    job = record_job_call.delay(6)
+    first_claim = claim_next_job("dead")
+    Job.objects.filter(id=job.id).update(status=Job.QUEUED)
+    second_claim = claim_next_job("other")
+    self.assertEqual(None,run_job(first_claim))
+    job = Job.objects.get(id=job.id)
+    self.assertEqual((Job.RUNNING,"other",2),
+                     (job.status,job.worker,job.attempts))
+    self.assertEqual(Job.DONE,run_job(second_claim))
+    self.assertEqual(Job.DONE,Job.objects.get(id=job.id).status)
+
+  def test_crontab_next_after(self):
+    date = datetime(2013,5,1,10,20,30,tzinfo=timezone.utc)
+    self.assertEqual(date.replace(minute=40,second=0),
+                     crontab(minute="*/20").next_after(date))
+    self.assertEqual(date.replace(hour=12,minute=0,second=0),
+                     crontab(minute="0",hour="*/12").next_after(date))
+    # 2013-05-01 is a Wednesday and 0 stands for Sunday
+    self.assertEqual(datetime(2013,5,5,0,0,tzinfo=timezone.utc),
+                     crontab(minute=0,hour=0,day_of_week=0).next_after(date))
+    
+  def test_periodic_tasks_are_scheduled_once(self):
+    now = datetime(2013,5,1,10,20,30,tzinfo=timezone.utc)
+    self.assertEqual(2,schedule_periodic_tasks(now))
+    self.assertEqual(0,schedule_periodic_tasks(now))
+    job = Job.objects.get(name=get_task_name(collect_all_new_references_regularly))
+    self.assertEqual(now.replace(minute=40,second=0),job.run_after)
+    
+  def test_update_request_only_queues_a_job(self):
+    for i in range(2):
+      resp = self.client.get("/houston/we_ve_got_an_update_request/")
+      self.assertEqual(302,resp.status_code)
+    jobs = Job.objects.filter(name=get_task_name(update_all_references))
+    self.assertEqual(1,jobs.count())
+    self.assertEqual(Job.QUEUED,jobs[0].status)
+    
+  def test_worker_command_runs_due_jobs_once(self):
+    record_job_call.delay(5)
+    out = StringIO()
+    call_command("wom_worker",once=True,stdout=out)
+    self.assertEqual([5],JOB_CALLS)
+    self.assertEqual("1 job(s) run.\n",out.getvalue())
+    # the periodic tasks are scheduled for later
+    self.assertEqual(2,Job.objects.filter(status=Job.QUEUED).count())
+
+
+class ImportJobTest(TestCase):
+
+  def setUp(self):
+    self.user = User.objects.create_user(username="uA",password="pA")
+    UserProfile.objects.create(owner=self.user)
+    other_user = User.objects.create_user(username="uB",password="pB")
+    UserProfile.objects.create(owner=other_user)
+    self.other_job = record_job_call.delay(0)
+    self.assertTrue(self.client.login(username="uA",password="pA"))
+    # uploaded files are saved in a temporary storage
+    self.media_root = tempfile.mkdtemp()
+    media_root_override = override_settings(MEDIA_ROOT=self.media_root)
+    media_root_override.enable()
+    self.addCleanup(media_root_override.disable)
+    default_storage._wrapped = empty
+    self.addCleanup(setattr,default_storage,"_wrapped",empty)
+
+  def tearDown(self):
+    shutil.rmtree(self.media_root)
+
+  def upload(self,view_name,field_name,file_name,content):
+    uploaded_file = StringIO(content)
+    uploaded_file.name = file_name
+    url = reverse(view_name,kwargs={"owner_name":"uA"})
+    return self.client.post(url,{field_name: uploaded_file})
+
+  def get_status(self,job_id,owner_name="uA"):
+    url = reverse("wom_user.views.user_job_status",
+                  kwargs={"owner_name":owner_name,"job_id":job_id})
+    return self.client.get(url,{"format":"json"})
+
+  def test_opml_upload_is_imported_in_background(self):
+    resp = self.upload("wom_user.views.user_upload_opml","opml_file",
+                       "feeds.opml",startup.OPML_TXT)
+    job = Job.objects.get(owner=self.user)
+    self.assertRedirects(resp,
+                         reverse("wom_user.views.user_job_status",
+                                 kwargs={"owner_name":"uA","job_id":job.id}))
+    # only the path of the saved upload is stored with the job
+    (user,file_name),_ = pickle.loads(base64.b64decode(job.arguments))
+    self.assertEqual(self.user,user)
+    self.assertTrue(file_name.startswith(IMPORT_UPLOAD_DIR+"/"))
+    self.assertEqual(startup.OPML_TXT,default_storage.open(file_name).read())
+    self.assertNotIn("<opml",job.arguments)
+    self.assertEqual(0,self.user.userprofile.web_feeds.count())
+    self.assertEqual({"id":job.id,"status":"queued",
+                      "processed":0,"total":0},
+                     simplejson.loads(self.get_status(job.id).content))
+    run_pending_jobs()
+    self.assertEqual(3,self.user.userprofile.web_feeds.count())
+    self.assertEqual({"id":job.id,"status":"done",
+                      "processed":3,"total":3},
+                     simplejson.loads(self.get_status(job.id).content))
+    self.assertFalse(default_storage.exists(file_name))
+
+  def test_bookmarks_upload_progress_reported_by_batch(self):
+    reported = []
+    def record_progress(processed,total=None):
+      reported.append((processed,total))
+      report_progress(processed,total)
+    wom_user.tasks.report_progress = record_progress
+    wom_user.tasks.IMPORT_BATCH_SIZE = 2
+    try:
+      self.upload("wom_user.views.user_upload_nsbmk","bookmarks_file",
+                  "bookmarks.html",startup.NS_BOOKMARKS_TXT)
+      self.assertEqual(0,UserBookmark.objects.filter(owner=self.user).count())
+      run_pending_jobs()
+    finally:
+      wom_user.tasks.report_progress = report_progress
+      wom_user.tasks.IMPORT_BATCH_SIZE = IMPORT_BATCH_SIZE
+    # the progress is measured in bytes read from the file
+    size = len(startup.NS_BOOKMARKS_TXT)
+    self.assertEqual(3,len(reported))
+    self.assertEqual([size]*3,[total for _,total in reported])
+    self.assertEqual((size,size),reported[-1])
+    self.assertEqual(3,UserBookmark.objects.filter(owner=self.user).count())
+    job = Job.objects.get(owner=self.user)
+    self.assertEqual((Job.DONE,size,size),
+                     (job.status,job.processed,job.total))
+    self.assertEqual([],os.listdir(os.path.join(self.media_root,
+                                                IMPORT_UPLOAD_DIR)))
+
+  def test_failed_upload_kept_until_last_attempt(self):
+    self.upload("wom_user.views.user_upload_nsbmk","bookmarks_file",
+                "bookmarks.html","not a bookmark file")
+    job = Job.objects.get(owner=self.user)
+    (_,file_name),_ = pickle.loads(base64.b64decode(job.arguments))
+    run_pending_jobs()
+    job = Job.objects.get(id=job.id)
+    self.assertEqual(Job.QUEUED,job.status)
+    self.assertTrue(default_storage.exists(file_name))
+    Job.objects.filter(id=job.id).update(run_after=timezone.now(),
+                                         attempts=job.max_attempts-1)
+    run_pending_jobs()
+    self.assertEqual(Job.FAILED,Job.objects.get(id=job.id).status)
+    self.assertFalse(default_storage.exists(file_name))
+
+  def test_status_page(self):
+    job = record_job_call.delay(1)
+    Job.objects.filter(id=job.id).update(owner=self.user)
+    url = reverse("wom_user.views.user_job_status",
+                  kwargs={"owner_name":"uA","job_id":job.id})
+    resp = self.client.get(url)
+    self.assertEqual(200,resp.status_code)
+    self.assertEqual(job.id,resp.context["job"].id)
+    self.assertEqual(None,resp.context["destination_url"])
+    self.assertEqual("max-age=0",resp["Cache-Control"])
+
+  def test_status_only_shown_to_the_owner(self):
+    # jobs of other users can't be seen even via the owner's url
+    self.assertEqual(404,self.get_status(self.other_job.id).status_code)
+    self.assertEqual(403,self.get_status(self.other_job.id,"uB").status_code)
+    self.client.logout()
+    self.assertEqual(302,self.get_status(self.other_job.id,"uB").status_code)
@@ -18,20 +18,29 @@
 # along with WaterOnMars.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import calendar
+import hashlib
+from functools import wraps
 from datetime import datetime
+from datetime import timedelta
 from django.utils import timezone
 from django.utils.http import urlunquote_plus
+from django.utils.http import quote_etag
+from django.utils.html import escape
+from django.template.defaultfilters import striptags
+from django.template.defaultfilters import truncatewords
 
 from django.conf import settings
 from django.template import RequestContext
 from django.core.urlresolvers import reverse
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
+from django.core.files.storage import default_storage
 
 from wom_pebbles.models import Reference
-from wom_classification.models import get_item_tag_names
 from wom_classification.models import get_user_tags
-from wom_pebbles.tasks import delete_old_references
-from wom_river.tasks import collect_news_from_feeds
+from wom_classification.models import get_user_tag_counts
+from wom_classification.models import get_items_tag_names
+from wom_pebbles.tasks import split_in_chunks
 
 from django.http import HttpResponse
 from django.http import HttpResponseNotAllowed
@@ -45,16 +54,28 @@ from django.shortcuts import render_to_response
 from django.utils import simplejson
 from django.forms.util import ErrorList
 from django.db import transaction
+from django.db.models import Max
+from django.db.models import Q
 
 from django.views.decorators.http import require_http_methods
+from django.views.decorators.http import condition
+from django.views.decorators.cache import never_cache
+from django.core.cache import cache
 from django.views.decorators.csrf import csrf_protect
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
 from django.contrib.auth import logout
 
 from wom_river.models import WebFeed
+from wom_user.models import UserProfile
 from wom_user.models import UserBookmark
 from wom_user.models import ReferenceUserStatus
+from wom_user.models import get_user_source_ids_with_tag
+from wom_user.models import get_visible_sources_by_reference
+from wom_user.models import get_user_news_marker
+from wom_user.models import touch_user_sources
+from wom_user.models import touch_user_news
+from wom_user.models import Job
 
 from wom_user.forms import OPMLFileUploadForm
 from wom_user.forms import NSBookmarkFileUploadForm
@@ -67,11 +88,20 @@ from wom_user.forms import WebFeedOptInOutForm
 
 
 from wom_user.tasks import import_user_feedsources_from_opml
+from wom_user.tasks import import_user_feedsources_from_opml_file
 from wom_user.tasks import import_user_bookmarks_from_ns_list
+from wom_user.tasks import import_user_bookmarks_from_ns_file
 from wom_user.tasks import check_user_unread_feed_items
+from wom_user.tasks import update_all_references
+from wom_user.tasks import delete_old_references_regularly
+
+from wom_user.jobs import enqueue
+from wom_user.jobs import get_task_name
 
-from wom_user.settings import NEWS_TIME_THRESHOLD
 from wom_user.settings import MAX_ITEMS_PER_PAGE
+from wom_user.settings import EXPORT_BATCH_SIZE
+from wom_user.settings import IMPORT_UPLOAD_DIR
+from wom_user.settings import OPML_CACHE_TIMEOUT
 from wom_user.settings import HUMANS_TEAM
 from wom_user.settings import HUMANS_THANKS
 
@@ -88,7 +118,7 @@ def check_and_set_owner(func):
 
   If the owner doesn't exists, the visitor is redirected to 404.
   """
-  
+  @wraps(func)
   def _check_and_set_owner(request, owner_name, *args, **kwargs):
      try:
        owner_user = User.objects.get(username=owner_name)
@@ -115,6 +145,7 @@ def loggedin_and_owner_required(func):
   # requests !)
   @login_required(login_url=settings.LOGIN_URL)
   @check_and_set_owner
+  @wraps(func)
   def _loggedin_and_owner_required(request, owner_name, *args, **kwargs):
     if request.user != request.owner_user:
       return HttpResponseForbidden()
@@ -123,6 +154,15 @@ def loggedin_and_owner_required(func):
   return _loggedin_and_owner_required
 
 
+def build_etag(request,*markers):
+  """
+  Return an ETag for the page requested by the visitor, given the
+  change markers of the data displayed on the page.
+  """
+  key = repr((request.user.username,request.get_full_path())+markers)
+  return hashlib.md5(key).hexdigest()
+
+
 def add_base_template_context_data(d,visitor_name, owner_name):
   """Generate the context data needed for templates that inherit from
   the base template.
@@ -185,27 +225,19 @@ def home(request):
 
 
 def request_for_update(request):
-  """Trigger the collection of news from all known feeds and the cleanup
+  """Queue the collection of news from all known feeds and the cleanup
   of all references that have never been saved (past an arbitrary
-  delay).
+  delay), to be run by the wom_worker command.
   """
-  delete_old_references(datetime.now(timezone.utc)-NEWS_TIME_THRESHOLD)
-  collect_news_from_feeds()
-  if settings.DEMO:
-    # keep only a short number of refs (the most recent) to avoid bloating the demo
-    with transaction.commit_on_success():
-      for ref in list(Reference.objects\
-                      .filter(save_count=0)\
-                      .order_by("-pub_date")[MAX_ITEMS_PER_PAGE:]):
-        ref.delete()
+  enqueue(get_task_name(update_all_references),unique=True)
   return HttpResponseRedirect(reverse("wom_user.views.home"))
 
 
 def request_for_cleanup(request):
-  """Trigger a cleanup of all references that have never been saved
-  (past an arbitrary delay).
+  """Queue a cleanup of all references that have never been saved
+  (past an arbitrary delay), to be run by the wom_worker command.
   """
-  delete_old_references(datetime.now(timezone.utc)-NEWS_TIME_THRESHOLD)
+  enqueue(get_task_name(delete_old_references_regularly),unique=True)
   return HttpResponseRedirect(reverse("wom_user.views.home"))
 
 
@@ -299,10 +331,45 @@ def user_root(request,owner_name):
   return HttpResponseRedirect(reverse("wom_user.views.user_river_view", args=(owner_name,)))
 
 
+def get_import_jobs():
+  """Return a dictionary mapping the names of the import tasks to the
+  title of the corresponding jobs and to the view displaying the
+  imported items."""
+  return {
+    get_task_name(import_user_feedsources_from_opml_file):
+      ("Subscriptions import","wom_user.views.user_river_sources"),
+    get_task_name(import_user_bookmarks_from_ns_file):
+      ("Bookmarks import","wom_user.views.user_collection"),
+    }
+
+
+def queue_import(import_task,uploadedFile,user):
+  """Save an uploaded file in the default storage, queue its import
+  (to be run by the wom_worker command) and return the url of the
+  page showing the progress of the import.
+
+  Only the path of the saved file is stored with the job, the import
+  task deleting the file when it's done.
+  """
+  file_name = default_storage.save("%s/%s" % (IMPORT_UPLOAD_DIR,
+                                              uploadedFile.name),
+                                   uploadedFile)
+  job = enqueue(get_task_name(import_task),(user,file_name),owner=user)
+  return reverse("wom_user.views.user_job_status",
+                 args=(user.username,job.id))
+
+
 def handle_uploaded_opml(opmlUploadedFile,user):
+  """Import the feeds of an uploaded OPML file and return the url of
+  the page to be redirected to."""
   if opmlUploadedFile.name.endswith(".opml") \
      or opmlUploadedFile.name.endswith(".xml"):
-    import_user_feedsources_from_opml(user,opmlUploadedFile.read())
+    if settings.USE_CELERY:
+      import_user_feedsources_from_opml(user,opmlUploadedFile.read())
+      return reverse("wom_user.views.user_river_sources",
+                     args=(user.username,))
+    return queue_import(import_user_feedsources_from_opml_file,
+                        opmlUploadedFile,user)
   else:
     raise ValueError("Uploaded file '%s' is not OPML !" % opmlUploadedFile.name)
     
@@ -317,9 +384,8 @@ def user_upload_opml(request,owner_name):
     form = OPMLFileUploadForm(request.POST, request.FILES,
                               error_class=CustomErrorList)
     if form.is_valid():
-      handle_uploaded_opml(request.FILES['opml_file'],user=request.user)
-      return HttpResponseRedirect(reverse("wom_user.views.user_river_sources",
-                                          args=(request.user.username,)))
+      return HttpResponseRedirect(
+        handle_uploaded_opml(request.FILES['opml_file'],user=request.user))
   else:
     form = OPMLFileUploadForm(error_class=CustomErrorList)
   d = add_base_template_context_data({'form': form},
@@ -333,9 +399,16 @@ def user_upload_opml(request,owner_name):
 
 
 def handle_uploaded_nsbmk(nsbmkUploadedFile,user):
+  """Import the bookmarks of an uploaded Netscape-style bookmark file
+  and return the url of the page to be redirected to."""
   if nsbmkUploadedFile.name.endswith(".html") \
      or nsbmkUploadedFile.name.endswith(".htm"):
-    import_user_bookmarks_from_ns_list(user,nsbmkUploadedFile.read())
+    if settings.USE_CELERY:
+      import_user_bookmarks_from_ns_list(user,nsbmkUploadedFile)
+      return reverse("wom_user.views.user_collection",
+                     args=(user.username,))
+    return queue_import(import_user_bookmarks_from_ns_file,
+                        nsbmkUploadedFile,user)
   else:
     raise ValueError("Uploaded file '%s' is not a Netscape-style bookmarks file !"\
                      % nsbmkUploadedFile.name)
@@ -351,9 +424,9 @@ def user_upload_nsbmk(request,owner_name):
     form = NSBookmarkFileUploadForm(request.POST, request.FILES,
                                     error_class=CustomErrorList)
     if form.is_valid():
-      handle_uploaded_nsbmk(request.FILES['bookmarks_file'],user=request.user)
-      return HttpResponseRedirect(reverse("wom_user.views.user_collection",
-                                          args=(request.user.username,)))
+      return HttpResponseRedirect(
+        handle_uploaded_nsbmk(request.FILES['bookmarks_file'],
+                              user=request.user))
   else:
     form = NSBookmarkFileUploadForm(error_class=CustomErrorList)
   d = add_base_template_context_data({'form': form},
@@ -363,6 +436,32 @@ def user_upload_nsbmk(request,owner_name):
                             context_instance=RequestContext(request))
 
 
+@loggedin_and_owner_required
+@never_cache
+@require_http_methods(["GET"])
+def user_job_status(request,owner_name,job_id):
+  """Show the progress of one of the owner's background jobs, as a JSON
+  dictionary if the 'format' parameter is set to 'json'."""
+  try:
+    job = Job.objects.get(id=job_id,owner=request.owner_user)
+  except Job.DoesNotExist:
+    return HttpResponseNotFound()
+  status = {"id": job.id, "status": job.status,
+            "processed": job.processed, "total": job.total}
+  if request.GET.get("format","html").lower()=="json":
+    return HttpResponse(simplejson.dumps(status),mimetype="application/json")
+  title,destination_view = get_import_jobs().get(job.name,
+                                                 ("Background task",None))
+  d = add_base_template_context_data({
+    'job': job,
+    'job_title': title,
+    'destination_url': reverse(destination_view,args=(owner_name,)) \
+                       if destination_view else None,
+    }, request.user.username, owner_name)
+  return render_to_response('job_status.html',d,
+                            context_instance=RequestContext(request))
+
+
 @loggedin_and_owner_required
 @csrf_protect
 @require_http_methods(["GET","POST"])
@@ -456,6 +555,10 @@ def user_river_source_item(request, owner_name, source_url):
       return HttpResponseForbidden("Source editting is not possible in DEMO mode.")
     if form.is_valid() and optOutFormsAreValid():
       form.save()
+      # the source's title or url appear on the sources pages and
+      # exports of all the users having it
+      touch_user_sources(sources=reference)
+      touch_user_sources(public_sources=reference)
       optOutFormsSave()
       return HttpResponseRedirect(reverse('wom_user.views.user_river_source_item',
                                           args=(request.user.username, source_url)))
@@ -532,7 +635,176 @@ def post_to_user_collection(request,owner_name):
                       mimetype='application/json')
 
 
+NS_BOOKMARK_LIST_HEADER = u"""\
+<!DOCTYPE NETSCAPE-Bookmark-file-1>
+<META HTTP-EQUIV="Content-Type" CONTENT="text/html; charset=UTF-8">
+<!-- This is an automatically generated file.
+It will be read and overwritten.
+Do Not Edit! -->
+<TITLE>Bookmarks</TITLE>
+<H1>WaterOnMars pebbles collected by %s</H1>
+<DL><p>
+"""
+
+NS_BOOKMARK_LIST_ITEM = u"""\
+<DT><A HREF="%(url)s" PRIVATE="%(private)s" TAGS="%(tags)s" ADD_DATE="%(add_date)d">%(title)s</A>
+<DD>%(comment)s %(description)s
+"""
+
+NS_BOOKMARK_LIST_FOOTER = u"</DL><p>\n"
+
+
+def generate_ns_bookmark_list(owner,bookmarks):
+  """Yield the content of a Netscape-style bookmark file listing the
+  bookmarks, piece by piece.
+
+  The bookmarks are loaded by batches of EXPORT_BATCH_SIZE together
+  with their tags so that the memory and the number of queries stay
+  bounded whatever the size of the collection.
+  """
+  yield NS_BOOKMARK_LIST_HEADER % escape(owner.username)
+  bookmark_ids = list(bookmarks.values_list("id",flat=True))
+  for id_batch in split_in_chunks(bookmark_ids,EXPORT_BATCH_SIZE):
+    bookmarks_by_id = UserBookmark.objects.select_related("reference")\
+                                          .in_bulk(id_batch)
+    tag_names = get_items_tag_names(owner,Reference,
+                                    [b.reference_id
+                                     for b in bookmarks_by_id.values()])
+    items = []
+    for bmk_id in id_batch:
+      bmk = bookmarks_by_id[bmk_id]
+      ref = bmk.reference
+      items.append(NS_BOOKMARK_LIST_ITEM % {
+        "url": escape(ref.url),
+        "private": "0" if bmk.is_public else "1",
+        "tags": escape(",".join(t for t in tag_names.get(ref.id,[])
+                                if t.strip())),
+        "add_date": calendar.timegm(bmk.saved_date.utctimetuple()),
+        "title": escape(ref.title),
+        "comment": escape(truncatewords(striptags(bmk.comment),30)),
+        "description": escape(truncatewords(striptags(ref.description),30)),
+        })
+    yield u"".join(items)
+  yield NS_BOOKMARK_LIST_FOOTER
+
+
+# Map the fields that can be requested from the JSON representations
+# to the corresponding value() lookups.
+NEWS_JSON_FIELDS = {
+  "url": "reference__url",
+  "title": "reference__title",
+  "date": "reference_pub_date",
+  "description": "reference__description",
+  "source_url": "main_source__url",
+  "source_title": "main_source__title",
+  "read": "has_been_read",
+  "saved": "has_been_saved",
+  }
+
+COLLECTION_JSON_FIELDS = {
+  "url": "reference__url",
+  "title": "reference__title",
+  "date": "saved_date",
+  "pub_date": "reference__pub_date",
+  "description": "reference__description",
+  "comment": "comment",
+  "public": "is_public",
+  }
+
+JSON_DEFAULT_FIELDS = "url,title,date"
+
+EPOCH = datetime.utcfromtimestamp(0).replace(tzinfo=timezone.utc)
+
+
+def encode_cursor(date,item_id):
+  """
+  Return the cursor pointing after the item with the given date and id.
+  """
+  delta = date-EPOCH
+  return "%d-%d" % ((delta.days*86400+delta.seconds)*10**6+delta.microseconds,
+                    item_id)
+
+
+def decode_cursor(cursor):
+  """
+  Return the date and id encoded in the cursor or raise a ValueError.
+  """
+  microseconds,item_id = cursor.rsplit("-",1)
+  return EPOCH+timedelta(microseconds=int(microseconds)),int(item_id)
+
+
+def to_json_value(value):
+  if isinstance(value,datetime):
+    return value.isoformat()
+  return value
+
+  
+def generate_json_page(request,items,json_fields,date_field,ascending=False):
+  """
+  Return a response with the JSON representation of a page of the
+  items, ordered by date and then by id.
+
+  The page is selected by the 'cursor' parameter (as given as
+  'next_cursor' in the previous page), the number of items by 'count'
+  (MAX_ITEMS_PER_PAGE at most) and the fields to send for each item by
+  a comma separated list in 'fields' (among the keys of json_fields).
+  """
+  field_names = request.GET.get("fields",JSON_DEFAULT_FIELDS).split(",")
+  unknown_fields = [f for f in field_names if f not in json_fields]
+  if unknown_fields:
+    return HttpResponseBadRequest("Unknown fields: %s (expected some of: %s)" \
+                                  % (",".join(unknown_fields),
+                                     ",".join(sorted(json_fields))))
+  try:
+    count = min(int(request.GET.get("count",MAX_ITEMS_PER_PAGE)),
+                MAX_ITEMS_PER_PAGE)
+  except ValueError:
+    count = 0
+  if count<=0:
+    return HttpResponseBadRequest("The count must be a positive integer.")
+  cursor = request.GET.get("cursor")
+  if cursor:
+    try:
+      cursor_date,cursor_id = decode_cursor(cursor)
+    except ValueError:
+      return HttpResponseBadRequest("Invalid cursor.")
+    direction = "gt" if ascending else "lt"
+    items = items.filter(
+      Q(**{"%s__%s" % (date_field,direction): cursor_date})
+      | Q(**{date_field: cursor_date, "id__%s" % direction: cursor_id}))
+  order = "" if ascending else "-"
+  lookups = set(json_fields[f] for f in field_names)
+  lookups.update(("id",date_field))
+  rows = list(items.order_by(order+date_field,order+"id")\
+              .values(*lookups)[:count+1])
+  next_cursor = None
+  if len(rows)>count:
+    rows = rows[:count]
+    next_cursor = encode_cursor(rows[-1][date_field],rows[-1]["id"])
+  data = {
+    "items": [dict((f,to_json_value(row[json_fields[f]]))
+                   for f in field_names) for row in rows],
+    "next_cursor": next_cursor,
+    }
+  return HttpResponse(simplejson.dumps(data),mimetype="application/json")
+
+  
+def get_collection_etag(request,owner_name):
+  if request.method!="GET":
+    return None
+  try:
+    collection_last_modified = request.owner_user.userprofile\
+                                                 .collection_last_modified
+  except UserProfile.DoesNotExist:
+    collection_last_modified = None
+  latest_saved_date = UserBookmark.objects.filter(owner=request.owner_user)\
+                                          .aggregate(Max("saved_date"))
+  return build_etag(request,collection_last_modified,
+                    latest_saved_date["saved_date__max"])
+
+  
 @check_and_set_owner
+@condition(etag_func=get_collection_etag)
 def get_user_collection(request,owner_name):
   """Display the collection of bookmarks"""
   bookmarks = UserBookmark.objects.filter(owner=request.owner_user)\
@@ -542,15 +814,29 @@ def get_user_collection(request,owner_name):
   bookmarks = bookmarks.order_by('-saved_date')
   expectedFormat = request.GET.get("format","html").lower()
   if expectedFormat=="ns-bmk-list":
-    paginator = Paginator(bookmarks, bookmarks.count())
-  else:
-    paginator = Paginator(bookmarks, MAX_ITEMS_PER_PAGE)
+    return HttpResponse(generate_ns_bookmark_list(request.owner_user,
+                                                  bookmarks),
+                        mimetype="text/html")
+  elif expectedFormat=="json":
+    return generate_json_page(request,bookmarks,COLLECTION_JSON_FIELDS,
+                              "saved_date")
+  paginator = Paginator(bookmarks, MAX_ITEMS_PER_PAGE)
   page = request.GET.get('page')
   try:
     bookmarks = paginator.page(page)
   except (PageNotAnInteger,EmptyPage):
     # If page is not an integer or out of range, deliver first page.
     bookmarks = paginator.page(1)
+  # Load the sources and tags of the whole page at once
+  bookmarks.object_list = list(bookmarks.object_list)
+  reference_ids = [b.reference_id for b in bookmarks.object_list]
+  sources_by_reference = get_visible_sources_by_reference(
+    request.owner_user,reference_ids,request.user!=request.owner_user)
+  tag_names = get_items_tag_names(request.owner_user,Reference,reference_ids)
+  for bmk in bookmarks.object_list:
+    bmk.visible_sources = sources_by_reference.get(bmk.reference_id,[])
+    bmk.visible_tag_names = [t for t in tag_names.get(bmk.reference_id,[])
+                             if t.strip()]
   d = add_base_template_context_data(
     {
       'user_bookmarks': bookmarks,
@@ -559,13 +845,8 @@ def get_user_collection(request,owner_name):
       'collection_add_bookmarklet': generate_collection_add_bookmarklet(
         request.build_absolute_uri("/"),request.user.username),
       }, request.user.username, owner_name)
-  if expectedFormat=="ns-bmk-list":
-    return render_to_response('collection_nsbmk.html',d,
-                              context_instance=RequestContext(request),
-                              mimetype="text/html")
-  else:
-    return render_to_response('collection.html',d,
-                              context_instance=RequestContext(request))
+  return render_to_response('collection.html',d,
+                            context_instance=RequestContext(request))
 
 
 def user_collection(request,owner_name):
@@ -623,13 +904,59 @@ def user_collection_item(request, owner_name, reference_url):
                             context_instance=RequestContext(request))
 
 
+def get_news_etag(request,owner_name):
+  """
+  Return an ETag for the river and sieve pages, changing when news
+  items are collected from the user's feeds, read or saved, and when
+  the user's sources change.
+  """
+  if request.method!="GET":
+    return None
+  profile = request.owner_user.userprofile
+  return build_etag(request,
+                    profile.sources_last_modified,
+                    profile.collection_last_modified,
+                    profile.news_last_modified,
+                    get_user_news_marker(request.owner_user))
+
+
+def refresh_news_etag(func):
+  """
+  Decorator for the river and sieve views, placed under the condition
+  decorator, that updates the ETag of the page when the view itself
+  modified the news (by creating the statuses of new items).
+  """
+  @wraps(func)
+  def _refresh_news_etag(request,owner_name,*args,**kwargs):
+    if request.method!="GET":
+      return func(request,owner_name,*args,**kwargs)
+    profile = request.owner_user.userprofile
+    news_last_modified = profile.news_last_modified
+    response = func(request,owner_name,*args,**kwargs)
+    if response.status_code==200 \
+       and profile.news_last_modified!=news_last_modified:
+      response["ETag"] = quote_etag(get_news_etag(request,owner_name))
+    return response
+  return _refresh_news_etag
+
+
 @check_and_set_owner
+@condition(etag_func=get_news_etag)
+@refresh_news_etag
 def user_river_view(request,owner_name):
   check_user_unread_feed_items(request.owner_user)
   river_items = ReferenceUserStatus.objects\
                                    .filter(owner=request.owner_user)\
                                    .order_by('-reference_pub_date')\
-                                   .select_related("reference")
+                                   .select_related("reference","main_source")
+  tag_name = request.GET.get("tag")
+  if tag_name:
+    river_items = river_items.filter(
+      main_source__in=get_user_source_ids_with_tag(request.owner_user,
+                                                   tag_name))
+  if request.GET.get("format","html").lower()=="json":
+    return generate_json_page(request,river_items,NEWS_JSON_FIELDS,
+                              "reference_pub_date")
   paginator = Paginator(river_items, MAX_ITEMS_PER_PAGE)
   page = request.GET.get('page')
   try:
@@ -639,6 +966,7 @@ def user_river_view(request,owner_name):
     news_items = paginator.page(1)
   d = add_base_template_context_data({
     'news_items': news_items,
+    'tag_name': tag_name,
     'source_add_bookmarklet': generate_source_add_bookmarklet(request.build_absolute_uri("/"),request.user.username),
   }, request.user.username, owner_name)
   return render_to_response('river.html',d,
@@ -653,6 +981,14 @@ def generate_user_sieve(request,owner_name):
   check_user_unread_feed_items(request.owner_user)
   unread_references = ReferenceUserStatus.objects.filter(owner=request.owner_user,
                                                          has_been_read=False)
+  tag_name = request.GET.get("tag")
+  if tag_name:
+    unread_references = unread_references.filter(
+      main_source__in=get_user_source_ids_with_tag(request.owner_user,
+                                                   tag_name))
+  if request.GET.get("format","html").lower()=="json":
+    return generate_json_page(request,unread_references,NEWS_JSON_FIELDS,
+                              "reference_pub_date",ascending=True)
   num_unread = unread_references.count()
   oldest_unread_references = unread_references.order_by('reference_pub_date')\
                              [:MAX_ITEMS_PER_PAGE]\
@@ -660,6 +996,7 @@ def generate_user_sieve(request,owner_name):
   d = add_base_template_context_data({
       'oldest_unread_references': oldest_unread_references,
       'num_unread_references': num_unread,
+      'tag_name': tag_name,
       'user_collection_url': reverse("wom_user.views.user_collection",
                                      args=(request.user.username,)),
       'source_add_bookmarklet': generate_source_add_bookmarklet(
@@ -693,26 +1030,24 @@ def apply_to_user_sieve(request,owner_name):
   action_name = action_dict.get(u"action")
   if action_name not in (u"read", u"drop"):
     return HttpResponseBadRequest("Only a JSON formatted 'read' and 'drop' actions are supported.")
-  modified_rust = []
-  rust_iterator = ReferenceUserStatus.objects\
-                                      .filter(has_been_read=False,
-                                              owner=request.owner_user)
+  unread_rusts = ReferenceUserStatus.objects\
+                                   .filter(has_been_read=False,
+                                           owner=request.owner_user)
   if action_name == u"read":
     target_urls = action_dict.get(u"references",[])
-    rust_iterator = rust_iterator.filter(reference__url__in=target_urls)
-  for rust in rust_iterator:
-    rust.has_been_read = True
-    modified_rust.append(rust)
+    unread_rusts = unread_rusts.filter(reference__url__in=target_urls)
   with transaction.commit_on_success():
-    for r in modified_rust:
-      r.save()
-  count = len(modified_rust)
+    count = unread_rusts.update(has_been_read=True)
+    if count:
+      touch_user_news(owner=request.owner_user)
   response_dict = {u"action": action_name, u"status": u"success", u"count": count}
   return HttpResponse(simplejson.dumps(response_dict), mimetype='application/json')
 
   
 
 @loggedin_and_owner_required
+@condition(etag_func=get_news_etag)
+@refresh_news_etag
 def user_river_sieve(request,owner_name):
   if request.owner_user != request.user:
     return HttpResponseForbidden()
@@ -724,42 +1059,134 @@ def user_river_sieve(request,owner_name):
     return HttpResponseNotAllowed(['GET','POST'])
 
 
-  
+
+def get_tagged_web_feeds(owner):
+  """Return the web feeds of the owner with their 'main_tag_name' set
+  (the first of their tag names in alphabetical order), sorted by this
+  tag name and then by title.
+  """
+  web_feeds = list(owner.userprofile.web_feeds.all()\
+                   .order_by('source__title')\
+                   .select_related("source"))
+  tag_names = get_items_tag_names(owner,WebFeed,[f.id for f in web_feeds])
+  for feed in web_feeds:
+    feed_tag_names = tag_names.get(feed.id)
+    feed.main_tag_name = feed_tag_names[0] if feed_tag_names else ""
+  web_feeds.sort(key=lambda f:f.main_tag_name)
+  return web_feeds
+
+
+SOURCES_OPML_HEADER = u"""\
+<?xml version="1.0" encoding="UTF-8"?>
+<opml version="1.0">
+  <head>
+    <title>WaterOnMars sources for %s.</title>
+  </head>
+  <body>
+"""
+
+SOURCES_OPML_TAG_START = u"""\
+  <outline title="%(tag)s" text="%(tag)s">
+"""
+
+SOURCES_OPML_FEED = u"""\
+    <outline text="%(title)s" title="%(title)s" xmlUrl="%(xml_url)s" htmlUrl="%(html_url)s" />
+"""
+
+SOURCES_OPML_TAG_END = u"  </outline>\n"
+
+SOURCES_OPML_FOOTER = u"""\
+  </body>
+</opml>
+"""
+
+
+def generate_sources_opml(owner):
+  """Yield the content of an OPML file listing the web feeds of the
+  owner grouped by their main tag, piece by piece.
+  """
+  yield SOURCES_OPML_HEADER % escape(owner.username)
+  current_tag = None
+  for feed in get_tagged_web_feeds(owner):
+    if feed.main_tag_name!=current_tag:
+      if current_tag is not None:
+        yield SOURCES_OPML_TAG_END
+      current_tag = feed.main_tag_name
+      yield SOURCES_OPML_TAG_START % {"tag": escape(current_tag)}
+    yield SOURCES_OPML_FEED % {
+      "title": escape(feed.source.title),
+      "xml_url": escape(feed.xmlURL),
+      "html_url": escape(feed.source.url),
+      }
+  if current_tag is not None:
+    yield SOURCES_OPML_TAG_END
+  yield SOURCES_OPML_FOOTER
+
+
+def get_sources_opml_cache_key(owner_profile):
+  return "wom_user.sources_opml.%d.%s" \
+    % (owner_profile.owner_id,
+       owner_profile.sources_last_modified.strftime("%Y%m%d%H%M%S%f"))
+
+
+def generate_cached_sources_opml(owner):
+  """Yield the OPML export of the owner's sources from the cache if
+  it is still valid, or stream it and store it in the cache once
+  fully generated.
+  """
+  cache_key = get_sources_opml_cache_key(owner.userprofile)
+  content = cache.get(cache_key)
+  if content is not None:
+    yield content
+    return
+  pieces = []
+  for piece in generate_sources_opml(owner):
+    pieces.append(piece)
+    yield piece
+  cache.set(cache_key,u"".join(pieces),OPML_CACHE_TIMEOUT)
+
+
+def is_sources_opml_request(request):
+  return request.method=="GET" \
+    and request.GET.get("format","html").lower()=="opml"
+
+
+def get_sources_etag(request,owner_name):
+  if request.method!="GET":
+    return None
+  profile = request.owner_user.userprofile
+  if is_sources_opml_request(request):
+    return get_sources_opml_cache_key(profile)
+  return build_etag(request,profile.sources_last_modified,
+                    profile.collection_last_modified)
+
+
 @check_and_set_owner
+@condition(etag_func=get_sources_etag)
 def user_river_sources(request,owner_name):
   if request.method == 'GET':
+    if is_sources_opml_request(request):
+      return HttpResponse(generate_cached_sources_opml(request.owner_user),
+                          mimetype="text/xml")
     owner_profile = request.owner_user.userprofile
-    web_feeds = owner_profile.web_feeds.all()\
-                                       .order_by('source__title')\
-                                       .select_related("source")
     if request.user == request.owner_user:
       other_sources = owner_profile.sources.all()
     else:
       other_sources = owner_profile.public_sources.all()
     other_sources = other_sources.exclude(webfeed__userprofile=owner_profile)\
                                  .order_by("title")
-    def add_tag_to_feed(feed):
-      tag_names = get_item_tag_names(request.owner_user,feed)
-      feed.main_tag_name = tag_names[0] if tag_names else ""
-      return feed
-    web_feeds = [add_tag_to_feed(f) for f in web_feeds.iterator()]
-    web_feeds.sort(key=lambda f:f.main_tag_name)
+    web_feeds = get_tagged_web_feeds(request.owner_user)
     d = add_base_template_context_data({
         'tagged_web_feeds': web_feeds,
         'user_tags': get_user_tags(request.owner_user), 
+        'user_tag_counts': get_user_tag_counts(request.owner_user,WebFeed),
         'other_sources': other_sources,
         'num_sources' : len(web_feeds)+other_sources.count(),
         'source_add_bookmarklet': generate_source_add_bookmarklet(
           request.build_absolute_uri("/"),request.user.username),
         }, request.user.username, owner_name)
-    expectedFormat = request.GET.get("format","html")
-    if expectedFormat.lower()=="opml":
-      return render_to_response('sources_opml.xml',d,
-                                context_instance=RequestContext(request),
-                                mimetype="text/xml")
-    else:
-      return render_to_response('sources.html',d,
-                                context_instance=RequestContext(request))
+    return render_to_response('sources.html',d,
+                              context_instance=RequestContext(request))
   elif request.user != request.owner_user:
     return HttpResponseForbidden()
   elif request.method == 'POST':